@@ -26,3 +26,6 @@ DATABASES = {
 
 VANDAR_API_KEY = ""
 KAVENEGAR_API_KEY = ""
+
+# never True in production, payments are accepted without the gateway
+DEBUG = False
@@ -123,10 +123,105 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# cache alias and timeout (seconds) of the serialized catalog responses
+CATALOG_CACHE = 'default'
+CATALOG_CACHE_TIMEOUT = 60 * 10
+
+# cache alias of the locks shared by the processes (core.helpers.SharedKeyLock), not locmem in production
+LOCK_CACHE = 'default'
+# a payment verification holds its lock for at most VERIFICATION_LOCK_TIMEOUT seconds,
+# duplicate callbacks wait up to VERIFICATION_WAIT seconds for it and answer with its result
+VERIFICATION_LOCK_TIMEOUT = 60
+VERIFICATION_WAIT = 25
+
+# expired reservations are released by the basket creation and, at most once per interval (seconds),
+# by the catalog reads, a batch of invoices at a time
+RESERVATION_RELEASE_INTERVAL = 60
+RESERVATION_RELEASE_BATCH_SIZE = 100
+
+# cache alias of the config version, it must be shared by all the processes (not locmem) in production
+# each process checks the version at most once per CONFIG_CHECK_INTERVAL seconds
+# and reloads the config after CONFIG_MAX_AGE seconds, which bounds the staleness when the cache is not shared
+CONFIG_CACHE = 'default'
+CONFIG_CHECK_INTERVAL = 5
+CONFIG_MAX_AGE = 60
+
+# sms queue, the transport delivering the verification codes
+# core.sms.KavenegarTransport, core.sms.ConsoleTransport or core.sms.LocMemTransport (tests)
+SMS_TRANSPORT = 'core.sms.ConsoleTransport' if DEBUG else 'core.sms.KavenegarTransport'
+SMS_MAX_ATTEMPTS = 4
+# seconds before the first retry, doubled on every failed attempt
+# the retries should fit in the lifetime of a code (UserProfilePhoneVerification.RETRY_TIME)
+SMS_RETRY_BACKOFF = 5
+# seconds a worker has to send a claimed message before it is sent again, longer than the gateway timeouts
+SMS_CLAIM_TIMEOUT = 60
+# in process workers sending the queued messages as soon as they are committed,
+# 0 leaves every message to the process_sms_queue command
+SMS_WORKER_THREADS = 2
+
+# http clients of the payment and sms gateways (core.gateway)
+# TIMEOUTS: {endpoint: (connect, read)} seconds
+# FAILURE_THRESHOLD consecutive failures open the circuit for RESET_TIMEOUT seconds
+GATEWAYS = {
+    'vandar': {
+        'BASE_URL': 'https://ipg.vandar.io',
+        'TIMEOUTS': {'send': (3.05, 10), 'verify': (3.05, 20)},
+        'FAILURE_THRESHOLD': 5,
+        'RESET_TIMEOUT': 30,
+        'POOL_SIZE': 10,
+        'ASYNC_POOL_SIZE': 100,
+    },
+    'kavenegar': {
+        'BASE_URL': 'https://api.kavenegar.com',
+        'TIMEOUTS': {'lookup': (3.05, 5)},
+        'FAILURE_THRESHOLD': 5,
+        'RESET_TIMEOUT': 30,
+        'POOL_SIZE': 10,
+        'ASYNC_POOL_SIZE': 100,
+    },
+}
+
+# tokens resolved by core.authentication.CachedTokenAuthentication are kept in each process
+# for AUTH_TOKEN_CACHE_TTL seconds, AUTH_CACHE holds the auth versions and must be shared by the processes,
+# check --deploy fails when it is process local and WORKER_PROCESSES (WEB_CONCURRENCY) is more than one
+AUTH_CACHE = 'default'
+WORKER_PROCESSES = int(os.environ.get('WEB_CONCURRENCY', 1))
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_CACHE_TTL = 60 * 5
+
+# webp renditions of the book covers (core.images), {name: (max width, max height)}
+IMAGE_RENDITIONS = {
+    'thumbnail': (160, 240),
+    'small': (320, 480),
+    'medium': (640, 960),
+}
+IMAGE_RENDITION_QUALITY = 80
+
+# books with at most this many remaining are listed by the low stock filter of the book admin
+LOW_STOCK_THRESHOLD = 5
+
+# rate limits of the send code and get info endpoints (core.throttling), 'number/second|minute|hour|day',
+# None disables a limit, THROTTLE_CACHE holds the counters and must be shared by the processes
+THROTTLE_CACHE = 'default'
+OTP_THROTTLE_RATES = {
+    'phone': '20/hour',
+    'ip': '100/hour',
+    'global': '600/minute',
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'core.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    ]
+    ],
+    # reverse proxies in front of the app, the client ip of the rate limits is taken from X-Forwarded-For
+    # behind them, 0 uses the connection address and ignores the header
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
@@ -1,6 +1,13 @@
-from django.contrib import admin
+import tempfile
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from .export import get_fulfillment_rows, stream_csv, write_xlsx, ExportError
+
 from .models import UserProfile, Book, Basket, Person, Invoice, Item, Publisher, Config, UserProfilePhoneVerification
 from django.utils.html import format_html
 from django.utils.translation import gettext as _
@@ -11,9 +18,65 @@ class UserProfileAdmin(admin.ModelAdmin):
     search_fields = ['first_name', 'last_name', 'phone_number']
 
 
+class StockListFilter(admin.SimpleListFilter):
+    """
+    books by remaining count, low stock is at most settings.LOW_STOCK_THRESHOLD books
+    """
+    title = _("stock")
+    parameter_name = 'stock'
+
+    OUT = 'out'
+    LOW = 'low'
+    IN = 'in'
+
+    def lookups(self, request, model_admin):
+        return [
+            (StockListFilter.OUT, _("Out of stock")),
+            (StockListFilter.LOW, _("Low stock")),
+            (StockListFilter.IN, _("In stock")),
+        ]
+
+    def queryset(self, request, queryset):
+        queryset = queryset.with_stock()
+        if self.value() == StockListFilter.OUT:
+            return queryset.filter(remaining_amount__lte=0)
+        if self.value() == StockListFilter.LOW:
+            return queryset.filter(remaining_amount__gt=0, remaining_amount__lte=settings.LOW_STOCK_THRESHOLD)
+        if self.value() == StockListFilter.IN:
+            return queryset.filter(remaining_amount__gt=0)
+        return queryset
+
+
 class BookAdmin(admin.ModelAdmin):
-    list_display = ['pk', 'title', 'description', 'price', 'discount', 'count', 'sold', 'final_price']
+    list_display = ['pk', 'title', 'description', 'price', 'discount', 'count',
+                    'sold', 'in_payment', 'remaining', 'final_price']
     search_fields = ['pk', 'title', 'description', 'price', ]
+    list_filter = [StockListFilter, 'is_delete']
+
+    def get_queryset(self, request):
+        # the stock columns are read from the stock ledger, sortable by their annotations
+        return super(BookAdmin, self).get_queryset(request).with_stock().with_final_price()
+
+    def sold(self, book):
+        return book.sold_count
+
+    sold.admin_order_field = 'sold_count'
+
+    def in_payment(self, book):
+        return book.reserved_count
+
+    in_payment.admin_order_field = 'reserved_count'
+    in_payment.short_description = _("in payment")
+
+    def remaining(self, book):
+        return book.remaining_amount
+
+    remaining.admin_order_field = 'remaining_amount'
+
+    def final_price(self, book):
+        return int(book.final_price_amount)
+
+    final_price.admin_order_field = 'final_price_amount'
 
 
 class PersonAdmin(admin.ModelAdmin):
@@ -44,6 +107,46 @@ class BasketAdmin(admin.ModelAdmin):
                      'user_profile__phone_number',
                      'user_profile__last_name']
 
+    actions = ['export_fulfillment_csv', 'export_fulfillment_xlsx']
+
+    def get_queryset(self, request):
+        # everything a changelist row shows, in a constant number of queries per page
+        return super(BasketAdmin, self).get_queryset(request) \
+            .select_related('invoice', 'user_profile') \
+            .prefetch_related('items__book') \
+            .with_subtotal()
+
+    @staticmethod
+    def get_export_filename(extension):
+        return 'fulfillment-%s.%s' % (timezone.localtime().strftime('%Y%m%d-%H%M'), extension)
+
+    def export_fulfillment_csv(self, request, queryset):
+        response = StreamingHttpResponse(stream_csv(get_fulfillment_rows(queryset)), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % self.get_export_filename('csv')
+        return response
+
+    export_fulfillment_csv.short_description = _("Export payed and pending baskets (csv)")
+
+    def export_fulfillment_xlsx(self, request, queryset):
+        # xlsx files are zip archives, written to a temporary file before being sent
+        file = tempfile.TemporaryFile()
+        try:
+            write_xlsx(get_fulfillment_rows(queryset), file)
+        except ExportError as e:
+            file.close()
+            self.message_user(request, str(e), level=messages.ERROR)
+            return None
+
+        file.seek(0)
+        return FileResponse(file, as_attachment=True, filename=self.get_export_filename('xlsx'))
+
+    export_fulfillment_xlsx.short_description = _("Export payed and pending baskets (xlsx)")
+
+    def subtotal(self, basket):
+        return basket.subtotal_amount
+
+    subtotal.admin_order_field = 'subtotal_amount'
+
     @staticmethod
     def details(basket):
         return "DETAILS"
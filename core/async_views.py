@@ -0,0 +1,141 @@
+"""
+Async variants of the payment and send code views, served under /async/ by an ASGI server
+
+the gateway calls are awaited on the event loop, so a worker holds many in flight payments,
+the database work runs in sync_to_async threads, responses are the same as the sync views
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, HttpResponseNotAllowed
+from django.shortcuts import get_object_or_404
+from django.utils.translation import gettext as _
+from rest_framework import serializers
+from rest_framework.parsers import JSONParser, FormParser
+from rest_framework.request import Request
+
+from BookStore.settings import DEBUG
+from .gateway import GatewayError
+from .models import Invoice
+from .serializers import SendCodeSerializer
+from .throttling import get_throttle_wait
+from .vandar import vandar_prepare_for_payment_async, vandar_verify_payment_async
+from .views import VerifyPaymentView
+
+
+
+def get_invoice(internal_id):
+    return get_object_or_404(Invoice.objects.select_related('basket'), internal_id=internal_id)
+
+
+async def make_payment(request, internal_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    invoice = await sync_to_async(get_invoice)(internal_id)
+
+    # reject invalid basket
+    if not await sync_to_async(lambda: invoice.basket.is_valid_for_payment)():
+        return JsonResponse({'details': _("Invalid Basket")}, status=400)
+
+    result = await vandar_prepare_for_payment_async(invoice, request)
+
+    # vandar failed to create redirect url
+    if result.get('status') != 200:
+        return JsonResponse(result)
+
+    # redirect url fetched from vandar
+    return JsonResponse({
+        'redirect_to': result.get('redirect_to')
+    })
+
+
+async def verify_payment(request, internal_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    # final invoices are answered from the database
+    invoice = await sync_to_async(get_invoice)(internal_id)
+    if not await sync_to_async(VerifyPaymentView.doesHaveValidBasket)(invoice):
+        return await get_invoice_response(invoice, status=VerifyPaymentView.getFinalInvoiceStatusCode(invoice))
+
+    # duplicate callbacks, of any process, wait for the first one and read its result
+    lock = VerifyPaymentView.verification_lock
+    token = await sync_to_async(lock.acquire)(str(internal_id), settings.VERIFICATION_LOCK_TIMEOUT)
+    if token is None:
+        await lock.wait_async(str(internal_id), settings.VERIFICATION_WAIT)
+        response = await sync_to_async(VerifyPaymentView.getVerifiedResponse)(internal_id)
+        return JsonResponse(response.data, status=response.status_code)
+
+    try:
+        invoice = await sync_to_async(get_invoice)(internal_id)
+        if not await sync_to_async(VerifyPaymentView.doesHaveValidBasket)(invoice):
+            return await get_invoice_response(invoice, status=VerifyPaymentView.getFinalInvoiceStatusCode(invoice))
+
+        try:
+            if DEBUG:
+                await sync_to_async(VerifyPaymentView.validateInvoice)(invoice)
+            else:
+                await vandar_verify_payment_async(invoice)
+        except GatewayError:
+            # the payment state is unknown, the invoice can be verified again later
+            return JsonResponse({'details': _("Payment gateway is not available")}, status=503)
+    finally:
+        await sync_to_async(lock.release)(str(internal_id), token)
+
+    if not VerifyPaymentView.isInvoiceValidated(invoice):
+        return await get_invoice_response(invoice, status=400)
+
+    return await get_invoice_response(invoice, status=200)
+
+
+async def get_invoice_response(invoice, status):
+    data = await sync_to_async(VerifyPaymentView.getInvoiceSerializedData)(invoice)
+    return JsonResponse(data, status=status)
+
+
+async def send_code(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        data = get_request_data(request)
+    except ValueError:
+        return JsonResponse({'details': _("Invalid request body")}, status=400)
+
+    # the throttles of UserProfileSendCode
+    wait = await sync_to_async(get_throttle_wait)(Request(request, parsers=[JSONParser(), FormParser()]))
+    if wait is not None:
+        response = JsonResponse({'detail': _("Request was throttled.")}, status=429)
+        response['Retry-After'] = '%d' % wait
+        return response
+
+    data, status = await sync_to_async(create_verification_object)(data)
+    return JsonResponse(data, status=status)
+
+
+# called with tokens or without a session like the rest framework views, csrf_exempt only wraps sync views
+send_code.csrf_exempt = True
+
+
+def get_request_data(request):
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+def create_verification_object(data):
+    """
+    :return: (response data, status code) of UserProfileSendCode
+    """
+    serializer = SendCodeSerializer(data=data)
+    if not serializer.is_valid():
+        return serializer.errors, 400
+
+    try:
+        serializer.save()
+    except serializers.ValidationError as e:
+        return e.detail, 400
+
+    return serializer.data, 201
@@ -0,0 +1,42 @@
+import copy
+
+from django.conf import settings
+from django.utils.translation import gettext as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from .cache import LRUCache, get_auth_version
+
+# {token key: (token with its user and user profile, auth version of the user)}
+token_cache = LRUCache(max_size=settings.AUTH_TOKEN_CACHE_SIZE, ttl=settings.AUTH_TOKEN_CACHE_TTL)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication resolving the token, the user and the user profile from an in process cache
+
+    a cached token is used while the auth version of its user is unchanged (core.cache.invalidate_user_auth),
+    the ttl bounds the staleness of a change made while the token was being loaded
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            token, version = cached
+            if version == get_auth_version(token.user_id):
+                # every request gets its own instances
+                token = copy.deepcopy(token)
+                return token.user, token
+
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user', 'user__user_profile').get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        token_cache.set(key, (token, get_auth_version(token.user_id)))
+        token = copy.deepcopy(token)
+        return token.user, token
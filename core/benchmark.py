@@ -0,0 +1,392 @@
+"""
+API benchmark: seeds a catalog and measures query counts, latency and response size per endpoint
+
+used by the benchmark_api command, which runs it against a throwaway test database,
+PaymentLoadTest is used by the load_test_payments command
+"""
+import asyncio
+import contextlib
+import io
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, AsyncClient
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from .cache import invalidate_catalog
+from .gateway import GatewayClient, close_async_clients
+from .gateway_stub import GatewayStub
+from .models import Book, Person, Publisher, UserProfile, Invoice, Basket, Item, UserProfilePhoneVerification, \
+    Config, move_book_stock
+
+BATCH_SIZE = 1000
+
+
+def seed_catalog(n_books, n_baskets, seed=0):
+    """
+    create n_books books with people and publishers and n_baskets payed or pending baskets
+    """
+    rng = random.Random(seed)
+
+    # bulk created primary keys are not set on every database, read them back
+    Publisher.objects.bulk_create(
+        [Publisher(name="publisher %d" % i) for i in range(max(1, n_books // 100))], batch_size=BATCH_SIZE)
+    publisher_ids = list(Publisher.objects.values_list('pk', flat=True))
+
+    Person.objects.bulk_create(
+        [Person(first_name="person", last_name="%d" % i) for i in range(max(1, n_books // 10))],
+        batch_size=BATCH_SIZE)
+    people_ids = list(Person.objects.values_list('pk', flat=True))
+
+    Book.objects.bulk_create([Book(
+        title="book %d" % i,
+        description="description of book %d" % i,
+        publisher_id=rng.choice(publisher_ids),
+        price=rng.randint(10, 500) * 1000,
+        discount=rng.choice([0, 0.1, 0.2]),
+        isbn="978%010d" % i,
+        count=rng.randint(0, 50) + n_baskets,
+    ) for i in range(n_books)], batch_size=BATCH_SIZE)
+    book_ids = list(Book.objects.values_list('pk', flat=True))
+
+    for relation in [Book.authors, Book.translators]:
+        relation.through.objects.bulk_create([
+            relation.through(book_id=book_id, person_id=rng.choice(people_ids)) for book_id in book_ids
+        ], batch_size=BATCH_SIZE)
+
+    Book.related_books.through.objects.bulk_create([
+        Book.related_books.through(from_book_id=book_id, to_book_id=rng.choice(book_ids)) for book_id in book_ids
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    seed_baskets(n_baskets, book_ids, rng)
+
+
+def seed_baskets(n_baskets, book_ids, rng):
+    user_profile = create_user_profile("benchmark-seed", "09000000000")
+
+    Invoice.objects.bulk_create([
+        Invoice(amount=1000, delivery_fee=1000, status=rng.choice([Invoice.PAYED, Invoice.REJECTED]))
+        for _ in range(n_baskets)
+    ], batch_size=BATCH_SIZE)
+    invoices = Invoice.objects.order_by('-pk')[:n_baskets]
+
+    Basket.objects.bulk_create([
+        Basket(user_profile=user_profile, invoice=invoice) for invoice in invoices
+    ], batch_size=BATCH_SIZE)
+
+    items = []
+    for basket in Basket.objects.filter(user_profile=user_profile):
+        for book_id in rng.sample(book_ids, min(len(book_ids), rng.randint(1, 3))):
+            items.append(Item(basket=basket, book_id=book_id, count=1, price=1000))
+    Item.objects.bulk_create(items, batch_size=BATCH_SIZE)
+
+    # count the payed items in the stock ledger
+    sold = {}
+    for book_id in Item.objects.filter(basket__invoice__status=Invoice.PAYED).values_list('book', flat=True):
+        sold[book_id] = sold.get(book_id, 0) + 1
+    Invoice.objects.filter(status=Invoice.PAYED).update(stock_status=Invoice.STOCK_SOLD)
+    move_book_stock(sold, Invoice.STOCK_NONE, Invoice.STOCK_SOLD)
+
+
+def create_user_profile(username, phone_number):
+    user = User.objects.create_user(username=username)
+    return UserProfile.objects.create(user=user, phone_number=phone_number)
+
+
+def get_unreachable_throttle_rates():
+    return {scope: '%d/hour' % 10 ** 9 for scope in settings.OTP_THROTTLE_RATES}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(samples):
+    latencies = [sample.get('latency') for sample in samples]
+    queries = [sample.get('queries') for sample in samples]
+    sizes = [sample.get('size') for sample in samples]
+
+    return {
+        'requests': len(samples),
+        'status_codes': sorted(set(sample.get('status') for sample in samples)),
+        'queries': {'median': statistics.median(queries), 'max': max(queries)},
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p90': round(percentile(latencies, 90) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(max(latencies) * 1000, 3),
+        },
+        'response_bytes': {'median': statistics.median(sizes), 'max': max(sizes)},
+    }
+
+
+class Benchmark:
+    """
+    measures the endpoints on the current database, seed it first
+
+    :param repeats: number of measured requests per endpoint
+    :param warm_cache: keep the catalog cache between requests, by default it is invalidated
+    before every catalog request to measure the database cost
+    """
+
+    def __init__(self, repeats=20, warm_cache=False, seed=0):
+        self.repeats = repeats
+        self.warm_cache = warm_cache
+        self.rng = random.Random(seed)
+        self.client = APIClient()
+        self.phone_number_counter = 0
+
+        self.book_ids = list(Book.objects.filter(is_delete=False).values_list('pk', flat=True))
+        self.user_profile = create_user_profile("benchmark", "09100000000")
+        self.client.force_authenticate(user=self.user_profile.user)
+
+        config = Config.get_instance()
+        config.delivery_fee = 1000
+        config.save()
+
+    def run(self):
+        endpoints = [
+            ('send_code', self.send_code),
+            ('get_info', self.get_info),
+            ('book_detail', self.book_detail),
+            ('book_list_page', self.book_list_page),
+            ('book_list_cursor', self.book_list_cursor),
+            ('book_list_compact', self.book_list_compact),
+            ('basket_create', self.basket_create),
+            ('basket_create_20_items', lambda: self.basket_create(n_items=20)),
+            ('basket_create_underflow', self.basket_create_underflow),
+            ('payment_make', self.payment_make),
+            ('payment_verify', self.payment_verify),
+        ]
+
+        report = {}
+        # the gateways are answered by a local stub server, no external network is used
+        # queued sms messages are delivered out of the request, leave them in the queue
+        # the otp rate limits are checked but never reached, every request comes from the same ip
+        with GatewayStub() as stub, override_settings(GATEWAYS=stub.get_gateways(), SMS_WORKER_THREADS=0,
+                                                      OTP_THROTTLE_RATES=get_unreachable_throttle_rates()):
+            for name, endpoint in endpoints:
+                report[name] = summarize([self.measure(endpoint) for _ in range(self.repeats)])
+
+        return report
+
+    def measure(self, endpoint):
+        """
+        :param endpoint: prepares the untimed state and returns a function making the timed request
+        """
+        request = endpoint()
+
+        with CaptureQueriesContext(connection) as context, contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            response = request()
+            latency = time.perf_counter() - start
+
+        return {
+            'latency': latency,
+            'queries': len(context.captured_queries),
+            'status': response.status_code,
+            'size': len(response.content),
+        }
+
+    def next_phone_number(self):
+        self.phone_number_counter += 1
+        return "093%08d" % self.phone_number_counter
+
+    def catalog_request(self, url, data=None):
+        if not self.warm_cache:
+            invalidate_catalog()
+        return lambda: self.client.get(url, data=data)
+
+    def send_code(self):
+        phone_number = self.next_phone_number()
+        return lambda: self.client.post(reverse('send_code'), data={'phone_number': phone_number})
+
+    def get_info(self):
+        phone_number = self.next_phone_number()
+        user_profile = create_user_profile(phone_number, phone_number)
+        verification_object = UserProfilePhoneVerification.objects.create(user_profile=user_profile).get('obj')
+
+        return lambda: self.client.post(reverse('get_user_info'), data={
+            'phone_number': phone_number,
+            'code': verification_object.code,
+        })
+
+    def book_detail(self):
+        book_id = self.rng.choice(self.book_ids)
+        return self.catalog_request(reverse('book_detail', kwargs={'book_id': book_id}))
+
+    def book_list_page(self):
+        pages = max(1, len(self.book_ids) // 20)
+        return self.catalog_request(reverse('books_list'), {'pagination': 'page', 'page': self.rng.randint(1, pages)})
+
+    def book_list_cursor(self):
+        return self.catalog_request(reverse('books_list'), {'pagination': 'cursor'})
+
+    def book_list_compact(self):
+        return self.catalog_request(reverse('books_list'), {'pagination': 'page', 'compact': 'true'})
+
+    def get_basket_data(self, n_items=3):
+        book_ids = self.rng.sample(self.book_ids, min(n_items, len(self.book_ids)))
+        return {'items': [{'book': book.pk, 'count': 1} for book in Book.objects.filter(pk__in=book_ids).in_stock()]}
+
+    def create_basket(self):
+        return self.client.post(reverse('basket_create'), data=self.get_basket_data(), format='json')
+
+    def basket_create(self, n_items=3):
+        data = self.get_basket_data(n_items)
+        return lambda: self.client.post(reverse('basket_create'), data=data, format='json')
+
+    def basket_create_underflow(self):
+        data = self.get_basket_data()
+        for item in data.get('items'):
+            item['count'] = 10 ** 6
+        return lambda: self.client.post(reverse('basket_create'), data=data, format='json')
+
+    def payment_make(self):
+        internal_id = self.create_basket().data.get('invoice').get('internal_id')
+        return lambda: self.client.get(reverse('payment_make', kwargs={'internal_id': internal_id}))
+
+    def payment_verify(self):
+        internal_id = self.create_basket().data.get('invoice').get('internal_id')
+        self.client.get(reverse('payment_make', kwargs={'internal_id': internal_id}))
+        return lambda: self.client.get(reverse('payment_verify', kwargs={'internal_id': internal_id}))
+
+
+class PaymentLoadTest:
+    """
+    compares the payment throughput of the sync and the async views against a slow local gateway
+
+    a sync worker is blocked for the whole gateway call, the sync path is measured on the given number
+    of worker threads, each with its own database connection, the async path is measured on a single event loop
+    with the given number of concurrent requests
+
+    :param gateway_delay: seconds the stub gateway takes to answer
+    """
+
+    def __init__(self, requests=100, concurrency=50, workers=4, gateway_delay=0.1):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.workers = workers
+        self.gateway_delay = gateway_delay
+        self.benchmark = Benchmark(repeats=0)
+
+    def run(self):
+        sync_invoices = [self.create_invoice() for _ in range(self.requests)]
+        async_invoices = [self.create_invoice() for _ in range(self.requests)]
+
+        with GatewayStub(delay=self.gateway_delay) as stub, \
+                override_settings(GATEWAYS=stub.get_gateways(), SMS_WORKER_THREADS=0):
+            return {
+                'requests': self.requests,
+                'gateway_delay_ms': self.gateway_delay * 1000,
+                'sync': self.run_sync(sync_invoices),
+                # the database work of the async views runs on this thread, like in a test
+                'async': async_to_sync(self.run_async)(async_invoices),
+            }
+
+    def create_invoice(self):
+        return self.benchmark.create_basket().data.get('invoice').get('internal_id')
+
+    def run_sync(self, internal_ids):
+        turns = DatabaseTurns(enabled=connection.vendor == 'sqlite')
+
+        def make_payments(worker_internal_ids):
+            client = Client()
+            responses = []
+            try:
+                for internal_id in worker_internal_ids:
+                    with turns:
+                        responses.append(client.get(reverse('payment_make', kwargs={'internal_id': internal_id})))
+                return responses
+            finally:
+                # worker threads have their own database connections
+                connection.close()
+
+        start = time.perf_counter()
+        with turns.release_during_gateway_calls(), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            responses = [response for worker_responses in executor.map(
+                make_payments, [internal_ids[worker::self.workers] for worker in range(self.workers)]
+            ) for response in worker_responses]
+        seconds = time.perf_counter() - start
+
+        result = self.summarize(responses, seconds)
+        result['workers'] = self.workers
+        return result
+
+    async def run_async(self, internal_ids):
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def make_payment(internal_id):
+            async with semaphore:
+                return await client.get(reverse('payment_make_async', kwargs={'internal_id': internal_id}))
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[make_payment(internal_id) for internal_id in internal_ids])
+        seconds = time.perf_counter() - start
+        await close_async_clients()
+
+        result = self.summarize(responses, seconds)
+        result['concurrency'] = self.concurrency
+        return result
+
+    @staticmethod
+    def summarize(responses, seconds):
+        return {
+            'status_codes': sorted(set(response.status_code for response in responses)),
+            'redirects': sum(1 for response in responses if 'redirect_to' in json.loads(response.content)),
+            'seconds': round(seconds, 3),
+            'requests_per_second': round(len(responses) / seconds, 3),
+        }
+
+
+class DatabaseTurns:
+    """
+    sqlite has one writer at a time and fails the transactions of other connections upgrading their locks,
+    the sync workers take turns for their requests and give the turn up while they wait for a gateway,
+    so the gateway calls overlap and the database work is serialized, as a single sqlite writer would do anyway
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        if self.enabled:
+            self.lock.acquire()
+
+    def __exit__(self, *args):
+        if self.enabled:
+            self.lock.release()
+
+    @contextlib.contextmanager
+    def release_during_gateway_calls(self):
+        if not self.enabled:
+            yield
+            return
+
+        request = GatewayClient.request
+        turns = self
+
+        def request_without_turn(client, *args, **kwargs):
+            turns.lock.release()
+            try:
+                return request(client, *args, **kwargs)
+            finally:
+                turns.lock.acquire()
+
+        with mock.patch.object(GatewayClient, 'request', request_without_turn):
+            yield
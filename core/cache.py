@@ -0,0 +1,204 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_LIST_VERSION_KEY = 'catalog:list:version'
+CATALOG_BOOK_VERSION_KEY = 'catalog:book:%s:version'
+CONFIG_VERSION_KEY = 'config:version'
+AUTH_VERSION_KEY = 'auth:version:%s'
+
+
+def get_catalog_cache():
+    return caches[settings.CATALOG_CACHE]
+
+
+def bump_catalog_version():
+    get_catalog_cache().set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_catalog():
+    """
+    Invalidate all the cached catalog responses,
+    once now and once after the current transaction commits,
+    so responses cached from not yet committed data are dropped too
+    """
+    bump_catalog_version()
+    transaction.on_commit(bump_catalog_version)
+
+
+def get_catalog_versions(book_id=None):
+    """
+    :param book_id: the book of a detail response, None for the list responses
+    :return: the versions a cached catalog response key contains,
+        the catalog version and the version of the book or of the lists
+    """
+    cache = get_catalog_cache()
+    keys = [CATALOG_VERSION_KEY, CATALOG_BOOK_VERSION_KEY % book_id if book_id else CATALOG_LIST_VERSION_KEY]
+
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_book_versions(book_ids):
+    keys = [CATALOG_LIST_VERSION_KEY] + [CATALOG_BOOK_VERSION_KEY % book_id for book_id in book_ids]
+    get_catalog_cache().set_many({key: uuid.uuid4().hex for key in keys}, timeout=None)
+
+
+def invalidate_books(book_ids):
+    """
+    Invalidate the cached detail responses of the books and all the list responses,
+    the other book details stay cached, now and after the current transaction commits
+    """
+    book_ids = list(book_ids)
+    bump_book_versions(book_ids)
+    transaction.on_commit(lambda: bump_book_versions(book_ids))
+
+
+def get_config_version():
+    """
+    changed on every config save, the processes compare it with the version of their cached config
+    """
+    cache = caches[settings.CONFIG_CACHE]
+    version = cache.get(CONFIG_VERSION_KEY)
+    if version is None:
+        cache.add(CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(CONFIG_VERSION_KEY)
+    return version
+
+
+def bump_config_version():
+    caches[settings.CONFIG_CACHE].set(CONFIG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_config():
+    """
+    Invalidate the cached config of all the processes, now and after the current transaction commits
+    """
+    bump_config_version()
+    transaction.on_commit(bump_config_version)
+
+
+def get_auth_version(user_id):
+    """
+    changed when the token or the profile of the user changes,
+    the processes compare it with the version of their cached user
+    """
+    cache = caches[settings.AUTH_CACHE]
+    key = AUTH_VERSION_KEY % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_auth_version(user_id):
+    caches[settings.AUTH_CACHE].set(AUTH_VERSION_KEY % user_id, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_user_auth(user_id):
+    """
+    Invalidate the cached authentication of the user in all the processes,
+    now and after the current transaction commits
+    """
+    bump_auth_version(user_id)
+    transaction.on_commit(lambda: bump_auth_version(user_id))
+
+
+class LRUCache:
+    """
+    in process cache of at most max_size entries, each one kept for ttl seconds
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_response_cache_key(request, book_id=None):
+    """
+    the responses contain absolute urls (images, next pages), so the host and scheme are part of the key
+    """
+    query = '&'.join('%s=%s' % (key, value)
+                     for key in sorted(request.query_params.keys())
+                     for value in request.query_params.getlist(key))
+    uri_hash = hashlib.md5(('%s?%s' % (request.build_absolute_uri(request.path), query)).encode()).hexdigest()
+    return 'catalog:%s:%s' % (':'.join(get_catalog_versions(book_id)), uri_hash)
+
+
+def get_etag(data):
+    return quote_etag(hashlib.md5(JSONRenderer().render(data)).hexdigest())
+
+
+class CatalogCacheMixin:
+    """
+    Caches the serialized data of successful GET responses,
+    keyed by the request uri, the catalog version and the version of the book (detail views) or the lists
+
+    responses have an ETag, a matching If-None-Match is answered with 304
+    """
+
+    def get(self, request, *args, **kwargs):
+        cache = get_catalog_cache()
+        lookup_url_kwarg = getattr(self, 'lookup_url_kwarg', None)
+        key = get_response_cache_key(request, self.kwargs.get(lookup_url_kwarg) if lookup_url_kwarg else None)
+
+        cached = cache.get(key)
+        if cached is None:
+            response = super(CatalogCacheMixin, self).get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+            cached = {'data': response.data, 'etag': get_etag(response.data)}
+            cache.set(key, cached, timeout=settings.CATALOG_CACHE_TIMEOUT)
+
+        etag = cached.get('etag')
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=304, headers={'ETag': etag})
+
+        return Response(cached.get('data'), headers={'ETag': etag})
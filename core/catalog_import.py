@@ -0,0 +1,339 @@
+"""
+Catalog import: books, people and publishers from csv or jsonl files
+
+rows are read as a stream and written in chunks, a transaction per chunk,
+people and publishers are deduplicated by their normalized names (core.search.normalize)
+and books are matched by their isbn, importing a file again updates the same books
+
+csv columns / jsonl keys:
+    isbn, title, description, edition, publish_date, publisher, price, discount, count,
+    page_count, cover_type, cover_format, authors, editors, translators, related_books
+people and related books (isbn numbers) are lists in jsonl and | separated in csv,
+missing keys and empty cells keep the current values of the book,
+rows with values the model fields can not store are skipped before anything is written
+"""
+import csv
+import itertools
+import json
+import re
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+
+from .cache import invalidate_catalog
+from .models import Book, Person, Publisher
+from .search import normalize, index_books
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = [CSV, JSONL]
+
+CHUNK_SIZE = 1000
+# books per update query, every field is set by a CASE over the books
+BULK_UPDATE_SIZE = 100
+LIST_SEPARATOR = '|'
+
+BOOK_FIELDS = ['title', 'description', 'edition', 'publish_date', 'price', 'discount', 'count',
+               'page_count', 'cover_type', 'cover_format']
+PEOPLE_FIELDS = ['authors', 'editors', 'translators']
+LIST_FIELDS = PEOPLE_FIELDS + ['related_books']
+
+
+def read_csv(file):
+    for row in csv.DictReader(file):
+        row = {key: value.strip() for key, value in row.items() if key and value and value.strip()}
+        for field in LIST_FIELDS:
+            if field in row:
+                row[field] = [value.strip() for value in row[field].split(LIST_SEPARATOR) if value.strip()]
+        yield row
+
+
+def read_jsonl(file):
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+
+        row = {key: value for key, value in json.loads(line).items() if value not in [None, '']}
+        for field in LIST_FIELDS:
+            if isinstance(row.get(field), str):
+                row[field] = [value.strip() for value in row[field].split(LIST_SEPARATOR) if value.strip()]
+        yield row
+
+
+def read_rows(file, file_format):
+    if file_format == JSONL:
+        return read_jsonl(file)
+    return read_csv(file)
+
+
+def normalize_name(name):
+    return ' '.join(normalize(name).split())
+
+
+def normalize_isbn(isbn):
+    return re.sub(r'[^0-9x]', '', normalize(str(isbn or '')))
+
+
+def split_name(name):
+    """
+    :return: first name, last name, the last word is the last name
+    """
+    words = name.split()
+    if len(words) == 1:
+        return words[0], None
+    return ' '.join(words[:-1]), words[-1]
+
+
+def clean_value(field, value):
+    """
+    :return: value converted and validated by the model field
+    :raise ValidationError: the column can not store the value
+    """
+    value = field.clean(value, None)
+    # the integer ranges of the fields are not validated on sqlite, the check constraints still fail
+    if isinstance(field, models.PositiveIntegerField) and value is not None:
+        MinValueValidator(0)(value)
+    return value
+
+
+def get_last_pk(model):
+    return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+class CatalogImporter:
+    """
+    :param progress: called with the stats after every chunk
+    :param index: update the search index of the imported books after every chunk
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, index=True, progress=None):
+        self.chunk_size = chunk_size
+        self.index = index
+        self.progress = progress
+
+        # normalized name or isbn: pk
+        self.people = {}
+        self.publishers = {}
+        self.books = {}
+        # [(book pk, related isbn numbers)], linked when all the books exist
+        self.related_books = []
+
+        self.stats = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0,
+                      'people': 0, 'publishers': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+        self.errors = []
+        self.start = None
+
+    def run(self, rows):
+        """
+        :param rows: dicts of book values, see read_rows
+        :return: stats
+        """
+        self.start = time.perf_counter()
+        self.load()
+
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+
+            with transaction.atomic():
+                book_ids = self.import_chunk(chunk)
+            if self.index:
+                index_books(Book.objects.filter(pk__in=book_ids))
+
+            self.update_time()
+            if self.progress:
+                self.progress(self.stats)
+
+        with transaction.atomic():
+            self.link_related_books()
+        invalidate_catalog()
+
+        self.update_time()
+        return self.stats
+
+    def update_time(self):
+        self.stats['seconds'] = time.perf_counter() - self.start
+        self.stats['rows_per_second'] = self.stats['rows'] / self.stats['seconds'] if self.stats['seconds'] else 0
+
+    def load(self):
+        for pk, first_name, last_name in Person.objects.order_by('pk').values_list('pk', 'first_name', 'last_name'):
+            self.people.setdefault(normalize_name('%s %s' % (first_name, last_name or '')), pk)
+
+        for pk, name in Publisher.objects.order_by('pk').values_list('pk', 'name'):
+            self.publishers.setdefault(normalize_name(name), pk)
+
+        for pk, isbn in Book.objects.exclude(isbn=None).order_by('pk').values_list('pk', 'isbn'):
+            self.books.setdefault(normalize_isbn(isbn), pk)
+        self.books.pop('', None)
+
+    def import_chunk(self, rows):
+        """
+        :return: pks of the imported books
+        """
+        books = {}
+        for row in rows:
+            self.stats['rows'] += 1
+            isbn = normalize_isbn(row.get('isbn'))
+
+            try:
+                if not isbn:
+                    raise ValueError("no isbn")
+                values = self.get_book_values(row)
+                if isbn not in self.books and isbn not in books and not values.get('title'):
+                    raise ValueError("no title")
+                self.validate_lists(row)
+                self.validate_names(row)
+            except ValidationError as e:
+                self.stats['skipped'] += 1
+                self.errors.append((self.stats['rows'], ' '.join(e.messages)))
+                continue
+            except ValueError as e:
+                self.stats['skipped'] += 1
+                self.errors.append((self.stats['rows'], str(e)))
+                continue
+
+            # the last row of an isbn wins
+            books[isbn] = (row, values)
+
+        self.create_publishers([row.get('publisher') for row, values in books.values() if row.get('publisher')])
+        self.create_people([name for row, values in books.values() for field in PEOPLE_FIELDS
+                            for name in row.get(field, [])])
+
+        for row, values in books.values():
+            if row.get('publisher'):
+                values['publisher_id'] = self.publishers.get(normalize_name(row.get('publisher')))
+
+        book_ids = self.save_books(books)
+        self.link_people(books, book_ids)
+
+        for isbn, (row, values) in books.items():
+            if 'related_books' in row:
+                self.related_books.append((book_ids[isbn], row.get('related_books')))
+
+        return list(book_ids.values())
+
+    @staticmethod
+    def get_book_values(row):
+        """
+        :return: {field: value} converted and validated by the book fields, so they compare to the stored values
+        :raise ValidationError: a value too long, negative or out of range for its column
+        """
+        Book._meta.get_field('isbn').clean(str(row.get('isbn')).strip(), None)
+        return {field: clean_value(Book._meta.get_field(field), row[field]) for field in BOOK_FIELDS if field in row}
+
+    @staticmethod
+    def validate_lists(row):
+        """
+        :raise ValueError: people or related books that are not a list of strings
+        """
+        for field in LIST_FIELDS:
+            if field in row and (not isinstance(row[field], list) or
+                                 not all(isinstance(value, str) for value in row[field])):
+                raise ValueError("%s is not a list of strings" % field)
+
+    @staticmethod
+    def validate_names(row):
+        """
+        :raise ValidationError: a publisher or person name too long for its column
+        """
+        if row.get('publisher'):
+            Publisher._meta.get_field('name').clean(row.get('publisher').strip(), None)
+
+        for field in PEOPLE_FIELDS:
+            names = [name for name in row.get(field, []) if normalize_name(name)]
+            for first_name, last_name in map(split_name, names):
+                Person._meta.get_field('first_name').clean(first_name, None)
+                Person._meta.get_field('last_name').clean(last_name, None)
+
+    def create_publishers(self, names):
+        missing = {normalize_name(name): name.strip() for name in names}
+        missing = {key: name for key, name in missing.items() if key and key not in self.publishers}
+        if not missing:
+            return
+
+        last_pk = get_last_pk(Publisher)
+        Publisher.objects.bulk_create([Publisher(name=name) for name in missing.values()])
+        for pk, name in Publisher.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'name'):
+            self.publishers.setdefault(normalize_name(name), pk)
+        self.stats['publishers'] += len(missing)
+
+    def create_people(self, names):
+        missing = {normalize_name(name): name for name in names}
+        missing = {key: name for key, name in missing.items() if key and key not in self.people}
+        if not missing:
+            return
+
+        last_pk = get_last_pk(Person)
+        Person.objects.bulk_create([Person(first_name=first_name, last_name=last_name)
+                                    for first_name, last_name in map(split_name, missing.values())])
+        for pk, first_name, last_name in Person.objects.filter(pk__gt=last_pk).order_by('pk') \
+                .values_list('pk', 'first_name', 'last_name'):
+            self.people.setdefault(normalize_name('%s %s' % (first_name, last_name or '')), pk)
+        self.stats['people'] += len(missing)
+
+    def save_books(self, books):
+        """
+        update the existing books and create the others
+
+        :param books: {isbn: (row, values)}
+        :return: {isbn: pk}
+        """
+        existing = {isbn: self.books[isbn] for isbn in books if isbn in self.books}
+        instances = Book.objects.in_bulk(existing.values())
+
+        # only the changed books and fields are written, reimporting a file is cheap
+        changed_books, changed_fields = [], set()
+        for isbn, pk in existing.items():
+            book = instances[pk]
+            fields = [field for field, value in books[isbn][1].items() if getattr(book, field) != value]
+            for field in fields:
+                setattr(book, field, books[isbn][1][field])
+            if fields:
+                changed_books.append(book)
+                changed_fields.update(fields)
+        if changed_books:
+            Book.objects.bulk_update(changed_books, changed_fields, batch_size=BULK_UPDATE_SIZE)
+
+        new_books = [Book(isbn=str(row.get('isbn')).strip(), **values)
+                     for isbn, (row, values) in books.items() if isbn not in existing]
+        last_pk = get_last_pk(Book)
+        Book.objects.bulk_create(new_books)
+        for pk, isbn in Book.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'isbn'):
+            self.books.setdefault(normalize_isbn(isbn), pk)
+
+        self.stats['updated'] += len(existing)
+        self.stats['created'] += len(new_books)
+        return {isbn: self.books[isbn] for isbn in books}
+
+    def link_people(self, books, book_ids):
+        """
+        replace the people of the books in one delete and one insert per relation
+        """
+        for field in PEOPLE_FIELDS:
+            through = getattr(Book, field).through
+            people = {book_ids[isbn]: dict.fromkeys(self.people[normalize_name(name)] for name in row.get(field)
+                                                    if normalize_name(name))
+                      for isbn, (row, values) in books.items() if field in row}
+            if not people:
+                continue
+
+            through.objects.filter(book_id__in=people.keys()).delete()
+            through.objects.bulk_create([through(book_id=book_id, person_id=person_id)
+                                         for book_id, person_ids in people.items() for person_id in person_ids])
+
+    def link_related_books(self):
+        through = Book.related_books.through
+        for chunk in iter(lambda: self.related_books[:self.chunk_size], []):
+            del self.related_books[:self.chunk_size]
+
+            related = {book_id: dict.fromkeys(self.books[normalize_isbn(isbn)] for isbn in isbn_numbers
+                                              if normalize_isbn(isbn) in self.books)
+                       for book_id, isbn_numbers in chunk}
+            through.objects.filter(from_book_id__in=related.keys()).delete()
+            through.objects.bulk_create([through(from_book_id=book_id, to_book_id=related_id)
+                                         for book_id, related_ids in related.items() for related_id in related_ids])
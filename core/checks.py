@@ -0,0 +1,30 @@
+"""
+System checks of the settings the processes of a deployment have to share
+
+deployment checks, run by manage.py check --deploy, so migrate and the other commands are not blocked
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# cache backends whose entries are only seen by the process that wrote them
+PROCESS_LOCAL_CACHE_BACKENDS = [
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+]
+
+
+@register(Tags.caches, deploy=True)
+def check_auth_cache(app_configs, **kwargs):
+    """
+    the auth versions invalidate the tokens cached by every process (core.authentication),
+    with a process local cache a deleted or rotated token keeps working in the other workers
+    """
+    backend = settings.CACHES.get(settings.AUTH_CACHE, {}).get('BACKEND')
+    if settings.WORKER_PROCESSES > 1 and backend in PROCESS_LOCAL_CACHE_BACKENDS:
+        return [Error(
+            "AUTH_CACHE '%s' is local to each process but WORKER_PROCESSES is %d" % (
+                settings.AUTH_CACHE, settings.WORKER_PROCESSES),
+            hint="Point AUTH_CACHE to a cache shared by the processes (memcached, redis, database).",
+            id='core.E001',
+        )]
+    return []
@@ -0,0 +1,115 @@
+"""
+Fulfillment export: the payed baskets waiting to be packed, one row per basket
+
+rows are read in a single query through a server side cursor and written as they are read,
+used by the basket admin actions and the export_fulfillment command,
+text cells that would run as spreadsheet formulas are escaped before any format is written
+xlsx needs the optional openpyxl package
+"""
+import csv
+import itertools
+
+from django.utils import timezone
+
+from .models import Basket, Invoice, Item
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+CSV = 'csv'
+XLSX = 'xlsx'
+FORMATS = [CSV, XLSX]
+
+CHUNK_SIZE = 2000
+
+HEADER = ['basket', 'invoice', 'create datetime', 'first name', 'last name', 'phone number',
+          'province', 'city', 'address', 'postal code', 'gift', 'description', 'items', 'count']
+
+# cells starting with these run as formulas in excel
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+ITEM_FIELDS = [
+    'basket_id', 'basket__invoice__internal_id', 'basket__create_datetime',
+    'basket__user_profile__first_name', 'basket__user_profile__last_name', 'basket__user_profile__phone_number',
+    'basket__user_profile__province', 'basket__user_profile__city', 'basket__user_profile__address',
+    'basket__user_profile__postal_code', 'basket__is_gift', 'basket__description',
+    'book__title', 'count',
+]
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_fulfillment_items(baskets=None):
+    """
+    :param baskets: a Basket queryset to export from, defaults to all the baskets
+    :return: values of the items of the payed and pending baskets, ordered by basket
+    """
+    items = Item.objects.filter(basket__invoice__status=Invoice.PAYED, basket__status=Basket.PENDING)
+    if baskets is not None:
+        items = items.filter(basket__in=baskets.order_by().values('pk'))
+    return items.order_by('basket_id', 'pk').values_list(*ITEM_FIELDS)
+
+
+def escape_formula(value):
+    """
+    text cells starting like a formula are prefixed with a quote, so spreadsheets show them as text
+    """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def get_fulfillment_rows(baskets=None, chunk_size=CHUNK_SIZE):
+    """
+    :return: the header and a row per basket, generated while the items are read
+    """
+    yield HEADER
+
+    items = get_fulfillment_items(baskets).iterator(chunk_size=chunk_size)
+    for basket_id, basket_items in itertools.groupby(items, key=lambda item: item[0]):
+        basket_items = list(basket_items)
+        basket = list(basket_items[0][:-2])
+        basket[1] = str(basket[1])
+        basket[2] = timezone.localtime(basket[2]).strftime('%Y-%m-%d %H:%M')
+
+        # names, addresses, descriptions and titles are user input
+        yield [escape_formula(value) for value in basket + [
+            ' | '.join('%s x %d' % (title, count) for *_, title, count in basket_items),
+            sum(count for *_, count in basket_items),
+        ]]
+
+
+class Echo:
+    """
+    file like object returning what is written, csv.writer formats a row at a time with it
+    """
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    # lets excel detect utf-8
+    yield '\ufeff'
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(rows, file):
+    """
+    write the rows to file in openpyxl write only mode, rows are not kept in memory
+    """
+    if openpyxl is None:
+        raise ExportError("xlsx export needs openpyxl, pip install openpyxl")
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('fulfillment')
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
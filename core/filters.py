@@ -0,0 +1,105 @@
+from django.db.models import Count, Q, F, Min, Max
+from django.utils.translation import gettext as _
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+
+class BookFilter(filters.BaseFilterBackend):
+    """
+    Book catalog filters, all evaluated by the database
+
+    publisher, author, editor, translator: comma separated ids
+    min_price, max_price, min_final_price, max_final_price: integers
+    cover_type: exact cover type
+    in_stock: true to list only the books with remaining items
+    """
+
+    id_filters = {
+        'publisher': 'publisher__in',
+        'author': 'authors__in',
+        'editor': 'editors__in',
+        'translator': 'translators__in',
+    }
+
+    range_filters = {
+        'min_price': 'price__gte',
+        'max_price': 'price__lte',
+        'min_final_price': 'final_price_amount__gte',
+        'max_final_price': 'final_price_amount__lte',
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        for param, lookup in self.id_filters.items():
+            if params.get(param):
+                queryset = queryset.filter(**{lookup: self.get_integers(params, param)}).distinct()
+
+        if params.get('min_final_price') or params.get('max_final_price'):
+            queryset = queryset.with_final_price()
+
+        for param, lookup in self.range_filters.items():
+            if params.get(param):
+                queryset = queryset.filter(**{lookup: self.get_integers(params, param)[0]})
+
+        if params.get('cover_type'):
+            queryset = queryset.filter(cover_type=params.get('cover_type'))
+
+        if params.get('in_stock') in ['1', 'true']:
+            queryset = queryset.in_stock()
+
+        return queryset
+
+    @staticmethod
+    def get_integers(params, param):
+        try:
+            return [int(value) for value in params.get(param).split(',')]
+        except ValueError:
+            raise ValidationError({param: _("Enter comma separated integers")})
+
+
+def get_book_facets(queryset):
+    """
+    Facet counts of the given book queryset, one grouped query per facet
+    """
+    queryset = queryset.prefetch_related(None).order_by()
+
+    def people_facet(relation):
+        people = queryset.filter(**{'%s__isnull' % relation: False}) \
+            .values(relation, '%s__first_name' % relation, '%s__last_name' % relation) \
+            .annotate(count=Count('pk', distinct=True)).order_by('-count', relation)
+        return [{
+            'pk': person.get(relation),
+            'first_name': person.get('%s__first_name' % relation),
+            'last_name': person.get('%s__last_name' % relation),
+            'count': person.get('count'),
+        } for person in people]
+
+    publishers = queryset.filter(publisher__isnull=False) \
+        .values('publisher', 'publisher__name') \
+        .annotate(count=Count('pk', distinct=True)).order_by('-count', 'publisher')
+
+    cover_types = queryset.filter(cover_type__isnull=False) \
+        .values('cover_type') \
+        .annotate(count=Count('pk', distinct=True)).order_by('-count', 'cover_type')
+
+    summary = queryset.aggregate(
+        total=Count('pk', distinct=True),
+        in_stock=Count('pk', distinct=True, filter=Q(count__gt=F('sold_count') + F('reserved_count'))),
+        min_price=Min('price'),
+        max_price=Max('price'),
+    )
+
+    return {
+        'publishers': [{
+            'pk': publisher.get('publisher'),
+            'name': publisher.get('publisher__name'),
+            'count': publisher.get('count'),
+        } for publisher in publishers],
+        'authors': people_facet('authors'),
+        'translators': people_facet('translators'),
+        'cover_types': list(cover_types),
+        'in_stock': summary.get('in_stock'),
+        'total': summary.get('total'),
+        'price': {'min': summary.get('min_price'), 'max': summary.get('max_price')},
+    }
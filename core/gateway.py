@@ -0,0 +1,329 @@
+"""
+HTTP client of the payment and sms gateways
+
+one pooled keep-alive session per gateway, connect/read timeouts per endpoint,
+a circuit breaker failing fast while a gateway is down and per endpoint metrics,
+gateways are configured by settings.GATEWAYS
+
+get_client is used by the sync code, get_async_client by the async views
+"""
+import asyncio
+import json
+import re
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+DEFAULT_ASYNC_POOL_SIZE = 100
+
+
+class GatewayError(Exception):
+    pass
+
+
+class CircuitOpenError(GatewayError):
+    pass
+
+
+# url paths in exception messages, they may contain api keys (kavenegar) and query params
+URL_PATHS = re.compile(r'(https?://[^/\s\'"]+)?/[^\s\'"()]*')
+
+
+def redact_urls(text):
+    return URL_PATHS.sub(lambda match: (match.group(1) or '') + '/...', text)
+
+
+class CircuitBreaker:
+    """
+    opens after failure_threshold consecutive failures, after reset_timeout seconds
+    a single trial request is let through, it closes the circuit on success
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half open'
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+
+            # open, or half open with its trial request in flight
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """
+    at most rate calls of wait() per second, shared by threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class GatewayClient:
+    """
+    :param timeouts: {endpoint: (connect timeout, read timeout)}
+    :param pool_size: kept alive connections of the sync session, one per worker thread is enough
+    :param async_pool_size: connections of every async client, bounds the in flight async requests
+    """
+
+    def __init__(self, name, base_url, timeouts=None, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, pool_size=DEFAULT_POOL_SIZE,
+                 async_pool_size=DEFAULT_ASYNC_POOL_SIZE):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = timeouts or {}
+        self.async_pool_size = async_pool_size
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        # retries are left to the callers, a payment request must not be sent twice
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
+
+    def url(self, path):
+        return self.base_url + path
+
+    def get_timeout(self, endpoint):
+        """
+        :return: (connect timeout, read timeout)
+        """
+        timeout = self.timeouts.get(endpoint, DEFAULT_TIMEOUT)
+        if isinstance(timeout, (int, float)):
+            return timeout, timeout
+        return tuple(timeout)
+
+    def request(self, method, endpoint, path, **kwargs):
+        """
+        :param endpoint: name of the endpoint, selects the timeout and the metrics
+        :raise GatewayError: on connection errors, timeouts and server errors
+        """
+        self.check_circuit(endpoint)
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url(path), timeout=self.get_timeout(endpoint), **kwargs)
+        except requests.RequestException as e:
+            raise self.failed(endpoint, start, e)
+        except BaseException as e:
+            # any other error resolves a half open trial too, or the circuit would stay half open
+            self.failed(endpoint, start, e)
+            raise
+
+        return self.checked(endpoint, start, response)
+
+    def check_circuit(self, endpoint):
+        if not self.circuit_breaker.allow_request():
+            self.record(endpoint, rejected=True)
+            raise CircuitOpenError("%s is not available" % self.name)
+
+    def failed(self, endpoint, start, error):
+        """
+        :return: the GatewayError of a request that got no response
+        """
+        self.circuit_breaker.record_failure()
+        self.record(endpoint, latency=time.perf_counter() - start, failed=True)
+        return GatewayError("%s %s failed: %s" % (self.name, endpoint, redact_urls(str(error))))
+
+    def checked(self, endpoint, start, response):
+        latency = time.perf_counter() - start
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+            self.record(endpoint, latency=latency, failed=True)
+            raise GatewayError("%s %s failed with status %d" % (self.name, endpoint, response.status_code))
+
+        self.circuit_breaker.record_success()
+        self.record(endpoint, latency=latency)
+        return response
+
+    def decode(self, endpoint, response):
+        try:
+            return json.loads(response.text)
+        except ValueError:
+            raise GatewayError("%s %s returned an invalid response" % (self.name, endpoint))
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request('GET', endpoint, path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request('POST', endpoint, path, **kwargs)
+
+    def post_json(self, endpoint, path, **kwargs):
+        """
+        :return: the decoded json response
+        """
+        return self.decode(endpoint, self.post(endpoint, path, **kwargs))
+
+    def record(self, endpoint, latency=0.0, failed=False, rejected=False):
+        with self.metrics_lock:
+            metrics = self.metrics.setdefault(endpoint, {
+                'requests': 0, 'failures': 0, 'rejected': 0, 'total_time': 0.0, 'max_time': 0.0
+            })
+            if rejected:
+                metrics['rejected'] += 1
+                return
+
+            metrics['requests'] += 1
+            metrics['failures'] += int(failed)
+            metrics['total_time'] += latency
+            metrics['max_time'] = max(metrics['max_time'], latency)
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            return {
+                'circuit': self.circuit_breaker.state,
+                'endpoints': {endpoint: dict(metrics) for endpoint, metrics in self.metrics.items()},
+            }
+
+
+class AsyncGatewayClient:
+    """
+    the same gateway for the async views, requests are sent by an httpx.AsyncClient,
+    the circuit breaker, the timeouts and the metrics are shared with the sync client
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.session = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=client.async_pool_size, max_keepalive_connections=client.async_pool_size))
+
+    async def request(self, method, endpoint, path, **kwargs):
+        self.client.check_circuit(endpoint)
+
+        connect_timeout, read_timeout = self.client.get_timeout(endpoint)
+        start = time.perf_counter()
+        try:
+            response = await self.session.request(method, self.client.url(path),
+                                                  timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                                  **kwargs)
+        except httpx.HTTPError as e:
+            raise self.client.failed(endpoint, start, e)
+        except BaseException as e:
+            # cancelled requests included
+            self.client.failed(endpoint, start, e)
+            raise
+
+        return self.client.checked(endpoint, start, response)
+
+    async def get(self, endpoint, path, **kwargs):
+        return await self.request('GET', endpoint, path, **kwargs)
+
+    async def post(self, endpoint, path, **kwargs):
+        return await self.request('POST', endpoint, path, **kwargs)
+
+    async def post_json(self, endpoint, path, **kwargs):
+        return self.client.decode(endpoint, await self.post(endpoint, path, **kwargs))
+
+
+_clients = {}
+# {event loop: {name: AsyncGatewayClient}}, httpx connections belong to the loop they were opened in
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    with _clients_lock:
+        if name not in _clients:
+            config = settings.GATEWAYS.get(name)
+            _clients[name] = GatewayClient(
+                name,
+                config.get('BASE_URL'),
+                timeouts=config.get('TIMEOUTS'),
+                failure_threshold=config.get('FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD),
+                reset_timeout=config.get('RESET_TIMEOUT', DEFAULT_RESET_TIMEOUT),
+                pool_size=config.get('POOL_SIZE', DEFAULT_POOL_SIZE),
+                async_pool_size=config.get('ASYNC_POOL_SIZE', DEFAULT_ASYNC_POOL_SIZE),
+            )
+        return _clients[name]
+
+
+def get_async_client(name):
+    client = get_client(name)
+    loop = asyncio.get_event_loop()
+
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if name not in clients:
+            clients[name] = AsyncGatewayClient(client)
+        return clients[name]
+
+
+async def close_async_clients():
+    """
+    close the async clients of the running event loop, before the loop is closed
+    """
+    with _clients_lock:
+        clients = _async_clients.pop(asyncio.get_event_loop(), {})
+
+    for client in clients.values():
+        await client.session.aclose()
+
+
+def get_metrics():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: client.get_metrics() for client in clients}
+
+
+def reset_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.session.close()
+        _clients.clear()
+        _async_clients.clear()
+
+
+@receiver(setting_changed)
+def reset_clients_on_settings_change(setting, **kwargs):
+    if setting == 'GATEWAYS':
+        reset_clients()
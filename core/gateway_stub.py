@@ -0,0 +1,101 @@
+"""
+Local vandar and kavenegar stub server, used by the tests and the benchmark
+"""
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+
+class GatewayStub:
+    """
+    answers the gateway endpoints with successful responses by default
+
+    :param responses: {path prefix: (status code, json data)} overriding the default responses
+    :param delay: seconds to wait before every response
+    """
+    default_responses = {
+        '/api/v3/send': (200, {'status': 1, 'token': 'stub-token'}),
+        '/api/v3/verify': (200, {'status': 1, 'transId': 1, 'cardNumber': '603799******7999'}),
+        '/v1/': (200, {'return': {'status': 200, 'message': 'ok'}}),
+    }
+
+    def __init__(self, responses=None, delay=0):
+        self.responses = dict(self.default_responses, **(responses or {}))
+        self.delay = delay
+        # (method, path, client port)
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.get_handler_class())
+        self.server.daemon_threads = True
+        # delayed responses may be written after the client timed out
+        self.server.handle_error = lambda request, client_address: None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def get_gateways(self, **options):
+        """
+        :return: settings.GATEWAYS pointing to the stub
+        """
+        return {
+            'vandar': dict(options, BASE_URL=self.base_url),
+            'kavenegar': dict(options, BASE_URL=self.base_url),
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_response(self, path):
+        for prefix, response in self.responses.items():
+            if path.startswith(prefix):
+                return response
+        return 404, {'status': 0, 'errors': ["not found"]}
+
+    def get_handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self.respond()
+
+            def respond(self):
+                path = urlparse(self.path).path
+                stub.requests.append((self.command, path, self.client_address[1]))
+
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                status, data = stub.get_response(path)
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,7 +1,14 @@
+import asyncio
+import contextlib
 import random
-from furl import furl
+import time
+import uuid
 
-from BookStore import settings
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .gateway import get_client
 
 
 def generate_code():
@@ -9,21 +16,74 @@ def generate_code():
 
 
 def kavenegar_send_sms(template, tokens, to):
-    import requests
+    params = {'receptor': to, 'template': template}
+    params.update(tokens)
+
+    response = get_client('kavenegar').get('lookup', '/v1/%s/verify/lookup.json' % settings.KAVENEGAR_API_KEY,
+                                           params=params)
+    response.raise_for_status()
+    return response
+
+
+class SharedKeyLock:
+    """
+    one lock per key shared by the processes through settings.LOCK_CACHE, with key_lock(key, timeout) as acquired: ...
+    acquired is False while another request holds the key, the key is not waited for,
+    a key expires after timeout seconds, so it is not held forever by a process that died
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    @staticmethod
+    def get_cache():
+        return caches[settings.LOCK_CACHE]
+
+    def get_key(self, key):
+        return 'lock:%s:%s' % (self.prefix, key)
+
+    def acquire(self, key, timeout):
+        """
+        :return: the token releasing the key, None if the key is held
+        """
+        token = uuid.uuid4().hex
+        if self.get_cache().add(self.get_key(key), token, timeout=timeout):
+            return token
+        return None
 
-    api_endpoint = "https://api.kavenegar.com/v1/{API-KEY}/verify/lookup.json"
-    api = furl(api_endpoint.replace('{API-KEY}', settings.KAVENEGAR_API_KEY))
-    api.args['receptor'] = to
-    api.args['template'] = template
+    def release(self, key, token):
+        cache = self.get_cache()
+        # not if the key expired and was acquired again meanwhile
+        if cache.get(self.get_key(key)) == token:
+            cache.delete(self.get_key(key))
 
-    for key in tokens.keys():
-        api.args[key] = tokens.get(key)
+    def is_held(self, key):
+        return self.get_cache().get(self.get_key(key)) is not None
 
-    requests.get(api.url)
+    def wait(self, key, timeout, interval=0.1):
+        """
+        :return: whether the key was released within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.is_held(key):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
 
+    async def wait_async(self, key, timeout, interval=0.1):
+        deadline = time.monotonic() + timeout
+        while await sync_to_async(self.is_held)(key):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+        return True
 
-def send_verification_code(phone_number, code):
-    if settings.DEBUG:
-        print("Sending: %s to %s" % (code, phone_number))
-    else:
-        kavenegar_send_sms('verify-abee', {'token': str(code)}, phone_number)
+    @contextlib.contextmanager
+    def __call__(self, key, timeout):
+        token = self.acquire(key, timeout)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self.release(key, token)
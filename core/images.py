@@ -0,0 +1,168 @@
+"""
+Renditions of the book covers: resized webp copies for the storefront, settings.IMAGE_RENDITIONS
+
+created when a cover is uploaded (core.signals) or by the create_image_renditions command,
+their storage names are kept in Book.image_renditions with the name of the cover they came from,
+books without renditions are served the original cover
+
+renditions are stored under a directory per book and never overwritten, the storage picks a free name,
+the previous renditions of a book are deleted once the new ones are saved
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .cache import invalidate_catalog
+from .models import Book, invalidate_book_responses
+
+SOURCE = 'source'
+RENDITIONS_DIRECTORY = 'renditions'
+
+
+def get_rendition_directory(book_id):
+    return '%s/%d/' % (RENDITIONS_DIRECTORY, book_id)
+
+
+def get_rendition_name(book_id, image_name, rendition):
+    return '%s%s-%s.webp' % (get_rendition_directory(book_id), os.path.basename(image_name).replace('.', '-'),
+                             rendition)
+
+
+def render(image, size):
+    """
+    :param image: a PIL image
+    :param size: (max width, max height), the aspect ratio is kept and small images are not enlarged
+    :return: webp bytes
+    """
+    image = image.copy()
+    image.thumbnail(size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, 'WEBP', quality=settings.IMAGE_RENDITION_QUALITY, method=4)
+    return output.getvalue()
+
+
+def create_renditions(image_name, book_id):
+    """
+    render and store the renditions of a stored image, runs in the backfill worker processes
+
+    :return: {rendition: storage name, SOURCE: image_name}
+    """
+    with default_storage.open(image_name) as file:
+        image = Image.open(file)
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    renditions = {SOURCE: image_name}
+    for rendition, size in settings.IMAGE_RENDITIONS.items():
+        name = get_rendition_name(book_id, image_name, rendition)
+        renditions[rendition] = default_storage.save(name, ContentFile(render(image, size)))
+
+    return renditions
+
+
+def is_stale(image_name, renditions):
+    """
+    :return: whether the renditions do not belong to the image or some of them are missing
+    """
+    renditions = renditions or {}
+    return renditions.get(SOURCE) != (image_name or None) or \
+        any(rendition not in renditions for rendition in settings.IMAGE_RENDITIONS)
+
+
+def delete_renditions(book_id, renditions, keep=None):
+    """
+    delete the stored renditions of a book, except the ones in keep
+    only names in the directory of the book are deleted, other books can not reference them
+    """
+    keep = set((keep or {}).values())
+    for rendition, name in (renditions or {}).items():
+        if rendition != SOURCE and name not in keep and name.startswith(get_rendition_directory(book_id)):
+            default_storage.delete(name)
+
+
+def update_book_renditions(book):
+    """
+    :return: whether the renditions were updated, False if the cover is missing or can not be read
+    """
+    renditions = try_create_renditions(book.image.name, book.pk) if book.image else {}
+    if renditions is None:
+        # served the original cover, the create_image_renditions command reports it
+        return False
+
+    # update, so the book signals are not sent again
+    Book.objects.filter(pk=book.pk).update(image_renditions=renditions)
+    delete_renditions(book.pk, book.image_renditions, keep=renditions)
+    book.image_renditions = renditions
+    invalidate_book_responses([book.pk])
+    return True
+
+
+def backfill_renditions(books, workers=None, progress=None):
+    """
+    create the missing or stale renditions of the given books, images are rendered by a process pool
+
+    :param workers: number of processes, 0 renders in this process
+    :param progress: called with the number of processed books
+    :return: (number of books with new renditions, number of books with unreadable covers)
+    """
+    books = books.exclude(image='').exclude(image=None).order_by('pk')
+    stale = [(pk, image, renditions) for pk, image, renditions
+             in books.values_list('pk', 'image', 'image_renditions') if is_stale(image, renditions)]
+    image_names = [image for pk, image, renditions in stale]
+    book_ids = [pk for pk, image, renditions in stale]
+
+    if workers == 0:
+        return save_results(stale, map(try_create_renditions, image_names, book_ids), progress)
+
+    # the workers only touch the storage, the database is updated by this process
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return save_results(stale, executor.map(try_create_renditions, image_names, book_ids, chunksize=8),
+                            progress)
+
+
+def try_create_renditions(image_name, book_id):
+    """
+    :return: create_renditions, None if the image is missing or can not be read
+    """
+    try:
+        return create_renditions(image_name, book_id)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def save_results(stale, results, progress):
+    created = failed = 0
+    for (pk, image, old_renditions), renditions in zip(stale, results):
+        if renditions is None:
+            failed += 1
+        else:
+            Book.objects.filter(pk=pk).update(image_renditions=renditions)
+            delete_renditions(pk, old_renditions, keep=renditions)
+            created += 1
+
+        if progress:
+            progress(created + failed)
+
+    invalidate_catalog()
+    return created, failed
+
+
+def get_rendition_urls(book):
+    """
+    :return: {rendition: url}, the original cover url while the renditions are missing
+    """
+    if not book.image:
+        return None
+
+    renditions = book.image_renditions or {}
+    if renditions.get(SOURCE) != book.image.name:
+        renditions = {}
+
+    return {rendition: default_storage.url(renditions[rendition]) if rendition in renditions else book.image.url
+            for rendition in settings.IMAGE_RENDITIONS}
@@ -0,0 +1,63 @@
+import json
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.benchmark import seed_catalog, Benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmark the API endpoints on seeded throwaway test databases and write a JSON report"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', default='1000',
+                            help="comma separated catalog sizes, e.g. 1000,10000,100000")
+        parser.add_argument('--baskets', type=int, default=None,
+                            help="number of seeded baskets, defaults to half the number of books")
+        parser.add_argument('--repeats', type=int, default=20, help="measured requests per endpoint")
+        parser.add_argument('--warm-cache', action='store_true',
+                            help="keep the catalog cache between requests")
+        parser.add_argument('--output', help="report file, printed when not given")
+
+    def handle(self, *args, **options):
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'repeats': options.get('repeats'),
+            'warm_cache': options.get('warm_cache'),
+            'sizes': {},
+        }
+
+        setup_test_environment()
+        try:
+            for n_books in [int(size) for size in options.get('books').split(',')]:
+                n_baskets = options.get('baskets')
+                if n_baskets is None:
+                    n_baskets = n_books // 2
+
+                self.stderr.write("benchmarking %d books and %d baskets" % (n_books, n_baskets))
+                report['sizes'][str(n_books)] = self.benchmark(n_books, n_baskets, options)
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options.get('output'):
+            with open(options.get('output'), 'w') as report_file:
+                report_file.write(output)
+            self.stderr.write(self.style.SUCCESS("report written to %s" % options.get('output')))
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def benchmark(n_books, n_baskets, options):
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            seed_catalog(n_books, n_baskets)
+            return Benchmark(repeats=options.get('repeats'), warm_cache=options.get('warm_cache')).run()
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from core.images import backfill_renditions
+from core.models import Book
+
+
+class Command(BaseCommand):
+    help = "Create the missing or stale webp renditions of the book covers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="rendering processes, defaults to the number of cpus, 0 renders in this process")
+
+    def handle(self, *args, **options):
+        created, failed = backfill_renditions(Book.objects.all(), workers=options.get('workers'),
+                                              progress=self.report)
+
+        if failed:
+            self.stderr.write("%d covers could not be read" % failed)
+        self.stdout.write(self.style.SUCCESS("renditions of %d books created" % created))
+
+    def report(self, count):
+        if count % 100 == 0:
+            self.stdout.write("%d books processed" % count)
@@ -0,0 +1,91 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from core.models import Book, BookSearchTerm, Invoice, Item, UserProfilePhoneVerification, PAYMENT_BUFFER_TIME
+from core.search import search_books
+
+
+def get_hot_queries():
+    """
+    :return: [(name, queryset, table that must not be fully scanned)]
+    """
+    _n_min_ago = timezone.now() - timezone.timedelta(minutes=PAYMENT_BUFFER_TIME)
+
+    return [
+        ("expired open invoices",
+         Invoice.objects.filter(Invoice.expired_q()).order_by('pk'),
+         Invoice._meta.db_table),
+        ("expired reservations",
+         Invoice.objects.filter(stock_status=Invoice.STOCK_RESERVED, last_try_datetime__lt=_n_min_ago),
+         Invoice._meta.db_table),
+        ("invoices by status",
+         Invoice.objects.filter(status=Invoice.PAYED).order_by('last_try_datetime'),
+         Invoice._meta.db_table),
+        ("last verification object",
+         UserProfilePhoneVerification.objects.filter(user_profile_id=1, create_date__gte=_n_min_ago)
+         .order_by('create_date'),
+         UserProfilePhoneVerification._meta.db_table),
+        ("sms queue",
+         UserProfilePhoneVerification.objects.filter(sms_status=UserProfilePhoneVerification.SMS_QUEUED,
+                                                     sms_next_try_datetime__lte=timezone.now())
+         .order_by('sms_next_try_datetime'),
+         UserProfilePhoneVerification._meta.db_table),
+        ("book items",
+         Item.objects.filter(book_id=1),
+         Item._meta.db_table),
+        ("invoice book counts",
+         Item.objects.filter(basket__invoice_id=1).values('book').annotate(total=Sum('count')),
+         Item._meta.db_table),
+        ("catalog",
+         Book.objects.catalog(relations=[]),
+         Book._meta.db_table),
+        ("in stock catalog",
+         Book.objects.catalog(relations=[]).in_stock(),
+         Book._meta.db_table),
+        ("book search",
+         search_books(Book.objects.catalog(relations=[]), "book search"),
+         BookSearchTerm._meta.db_table),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Print the EXPLAIN plans of the hot ORM queries, --check fails on full table scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="fail if a hot query scans its whole table instead of using an index")
+
+    def handle(self, *args, **options):
+        full_scans = []
+
+        with transaction.atomic():
+            if options.get('check') and connection.vendor == 'postgresql':
+                # small tables are scanned sequentially anyway, ask the planner to prefer the indexes
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for name, queryset, table in get_hot_queries():
+                plan = queryset.explain()
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write(plan + "\n")
+
+                if self.is_full_scan(plan, table):
+                    full_scans.append(name)
+
+        if options.get('check') and full_scans:
+            raise CommandError("Full table scans in: %s" % ", ".join(full_scans))
+
+    @staticmethod
+    def is_full_scan(plan, table):
+        table = re.escape(table)
+        patterns = [
+            # postgresql
+            r'Seq Scan on "?%s"?\b' % table,
+            # sqlite, a scan through an index is fine
+            r'\bSCAN( TABLE)? %s\b(?!.*USING)' % table,
+        ]
+        return any(re.search(pattern, plan) for pattern in patterns)
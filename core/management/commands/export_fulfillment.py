@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.export import get_fulfillment_rows, stream_csv, write_xlsx, ExportError, FORMATS, CSV, CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Export the payed and pending baskets with their addresses and items for packing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default=CSV)
+        parser.add_argument('--output', help="output file, csv is written to stdout by default")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help="rows fetched from the database cursor at a time")
+
+    def handle(self, *args, **options):
+        rows = get_fulfillment_rows(chunk_size=options.get('chunk_size'))
+        output = options.get('output')
+
+        if options.get('format') == CSV:
+            if output:
+                with open(output, 'w', encoding='utf-8', newline='') as file:
+                    file.writelines(stream_csv(rows))
+            else:
+                for line in stream_csv(rows):
+                    self.stdout.write(line, ending='')
+            return
+
+        if not output:
+            raise CommandError("--output is required for xlsx")
+
+        try:
+            write_xlsx(rows, output)
+        except ExportError as e:
+            raise CommandError(str(e))
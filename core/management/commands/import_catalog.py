@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.catalog_import import CatalogImporter, read_rows, FORMATS, CHUNK_SIZE
+
+MAX_REPORTED_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = "Import books, people and publishers from a csv or jsonl file, books are matched by isbn"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help="defaults to the file extension")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help="rows written in a transaction")
+        parser.add_argument('--no-index', action='store_true',
+                            help="leave the search index to the rebuild_search_index command")
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        file_format = options.get('format') or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in FORMATS:
+            raise CommandError("unknown format %s, use --format" % file_format)
+
+        importer = CatalogImporter(chunk_size=options.get('chunk_size'), index=not options.get('no_index'),
+                                   progress=self.report)
+        with open(path, encoding='utf-8-sig', newline='') as file:
+            stats = importer.run(read_rows(file, file_format))
+
+        for line, error in importer.errors[:MAX_REPORTED_ERRORS]:
+            self.stderr.write("row %d skipped: %s" % (line, error))
+
+        self.stdout.write(self.style.SUCCESS(
+            "%(rows)d rows in %(seconds).1fs (%(rows_per_second).0f rows/s): %(created)d books created, "
+            "%(updated)d updated, %(skipped)d skipped, %(people)d people and %(publishers)d publishers created"
+            % stats))
+
+    def report(self, stats):
+        self.stdout.write("%(rows)d rows, %(created)d created, %(updated)d updated, %(skipped)d skipped, "
+                          "%(rows_per_second).0f rows/s" % stats)
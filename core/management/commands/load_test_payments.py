@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.benchmark import seed_catalog, PaymentLoadTest
+
+
+class Command(BaseCommand):
+    help = "Compare the sync and async payment views throughput against a slow local gateway " \
+           "on a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100, help="payments per path")
+        parser.add_argument('--concurrency', type=int, default=50, help="in flight async requests")
+        parser.add_argument('--workers', type=int, default=4, help="concurrent sync workers (threads)")
+        parser.add_argument('--gateway-delay', type=float, default=0.1, help="gateway response time in seconds")
+        parser.add_argument('--books', type=int, default=100)
+        parser.add_argument('--output', help="report file, printed when not given")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # every payment needs its own basket
+            seed_catalog(options.get('books'), 2 * options.get('requests'))
+            report = PaymentLoadTest(
+                requests=options.get('requests'),
+                concurrency=options.get('concurrency'),
+                workers=options.get('workers'),
+                gateway_delay=options.get('gateway_delay'),
+            ).run()
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options.get('output'):
+            with open(options.get('output'), 'w') as report_file:
+                report_file.write(output)
+            self.stderr.write(self.style.SUCCESS("report written to %s" % options.get('output')))
+        else:
+            self.stdout.write(output)
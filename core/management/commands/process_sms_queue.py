@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import UserProfilePhoneVerification
+from core.sms import process_sms_queue
+
+
+class Command(BaseCommand):
+    help = "Send the queued verification sms messages and retry the failed ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help="keep processing the queue")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="seconds to sleep between the batches when looping")
+
+    def handle(self, *args, **options):
+        while True:
+            results = process_sms_queue(batch_size=options.get('batch_size'))
+            if results or not options.get('loop'):
+                self.stdout.write("%d sent, %d failed, %d retrying" % (
+                    results.get(UserProfilePhoneVerification.SMS_SENT, 0),
+                    results.get(UserProfilePhoneVerification.SMS_FAILED, 0),
+                    results.get(UserProfilePhoneVerification.SMS_QUEUED, 0),
+                ))
+
+            if not options.get('loop'):
+                return
+            time.sleep(options.get('interval'))
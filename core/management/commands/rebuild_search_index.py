@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Book
+from core.search import index_books
+
+
+class Command(BaseCommand):
+    help = "Rebuild the book search index"
+
+    def handle(self, *args, **options):
+        books = Book.objects.all()
+        index_books(books)
+        self.stdout.write(self.style.SUCCESS("%d books indexed" % books.count()))
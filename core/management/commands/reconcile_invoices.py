@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.gateway import get_client, GatewayError, RateLimiter
+from core.models import Invoice
+from core.vandar import get_verification_data, handle_verification_result
+
+
+class Command(BaseCommand):
+    help = "Resolve the expired created and in payment invoices, in payment invoices are verified with vandar " \
+           "and become payed or rejected, created invoices are rejected"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4, help="concurrent vandar verifications")
+        parser.add_argument('--rate', type=float, default=10, help="max vandar verifications per second")
+        parser.add_argument('--loop', action='store_true', help="keep reconciling")
+        parser.add_argument('--interval', type=float, default=60,
+                            help="seconds to sleep between the runs when looping")
+
+    def handle(self, *args, **options):
+        while True:
+            results = self.reconcile(options.get('batch_size'), options.get('workers'), options.get('rate'))
+            self.stdout.write("%d payed, %d rejected, %d left for the next run" % (
+                results.get(Invoice.PAYED), results.get(Invoice.REJECTED), results.get('failed')))
+
+            if not options.get('loop'):
+                return
+            time.sleep(options.get('interval'))
+
+    def reconcile(self, batch_size, workers, rate):
+        results = {Invoice.PAYED: 0, Invoice.REJECTED: 0, 'failed': 0}
+        rate_limiter = RateLimiter(rate)
+        expired = Invoice.objects.filter(Invoice.expired_q()).order_by('pk')
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            last_pk = 0
+            while True:
+                batch = list(expired.filter(pk__gt=last_pk)[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+
+                # only the vandar requests run in the worker threads, the invoices are saved here
+                in_payment = [invoice for invoice in batch
+                              if invoice.status == Invoice.IN_PAYMENT and invoice.payment_token]
+                verifications = executor.map(lambda invoice: self.fetch_verification(invoice, rate_limiter),
+                                             in_payment)
+
+                for invoice, result in verifications:
+                    if isinstance(result, GatewayError):
+                        results['failed'] += 1
+                        continue
+                    self.count(results, self.resolve(invoice, result))
+
+                for invoice in batch:
+                    if invoice not in in_payment:
+                        self.count(results, self.resolve(invoice, None))
+
+        return results
+
+    @staticmethod
+    def fetch_verification(invoice, rate_limiter):
+        """
+        :return: (invoice, vandar result or the GatewayError)
+        """
+        rate_limiter.wait()
+        try:
+            return invoice, get_client('vandar').post_json('verify', '/api/v3/verify',
+                                                           data=get_verification_data(invoice))
+        except GatewayError as e:
+            return invoice, e
+
+    @staticmethod
+    def resolve(invoice, result):
+        """
+        :param result: vandar verification result, None rejects the invoice
+        :return: the new status, None if the invoice was resolved meanwhile
+        """
+        with transaction.atomic():
+            invoice = Invoice.objects.select_for_update().filter(Invoice.expired_q(), pk=invoice.pk).first()
+            if not invoice:
+                return None
+
+            # saving moves the invoice items out of the reserved counter
+            if result is None:
+                invoice.status = Invoice.REJECTED
+                invoice.save()
+            else:
+                handle_verification_result(invoice, result)
+
+        return invoice.status
+
+    @staticmethod
+    def count(results, status):
+        if status is not None:
+            results[status] += 1
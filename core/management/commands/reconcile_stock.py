@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Q
+from django.utils import timezone
+
+from core.cache import invalidate_catalog
+from core.models import Book, Invoice, Item, release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Release expired reservations and recompute the books stock ledger from basket items"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expired-only', action='store_true',
+                            help="only release the reservations of expired invoices")
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations()
+        self.stdout.write("%d expired reservations released" % released)
+
+        if options.get('expired_only'):
+            return
+
+        invoices, books = self.reconcile()
+        self.stdout.write(self.style.SUCCESS("%d invoices and %d books reconciled" % (invoices, books)))
+
+    def reconcile(self):
+        with transaction.atomic():
+            # lock all the books to block basket creation while recomputing
+            list(Book.objects.select_for_update().order_by('pk').values_list('pk', flat=True))
+
+            invoices = self.reconcile_invoices()
+            books = self.reconcile_books()
+
+        return invoices, books
+
+    @staticmethod
+    def reconcile_invoices():
+        now = timezone.now()
+        sold_q = Q(status=Invoice.PAYED)
+        reserved_q = Invoice.reserved_q(now)
+
+        expected_stock_status = [
+            (Invoice.STOCK_SOLD, sold_q),
+            (Invoice.STOCK_RESERVED, reserved_q),
+            (Invoice.STOCK_NONE, ~(sold_q | reserved_q)),
+        ]
+
+        updated = 0
+        for stock_status, q in expected_stock_status:
+            updated += Invoice.objects.filter(q).exclude(stock_status=stock_status).update(stock_status=stock_status)
+
+        return updated
+
+    @staticmethod
+    def reconcile_books():
+        totals = Item.objects.values('book').annotate(
+            sold=Sum('count', filter=Q(basket__invoice__stock_status=Invoice.STOCK_SOLD)),
+            reserved=Sum('count', filter=Q(basket__invoice__stock_status=Invoice.STOCK_RESERVED)),
+        )
+        totals = {total.get('book'): total for total in totals}
+
+        changed_books = []
+        for book in Book.objects.only('pk', 'sold_count', 'reserved_count').iterator():
+            total = totals.get(book.pk, {})
+            sold_count = total.get('sold') or 0
+            reserved_count = total.get('reserved') or 0
+
+            if book.sold_count != sold_count or book.reserved_count != reserved_count:
+                book.sold_count = sold_count
+                book.reserved_count = reserved_count
+                changed_books.append(book)
+
+        Book.objects.bulk_update(changed_books, ['sold_count', 'reserved_count'], batch_size=500)
+        if changed_books:
+            invalidate_catalog()
+
+        return len(changed_books)
@@ -0,0 +1,56 @@
+# Generated by Django 3.1.7 on 2026-10-18 06:15
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Sum, Q
+from django.utils import timezone
+
+
+def fill_stock_ledger(apps, schema_editor):
+    Book = apps.get_model('core', 'Book')
+    Invoice = apps.get_model('core', 'Invoice')
+    Item = apps.get_model('core', 'Item')
+
+    # Invoice.PAYED, Invoice.CREATED, Invoice.IN_PAYMENT
+    sold_q = Q(status='2')
+    _15_min_ago = timezone.now() - datetime.timedelta(minutes=15)
+    reserved_q = Q(status__in=['0', '1'], last_try_datetime__gte=_15_min_ago)
+
+    # Invoice.STOCK_SOLD, Invoice.STOCK_RESERVED
+    Invoice.objects.filter(sold_q).update(stock_status='2')
+    Invoice.objects.filter(reserved_q).update(stock_status='1')
+
+    totals = Item.objects.values('book').annotate(
+        sold=Sum('count', filter=Q(basket__invoice__stock_status='2')),
+        reserved=Sum('count', filter=Q(basket__invoice__stock_status='1')),
+    )
+    for total in totals:
+        Book.objects.filter(pk=total.get('book')).update(sold_count=total.get('sold') or 0,
+                                                          reserved_count=total.get('reserved') or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_merge_20210405_1034'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='reserved_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='sold_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='stock_status',
+            field=models.CharField(choices=[('0', 'None'), ('1', 'Reserved'), ('2', 'Sold')], default='0', max_length=1),
+        ),
+        migrations.RunPython(fill_stock_ledger, migrations.RunPython.noop),
+    ]
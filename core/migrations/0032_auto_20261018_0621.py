@@ -0,0 +1,33 @@
+# Generated by Django 3.1.7 on 2026-10-18 06:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_booksearchterm'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(is_delete=False), fields=['id'], name='book_not_deleted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['status', 'last_try_datetime'], name='invoice_status_last_try_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(condition=models.Q(status__in=['0', '1']), fields=['last_try_datetime'], name='invoice_open_last_try_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(condition=models.Q(stock_status='1'), fields=['last_try_datetime'], name='invoice_reserved_last_try_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofilephoneverification',
+            index=models.Index(fields=['user_profile', 'create_date'], name='verification_profile_date_idx'),
+        ),
+    ]
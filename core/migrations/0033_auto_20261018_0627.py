@@ -0,0 +1,49 @@
+# Generated by Django 3.1.7 on 2026-10-18 06:27
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_auto_20261018_0621'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofilephoneverification',
+            name='sms_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofilephoneverification',
+            name='sms_last_error',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofilephoneverification',
+            name='sms_next_try_datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='userprofilephoneverification',
+            name='sms_sent_datetime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # the existing codes were sent synchronously, they must not be queued again
+        migrations.AddField(
+            model_name='userprofilephoneverification',
+            name='sms_status',
+            field=models.CharField(choices=[('0', 'Queued'), ('1', 'Sent'), ('2', 'Failed')], default='1', max_length=1),
+        ),
+        migrations.AlterField(
+            model_name='userprofilephoneverification',
+            name='sms_status',
+            field=models.CharField(choices=[('0', 'Queued'), ('1', 'Sent'), ('2', 'Failed')], default='0', max_length=1),
+        ),
+        migrations.AddIndex(
+            model_name='userprofilephoneverification',
+            index=models.Index(condition=models.Q(sms_status='0'), fields=['sms_next_try_datetime'], name='verification_sms_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_auto_20261018_0627'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='image_renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
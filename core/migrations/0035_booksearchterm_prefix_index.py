@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_book_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booksearchterm',
+            index=models.Index(fields=['term'], name='search_term_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
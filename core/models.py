@@ -1,5 +1,9 @@
+import copy
 import datetime
+import time
 
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
@@ -7,14 +11,17 @@ import math
 import uuid
 from rest_framework.authtoken.models import Token
 
-from django.db.models import Sum
+from django.db.models import Sum, F, Q, Value, ExpressionWrapper, Case, When, Subquery, OuterRef
+from django.db.models.functions import Ceil, Round, Coalesce
 from django.utils.translation import gettext as _
 
 from django.utils import timezone
 
-from core.helpers import generate_code, send_verification_code
+from core.cache import invalidate_books, get_config_version
+from core.helpers import generate_code
 
 PAYMENT_BUFFER_TIME = 15
+RESERVATION_RELEASE_KEY = 'stock:release'
 
 
 class UserProfile(models.Model):
@@ -52,8 +59,12 @@ class UserProfile(models.Model):
 
     @property
     def token(self):
-        token, created = Token.objects.get_or_create(user=self.user)
-        return token.key
+        # the token is usually loaded with the user by the authentication
+        try:
+            return self.user.auth_token.key
+        except Token.DoesNotExist:
+            token, created = Token.objects.get_or_create(user=self.user)
+            return token.key
 
     def get_verification_object(self):
         return UserProfilePhoneVerification.objects.create(user_profile=self)
@@ -97,7 +108,7 @@ class UserProfilePhoneVerificationObjectManager(models.Manager):
         # select the latest valid user profile phone verification object
         user_profile_phone = UserProfilePhoneVerification.objects.order_by('-create_date'). \
             filter(create_date__gte=time,
-                   user_profile__phone_number=user_profile.phone_number) \
+                   user_profile=user_profile) \
             .last()
 
         if user_profile_phone and user_profile_phone.is_usable:
@@ -120,6 +131,17 @@ class UserProfilePhoneVerification(models.Model):
     RETRY_TIME = 1
     MAX_QUERY = 5
 
+    # sms delivery states
+    SMS_QUEUED = '0'
+    SMS_SENT = '1'
+    SMS_FAILED = '2'
+
+    sms_states = (
+        (SMS_QUEUED, _("Queued")),
+        (SMS_SENT, _("Sent")),
+        (SMS_FAILED, _("Failed"))
+    )
+
     user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="phone_numbers")
     code = models.CharField(max_length=13, default=generate_code)
     create_date = models.DateTimeField(auto_now_add=True)
@@ -127,12 +149,32 @@ class UserProfilePhoneVerification(models.Model):
     used = models.BooleanField(default=False)
     burnt = models.BooleanField(default=False)
 
+    # sms delivery, the code is sent by the sms queue (core.sms)
+    sms_status = models.CharField(max_length=1, choices=sms_states, default=SMS_QUEUED)
+    sms_attempts = models.IntegerField(default=0)
+    sms_next_try_datetime = models.DateTimeField(default=timezone.now)
+    sms_sent_datetime = models.DateTimeField(blank=True, null=True)
+    sms_last_error = models.CharField(max_length=255, blank=True, null=True)
+
     objects = UserProfilePhoneVerificationObjectManager()
 
+    class Meta:
+        indexes = [
+            # last not expired verification object of a user profile
+            models.Index(fields=['user_profile', 'create_date'], name='verification_profile_date_idx'),
+            # due messages of the sms queue
+            models.Index(fields=['sms_next_try_datetime'], name='verification_sms_queue_idx',
+                         condition=Q(sms_status='0')),
+        ]
+
     @property
     def is_usable(self):
         return not self.used and not self.burnt and self.query_times <= UserProfilePhoneVerification.MAX_QUERY
 
+    @property
+    def is_expired(self):
+        return self.create_date < timezone.now() - timezone.timedelta(minutes=UserProfilePhoneVerification.RETRY_TIME)
+
 
 class Person(models.Model):
     first_name = models.CharField(max_length=120)
@@ -163,6 +205,47 @@ class Publisher(models.Model):
         return "%d - %s" % (self.pk, self.name)
 
 
+class BookQuerySet(models.QuerySet):
+    CATALOG_RELATIONS = ['publisher', 'authors', 'editors', 'translators', 'related_books', 'related_to']
+
+    def catalog(self, relations=None):
+        """
+        Not deleted books, with the relations the book serializer needs
+        fetched in a constant number of queries.
+        stock counters are book columns, so no aggregation is needed
+
+        :param relations: relations to fetch, defaults to all the catalog relations
+        """
+        if relations is None:
+            relations = BookQuerySet.CATALOG_RELATIONS
+
+        queryset = self.filter(is_delete=False)
+        if 'publisher' in relations:
+            queryset = queryset.select_related('publisher')
+
+        return queryset.prefetch_related(*[relation for relation in relations if relation != 'publisher'])
+
+    def in_stock(self):
+        return self.filter(count__gt=F('sold_count') + F('reserved_count'))
+
+    def with_stock(self):
+        """
+        annotate remaining_amount, Book.remaining computed by the database
+        """
+        return self.annotate(remaining_amount=F('count') - F('sold_count') - F('reserved_count'))
+
+    def with_final_price(self):
+        """
+        annotate final_price_amount, Book.final_price computed by the database
+        discount is turned into an integer percent to keep the arithmetic exact
+        """
+        discount_percent = Round(F('discount') * 100)
+        return self.annotate(final_price_amount=Ceil(ExpressionWrapper(
+            F('price') * (100 - discount_percent) / Value(100.0),
+            output_field=models.FloatField()
+        )))
+
+
 class Book(models.Model):
     # display info
     title = models.CharField(max_length=1024)
@@ -185,6 +268,8 @@ class Book(models.Model):
 
     # header image
     image = models.ImageField(blank=True, null=True)
+    # {rendition: storage name, 'source': image name}, maintained by core.images
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
 
     # other meta data
     cover_type = models.CharField(max_length=120, blank=True, null=True)
@@ -200,14 +285,19 @@ class Book(models.Model):
     # related books
     related_books = models.ManyToManyField("Book", related_name="related_to", blank=True)
 
-    @staticmethod
-    def clear(aggregate_dict):
-        """
-        clear aggregate dictionary from null values
-        """
-        for key in aggregate_dict.keys():
-            if not aggregate_dict.get(key):
-                aggregate_dict[key] = 0
+    # stock ledger, maintained by move_book_stock
+    # number of items in payed invoices
+    sold_count = models.IntegerField(default=0)
+    # number of items in created or in payment invoices (with a time limit of 15 minutes)
+    reserved_count = models.IntegerField(default=0)
+
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # catalog queries only read not deleted books
+            models.Index(fields=['id'], name='book_not_deleted_idx', condition=Q(is_delete=False)),
+        ]
 
     @property
     def sold(self):
@@ -215,20 +305,10 @@ class Book(models.Model):
         Sold: Number of items that are fully paid +
         number of items that are in payment or in created status
         (with a time limit of 15 minutes)
-        """
-        items = Item.objects.filter(book=self)
 
-        _total_sold = items.filter(basket__invoice__status=Invoice.PAYED).aggregate(total_sold=Sum('count'))
-        _n_min_ago = timezone.now() - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME)
-        _total_in_payment = items.filter(basket__invoice__status__in=[
-            Invoice.CREATED,
-            Invoice.IN_PAYMENT
-        ], basket__invoice__last_try_datetime__gte=_n_min_ago).aggregate(total_sold=Sum('count'))
-
-        self.clear(_total_sold)
-        self.clear(_total_in_payment)
-
-        return _total_sold.get('total_sold') + _total_in_payment.get('total_sold')
+        read from the stock ledger, no queries are made
+        """
+        return self.sold_count + self.reserved_count
 
     @property
     def remaining(self):
@@ -242,6 +322,24 @@ class Book(models.Model):
         return "%d - %s" % (self.pk, self.title)
 
 
+class BookSearchTerm(models.Model):
+    """
+    Inverted index of the book search
+    a normalized term of a book and its weight, see core.search
+    """
+
+    term = models.CharField(max_length=120)
+    book = models.ForeignKey(Book, related_name="search_terms", on_delete=models.CASCADE)
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ['term', 'book']
+        indexes = [
+            # term prefix lookups, postgresql only uses an index for LIKE 'x%' with the pattern operators
+            models.Index(fields=['term'], name='search_term_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ]
+
+
 class Invoice(models.Model):
     # payment gate states
     CREATED = '0'
@@ -263,7 +361,20 @@ class Invoice(models.Model):
     create_datetime = models.DateTimeField(auto_now_add=True)
     last_try_datetime = models.DateTimeField(default=timezone.now)
 
+    # stock ledger states
+    # indicates which book counter the items of this invoice are counted in
+    STOCK_NONE = '0'
+    STOCK_RESERVED = '1'
+    STOCK_SOLD = '2'
+
+    stock_states = (
+        (STOCK_NONE, _("None")),
+        (STOCK_RESERVED, _("Reserved")),
+        (STOCK_SOLD, _("Sold"))
+    )
+
     status = models.CharField(max_length=1, choices=states, default=CREATED)
+    stock_status = models.CharField(max_length=1, choices=stock_states, default=STOCK_NONE)
 
     # vandar payment fields
     payment_token = models.CharField(max_length=255, blank=True, null=True)
@@ -274,10 +385,197 @@ class Invoice(models.Model):
     cid = models.CharField(max_length=255, blank=True, null=True)
     payment_date = models.CharField(max_length=255, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'last_try_datetime'], name='invoice_status_last_try_idx'),
+            # created and in payment invoices
+            models.Index(fields=['last_try_datetime'], name='invoice_open_last_try_idx',
+                         condition=Q(status__in=['0', '1'])),
+            # invoices counted as reserved in the stock ledger
+            models.Index(fields=['last_try_datetime'], name='invoice_reserved_last_try_idx',
+                         condition=Q(stock_status='1')),
+        ]
+
     @property
     def total_payable_amount(self):
         return self.amount + self.delivery_fee
 
+    @staticmethod
+    def reserved_q(now=None):
+        """
+        invoices that reserve their items:
+        created or in payment, with a last try in the past 15 minutes
+        """
+        now = now or timezone.now()
+        _n_min_ago = now - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME)
+        return Q(status__in=[Invoice.CREATED, Invoice.IN_PAYMENT], last_try_datetime__gte=_n_min_ago)
+
+    @staticmethod
+    def expired_q(now=None):
+        """
+        created or in payment invoices whose payment time is over, resolved by reconcile_invoices
+        """
+        now = now or timezone.now()
+        _n_min_ago = now - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME)
+        return Q(status__in=[Invoice.CREATED, Invoice.IN_PAYMENT], last_try_datetime__lt=_n_min_ago)
+
+    def get_stock_status(self):
+        """
+        the stock ledger state this invoice should be counted in
+        """
+        if self.status == Invoice.PAYED:
+            return Invoice.STOCK_SOLD
+
+        _n_min_ago = timezone.now() - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME)
+        if self.status in [Invoice.CREATED, Invoice.IN_PAYMENT] and self.last_try_datetime >= _n_min_ago:
+            return Invoice.STOCK_RESERVED
+
+        return Invoice.STOCK_NONE
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Invoice, cls).from_db(db, field_names, values)
+        instance._loaded_state = instance.get_ledger_state()
+        return instance
+
+    def get_ledger_state(self):
+        """
+        the fields the stock status is computed from
+        """
+        return self.__dict__.get('status'), self.__dict__.get('last_try_datetime')
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            update_fields = kwargs.get('update_fields')
+
+            if self.update_stock_ledger():
+                if update_fields is not None:
+                    kwargs['update_fields'] = set(update_fields) | {'stock_status'}
+            elif update_fields is None and not self._state.adding:
+                # keep the recorded stock status, this instance might be stale
+                kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                           if not field.primary_key and field.name != 'stock_status']
+            else:
+                kwargs['update_fields'] = set(update_fields) - {'stock_status'}
+
+            super(Invoice, self).save(*args, **kwargs)
+            self._loaded_state = self.get_ledger_state()
+
+    def update_stock_ledger(self):
+        """
+        move the items of this invoice between the book stock counters
+        when its stock status changes (payed, rejected, expired, ...)
+
+        :return: whether the stock status has to be saved,
+            saves that do not change the stock status do not lock the invoice
+        """
+        stock_status = self.get_stock_status()
+
+        if self._state.adding:
+            # no items yet, nothing to move
+            self.stock_status = stock_status
+            return True
+
+        if stock_status == self.stock_status and getattr(self, '_loaded_state', None) == self.get_ledger_state():
+            return False
+
+        # lock the invoice and read the recorded stock status, this instance might be stale
+        recorded_stock_status = Invoice.objects.select_for_update() \
+            .values_list('stock_status', flat=True).get(pk=self.pk)
+
+        if recorded_stock_status != stock_status:
+            move_book_stock(self.get_book_counts(), recorded_stock_status, stock_status)
+
+        self.stock_status = stock_status
+        return True
+
+    def get_book_counts(self):
+        """
+        :return: {book_id: count} of the items of this invoice
+        """
+        return dict(Item.objects.filter(basket__invoice=self)
+                    .values('book').annotate(total=Sum('count'))
+                    .values_list('book', 'total'))
+
+
+def move_book_stock(book_counts, from_stock_status, to_stock_status):
+    """
+    move books from a stock ledger counter to another
+    :param book_counts: {book_id: count}
+    :param from_stock_status: one of Invoice stock states
+    :param to_stock_status: one of Invoice stock states
+    """
+    ledger_fields = {
+        Invoice.STOCK_RESERVED: 'reserved_count',
+        Invoice.STOCK_SOLD: 'sold_count',
+    }
+    from_field = ledger_fields.get(from_stock_status)
+    to_field = ledger_fields.get(to_stock_status)
+
+    if from_field == to_field or not book_counts:
+        return
+
+    # lock the books in a deterministic order to avoid dead locks
+    book_ids = sorted(book_counts.keys())
+    list(Book.objects.select_for_update().filter(pk__in=book_ids).order_by('pk').values_list('pk', flat=True))
+
+    # update all the books in one query
+    counts = Case(*[When(pk=book_id, then=Value(count)) for book_id, count in book_counts.items()],
+                  output_field=models.IntegerField())
+    changes = {}
+    if from_field:
+        changes[from_field] = F(from_field) - counts
+    if to_field:
+        changes[to_field] = F(to_field) + counts
+    Book.objects.filter(pk__in=book_ids).update(**changes)
+
+    invalidate_book_responses(book_ids)
+
+
+def invalidate_book_responses(book_ids):
+    """
+    invalidate the cached responses showing the books:
+    their details, the details of their related books (they show the related remaining) and the lists
+    """
+    related = Book.related_books.through.objects \
+        .filter(Q(from_book_id__in=book_ids) | Q(to_book_id__in=book_ids)) \
+        .values_list('from_book_id', 'to_book_id')
+    invalidate_books(set(book_ids).union(*related))
+
+
+def release_expired_reservations(limit=None, book_ids=None):
+    """
+    move the items of the invoices whose payment time is over out of the reserved counters,
+    the reserved invoices are found by the invoice_reserved_last_try_idx index
+
+    :param limit: maximum number of invoices to release
+    :param book_ids: only release the invoices with items of these books
+    :return: number of released invoices
+    """
+    expired = Invoice.objects.filter(stock_status=Invoice.STOCK_RESERVED).exclude(Invoice.reserved_q()).order_by('pk')
+    if book_ids is not None:
+        expired = expired.filter(pk__in=Item.objects.filter(book_id__in=book_ids).values('basket__invoice'))
+    if limit:
+        expired = expired[:limit]
+
+    released = 0
+    for invoice in expired.iterator():
+        # saving moves the invoice items out of the reserved counter
+        invoice.save(update_fields=['stock_status'])
+        released += 1
+
+    return released
+
+
+def release_expired_reservations_if_due():
+    """
+    release_expired_reservations at most once per settings.RESERVATION_RELEASE_INTERVAL seconds
+    across the processes sharing the catalog cache, called by the catalog reads
+    """
+    if caches[settings.CATALOG_CACHE].add(RESERVATION_RELEASE_KEY, True,
+                                          timeout=settings.RESERVATION_RELEASE_INTERVAL):
+        release_expired_reservations(limit=settings.RESERVATION_RELEASE_BATCH_SIZE)
+
 
 class Item(models.Model):
     """
@@ -300,6 +598,25 @@ class Item(models.Model):
         unique_together = ['book', 'basket']
 
 
+class BasketQuerySet(models.QuerySet):
+
+    def with_subtotal(self):
+        """
+        annotate subtotal_amount, Basket.subtotal computed by the database
+
+        summed by a subquery per basket, joins added to the queryset (admin searches by item)
+        do not repeat the items
+        """
+        discount_percent = Round(F('discount') * 100)
+        item_subtotal = Ceil(ExpressionWrapper(
+            F('price') * (100 - discount_percent) / Value(100.0),
+            output_field=models.FloatField()
+        )) * F('count')
+        subtotal = Item.objects.filter(basket=OuterRef('pk')).order_by().values('basket') \
+            .annotate(total=Sum(item_subtotal, output_field=models.IntegerField())).values('total')
+        return self.annotate(subtotal_amount=Coalesce(Subquery(subtotal, output_field=models.IntegerField()), 0))
+
+
 class Basket(models.Model):
     """
         A  set of items that a user profile made
@@ -328,6 +645,8 @@ class Basket(models.Model):
 
     no_delivery_fee = models.BooleanField(default=False)
 
+    objects = BasketQuerySet.as_manager()
+
     @property
     def subtotal(self):
         return sum([item.subtotal for item in self.items.all()])
@@ -371,9 +690,10 @@ class SingletonModel(models.Model):
     def save(self, *args, **kwargs):
         """
         Save object to the database. Removes all other entries if there
-        are any.
+        are any, when it is a new entry.
         """
-        self.__class__.objects.exclude(id=self.id).delete()
+        if self._state.adding:
+            self.__class__.objects.exclude(id=self.id).delete()
         super(SingletonModel, self).save(*args, **kwargs)
 
     @classmethod
@@ -393,9 +713,34 @@ class SingletonModel(models.Model):
 class Config(SingletonModel):
     delivery_fee = models.IntegerField(default=0)
 
+    # (instance, config version, time of the last version check, load time) of this process
+    cached = None
+
     @staticmethod
     def get_instance():
-        return Config.get_or_create_instance()
+        """
+        the config cached by this process, a copy so the callers can change it,
+        the shared config version is checked at most once per settings.CONFIG_CHECK_INTERVAL seconds
+        and the config is reloaded after settings.CONFIG_MAX_AGE seconds, even if the version was not shared
+        """
+        cached = Config.cached
+        now = time.monotonic()
+
+        if cached and now - cached[2] < settings.CONFIG_CHECK_INTERVAL:
+            return copy.copy(cached[0])
+
+        version = get_config_version()
+        if cached and cached[1] == version and now - cached[3] < settings.CONFIG_MAX_AGE:
+            Config.cached = (cached[0], version, now, cached[3])
+            return copy.copy(cached[0])
+
+        instance = Config.get_or_create_instance()
+        Config.cached = (instance, version, now, now)
+        return copy.copy(instance)
+
+    @staticmethod
+    def clear_cache():
+        Config.cached = None
 
     @staticmethod
     def get_or_create_instance():
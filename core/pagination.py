@@ -0,0 +1,95 @@
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination, _reverse_ordering
+
+
+class BookPageNumberPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class BookCursorPagination(CursorPagination):
+    """
+    Keyset pagination, deep pages cost the same as the first page
+    the ordering is taken from the view ordering filter
+
+    the cursor position holds the values of all the ordering fields of the last book,
+    pages seek past it on all of them, so runs of equal prices or titles need no offset
+    """
+
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = 'pk'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super(BookCursorPagination, self).get_ordering(request, queryset, view)
+
+        # pk breaks the ties between equal values, keeps the order stable between pages
+        if not {'pk', '-pk'} & set(ordering):
+            ordering = tuple(ordering) + ('-pk' if ordering[0].startswith('-') else 'pk',)
+
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination.paginate_queryset seeking on the whole ordering,
+        # positions are unique (pk is in the ordering), so the cursors never have an offset
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        queryset = queryset.order_by(*(_reverse_ordering(self.ordering) if reverse else self.ordering))
+        if position is not None:
+            queryset = queryset.filter(self.get_seek_q(position, reverse))
+
+        # an extra book tells if there is a following page
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following_position = None
+        if len(results) > len(self.page):
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+
+        if reverse:
+            self.page.reverse()
+            self.next_position, self.previous_position = position, following_position
+        else:
+            self.next_position, self.previous_position = following_position, position
+        self.has_next = self.next_position is not None
+        self.has_previous = self.previous_position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_seek_q(self, position, reverse):
+        """
+        books after the position in the ordering (before it for reverse cursors):
+        (f1 > v1) or (f1 = v1 and f2 > v2) or ...
+        """
+        try:
+            values = json.loads(position)
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+        seek_q, equal = Q(), {}
+        for order, value in zip(self.ordering, values):
+            field = order.lstrip('-')
+            lookup = 'lt' if order.startswith('-') != reverse else 'gt'
+            seek_q |= Q(**equal, **{'%s__%s' % (field, lookup): value})
+            equal[field] = value
+        return seek_q
+
+    def _get_position_from_instance(self, instance, ordering):
+        return json.dumps([getattr(instance, order.lstrip('-')) for order in ordering])
@@ -0,0 +1,173 @@
+"""
+Book search over an inverted index (BookSearchTerm)
+
+book fields are normalized and split into terms, each term is stored with a weight
+depending on the field it came from, queries only read the terms table
+"""
+import re
+
+from django.db import transaction
+from django.db.models import Q, Sum, Max, Case, When, F, IntegerField, Value, Subquery, OuterRef
+
+from .models import BookSearchTerm
+
+# weight of a term by the field it came from
+FIELD_WEIGHTS = {
+    'title': 10,
+    'isbn': 10,
+    'authors': 5,
+    'translators': 4,
+    'publisher': 3,
+    'editors': 2,
+    'description': 1,
+}
+
+MAX_TERM_LENGTH = 120
+MAX_QUERY_TERMS = 10
+# sorts after every term starting with a given prefix
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+PERSIAN_CHARACTERS = str.maketrans({
+    # arabic letters to persian
+    'ي': 'ی',
+    'ى': 'ی',
+    'ئ': 'ی',
+    'ك': 'ک',
+    'ة': 'ه',
+    'ۀ': 'ه',
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ؤ': 'و',
+    # persian and arabic digits to latin
+    '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4',
+    '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+    # zero width non joiner and tatweel
+    '\u200c': '',
+    '\u0640': '',
+})
+
+# arabic diacritics (harakat, tanvin, shadda, ...)
+DIACRITICS = re.compile('[\u064b-\u065f\u0670]')
+
+# hyphens between digits, as in isbn numbers
+DIGIT_HYPHENS = re.compile(r'(?<=\d)-(?=\d)')
+
+WORDS = re.compile(r'\w+')
+
+
+def normalize(text):
+    text = (text or '').translate(PERSIAN_CHARACTERS)
+    text = DIACRITICS.sub('', text)
+    text = DIGIT_HYPHENS.sub('', text)
+    return text.lower()
+
+
+def tokenize(text):
+    """
+    normalized terms of the given text, single characters are ignored
+    """
+    return [word[:MAX_TERM_LENGTH] for word in WORDS.findall(normalize(text)) if len(word) > 1]
+
+
+def person_names(people):
+    return ' '.join('%s %s %s' % (person.first_name, person.last_name or '', person.nick_name or '')
+                    for person in people)
+
+
+def get_book_terms(book):
+    """
+    :return: {term: weight} of the given book
+    """
+    fields = {
+        'title': book.title,
+        'isbn': book.isbn,
+        'description': book.description,
+        'publisher': book.publisher.name if book.publisher else '',
+        'authors': person_names(book.authors.all()),
+        'translators': person_names(book.translators.all()),
+        'editors': person_names(book.editors.all()),
+    }
+
+    terms = {}
+    for field, text in fields.items():
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + FIELD_WEIGHTS.get(field)
+
+    return terms
+
+
+def index_book(book):
+    """
+    replace the search terms of the given book
+    """
+    with transaction.atomic():
+        BookSearchTerm.objects.filter(book=book).delete()
+        BookSearchTerm.objects.bulk_create([
+            BookSearchTerm(book=book, term=term, weight=weight)
+            for term, weight in get_book_terms(book).items()
+        ])
+
+
+def index_books(books, chunk_size=500):
+    books = books.select_related('publisher').prefetch_related('authors', 'editors', 'translators').order_by('pk')
+
+    last_pk = 0
+    while True:
+        chunk = list(books.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+
+        # replace the terms of the whole chunk in one delete and one insert
+        with transaction.atomic():
+            BookSearchTerm.objects.filter(book__in=chunk).delete()
+            BookSearchTerm.objects.bulk_create([
+                BookSearchTerm(book=book, term=term, weight=weight)
+                for book in chunk for term, weight in get_book_terms(book).items()
+            ])
+        last_pk = chunk[-1].pk
+
+
+def get_prefix_q(token):
+    """
+    terms starting with the token, the range lets the databases seek the term indexes
+    (sqlite does not use an index for LIKE, postgresql needs the varchar_pattern_ops one)
+    """
+    return Q(term__gte=token, term__lt=token + PREFIX_UPPER_BOUND, term__startswith=token)
+
+
+def search_books(queryset, query):
+    """
+    Books of the given queryset that contain all the query terms (exact or as a prefix),
+    ordered by their score, exact matches score twice as much as prefix matches
+
+    the matching books are found from the terms table, only they are read from the books table
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return queryset.none()
+
+    any_token = Q()
+    matched_tokens = Value(0, output_field=IntegerField())
+    for token in tokens:
+        any_token |= get_prefix_q(token)
+        matched_tokens = matched_tokens + Max(Case(
+            When(term__startswith=token, then=1),
+            default=0, output_field=IntegerField()
+        ))
+
+    score = Sum(Case(
+        When(term__in=tokens, then=F('weight') * 2),
+        default=F('weight'), output_field=IntegerField()
+    ))
+
+    scores = BookSearchTerm.objects.filter(any_token).values('book') \
+        .annotate(search_score=score, matched_tokens=matched_tokens) \
+        .filter(matched_tokens=len(tokens))
+
+    return queryset.filter(pk__in=scores.values('book')) \
+        .annotate(search_score=Subquery(scores.filter(book=OuterRef('pk')).values('search_score'))) \
+        .order_by('-search_score', 'pk')
@@ -1,10 +1,14 @@
 from django.core.validators import RegexValidator
 from django.db import transaction
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 
 from BookStore.settings import DEBUG
-from .helpers import send_verification_code
-from .models import UserProfile, Book, Basket, Person, Item, Invoice, Publisher, UserProfilePhoneVerification, Config
+from .models import UserProfile, Book, Basket, Person, Item, Invoice, Publisher, UserProfilePhoneVerification, Config, \
+    move_book_stock
+from .cache import invalidate_user_auth
+from .images import get_rendition_urls
+from .sms import enqueue_verification_sms
 from django.contrib.auth.models import User
 from django.utils.translation import gettext as _
 
@@ -38,6 +42,9 @@ class UserProfileSerializer(serializers.ModelSerializer):
         user_profile.update(**validated_data)
         instance.refresh_from_db()
 
+        # queryset updates send no signals, drop the cached authentication of the user
+        invalidate_user_auth(instance.user_id)
+
         return instance
 
 
@@ -50,12 +57,13 @@ class SendCodeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserProfilePhoneVerification
-        fields = ['pk', 'create_date', 'query_times', 'phone_number']
+        fields = ['pk', 'create_date', 'query_times', 'phone_number', 'sms_status']
 
         extra_kwargs = {
             'create_date': {'read_only': True},
             'query_times': {'read_only': True},
             'phone_number': {'read_only': True},
+            'sms_status': {'read_only': True},
         }
         if DEBUG:
             fields += ['code']
@@ -70,11 +78,11 @@ class SendCodeSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def send_verification_sms(user_profile):
-        # send a verification sms to the given user_profile
+        # queue a verification sms to the given user_profile, it is sent after the response
         verification_object = user_profile.get_verification_object()
         if verification_object.get('status') != 201:
             raise serializers.ValidationError(verification_object)
-        send_verification_code(user_profile.phone_number, verification_object.get('obj').code)
+        enqueue_verification_sms(verification_object.get('obj'))
         return verification_object
 
     def get_or_create_user_profile(self, phone_number, validated_data):
@@ -124,7 +132,49 @@ class RelatedBookSerializer(serializers.ModelSerializer):
                   'image', 'count', 'remaining']
 
 
-class BookSerializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """
+    Serializes only the fields asked through the request query params,
+    unrequested fields are removed before serialization so they are never computed
+
+    fields: comma separated field names, defaults to all the not expandable fields
+    expand: comma separated expandable fields to include as well
+    """
+
+    # fields that are only serialized when asked for
+    expandable_fields = []
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+
+        request = self.context.get('request')
+        if request is None:
+            return
+
+        for field_name in self.get_excluded_fields(request):
+            self.fields.pop(field_name)
+
+    def get_excluded_fields(self, request):
+        fields = self.get_query_param_set(request, 'fields')
+        expand = self.get_query_param_set(request, 'expand') or set()
+
+        included = set(self.fields.keys())
+        if fields is None:
+            included -= set(self.expandable_fields) - expand
+        else:
+            included &= fields | expand
+
+        return set(self.fields.keys()) - included
+
+    @staticmethod
+    def get_query_param_set(request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        return {field.strip() for field in value.split(',') if field.strip()}
+
+
+class BookSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     authors = PersonSerializer(many=True, read_only=True)
     editors = PersonSerializer(many=True, read_only=True)
     translators = PersonSerializer(many=True, read_only=True)
@@ -133,6 +183,8 @@ class BookSerializer(serializers.ModelSerializer):
     related_books = RelatedBookSerializer(many=True)
     related_to = RelatedBookSerializer(many=True)
 
+    image_renditions = serializers.SerializerMethodField()
+
     class Meta:
         model = Book
         fields = ['pk', 'title', 'description',
@@ -142,19 +194,82 @@ class BookSerializer(serializers.ModelSerializer):
                   'cover_type', 'page_count',
                   'cover_format', 'publish_date',
                   'related_books', 'related_to', 'remaining',
-                  'image', 'count', 'is_delete', 'sold'
+                  'image', 'image_renditions', 'count', 'is_delete', 'sold'
                   ]
 
+    def get_image_renditions(self, book):
+        """
+        {rendition: url} of the webp renditions of the cover, see settings.IMAGE_RENDITIONS
+        """
+        urls = get_rendition_urls(book)
+        request = self.context.get('request')
+        if urls and request is not None:
+            return {rendition: request.build_absolute_uri(url) for rendition, url in urls.items()}
+        return urls
+
+
+class BookCompactSerializer(BookSerializer):
+    """
+    Compact book representation for the storefront grid
+    relations are only serialized when asked through expand
+    """
+
+    expandable_fields = ['publisher', 'authors', 'editors', 'translators', 'related_books', 'related_to']
+
+    class Meta(BookSerializer.Meta):
+        fields = ['pk', 'title', 'price', 'discount', 'final_price', 'image', 'image_renditions', 'remaining',
+                  'publisher', 'authors', 'editors', 'translators', 'related_books', 'related_to']
+
+
+class ItemBookField(serializers.PrimaryKeyRelatedField):
+    """
+    Reads the book from the books fetched at once by ItemListSerializer,
+    falls back to a query for books that were not fetched
+    """
+
+    books = None
+
+    def to_internal_value(self, data):
+        if self.books is not None:
+            try:
+                book = self.books.get(int(data))
+            except (TypeError, ValueError):
+                book = None
+
+            if book is not None:
+                return book
+
+        return super(ItemBookField, self).to_internal_value(data)
+
+
+class ItemListSerializer(serializers.ListSerializer):
+
+    def to_internal_value(self, data):
+        # fetch the books of all the items in one query
+        if isinstance(data, list):
+            self.child.fields['book'].books = self.child.fields['book'].get_queryset().in_bulk(
+                self.get_book_ids(data))
+        return super(ItemListSerializer, self).to_internal_value(data)
+
+    @staticmethod
+    def get_book_ids(data):
+        book_ids = []
+        for item in data:
+            try:
+                book_ids.append(int(item.get('book')))
+            except (AttributeError, TypeError, ValueError):
+                # invalid items are reported by the item serializer
+                pass
+        return book_ids
+
 
 class ItemSerializer(serializers.ModelSerializer):
+    book = ItemBookField(queryset=Book.objects.all())
+
     class Meta:
         model = Item
         fields = ['pk', 'book', 'count']
-
-    def create(self, validated_data):
-        book = validated_data.get('book')
-        item = Item.objects.create(**validated_data, price=book.price, discount=book.discount)
-        return item
+        list_serializer_class = ItemListSerializer
 
 
 class InvoiceSerializer(serializers.ModelSerializer):
@@ -189,26 +304,44 @@ class BasketCreate(serializers.ModelSerializer):
 
     @staticmethod
     def get_items_errors_if_any(items):
-        errors, subtotal = BasketCreate.validate_item_enough_remaining_and_get_subtotal(items)
+        errors, subtotal = BasketCreate.validate_items_and_get_subtotal(items)
         # check for min order amount
         if subtotal < 1000:
             errors.append(_("Min order amount is 1000 Toman"))
         return errors
 
     @staticmethod
-    def validate_item_enough_remaining_and_get_subtotal(items):
+    def validate_items_and_get_subtotal(items):
         subtotal = 0
         errors = []
+        book_ids = set()
         for item in items:
-            subtotal += item.get('book').final_price * item.get('count')
+            book = item.get('book')
+            subtotal += book.final_price * item.get('count')
 
-            # check for remaining
-            if item.get('book').remaining < item.get('count'):
-                book = item.get('book')
-                errors.append(_("Book %d - %s underflow" % (book.pk, book.title)))
+            # a book can be put in the basket once
+            if book.pk in book_ids:
+                errors.append(_("Book %d - %s repeated" % (book.pk, book.title)))
+            book_ids.add(book.pk)
 
+        errors += BasketCreate.get_underflow_errors({item.get('book').pk: item.get('book') for item in items}, items)
         return errors, subtotal
 
+    @staticmethod
+    def get_underflow_errors(books, items):
+        """
+        :param books: {book_id: book}
+        outside of create, the books are the not locked ones read while validating,
+        their remaining is only a hint to reject baskets without locking anything,
+        the remaining of the locked books is checked once while creating
+        """
+        errors = []
+        for item in items:
+            book = books.get(item.get('book').pk)
+            if book.remaining < item.get('count'):
+                errors.append(_("Book %d - %s underflow" % (book.pk, book.title)))
+        return errors
+
     def create(self, validated_data):
 
         with transaction.atomic():
@@ -218,50 +351,54 @@ class BasketCreate(serializers.ModelSerializer):
 
     def create_basket_and_put_items_in_the_basket(self, validated_data):
         items = validated_data.pop('items')
-        basket, invoice = self.create_basket(validated_data)
-        self.create_items_in_the_basket(basket, items)
-        self.update_invoice_subtotal(basket, invoice)
+        books = self.lock_the_books(items)
+
+        errors = self.get_underflow_errors(books, items)
+        if errors:
+            raise serializers.ValidationError({'items': errors})
+
+        basket_items = [self.get_basket_item(books.get(item.get('book').pk), item.get('count')) for item in items]
+
+        basket, invoice = self.create_basket(validated_data, amount=sum(item.subtotal for item in basket_items))
+        self.create_items_in_the_basket(basket, basket_items)
+        self.reserve_the_books(basket_items, invoice)
         return basket
 
     @staticmethod
-    def update_invoice_subtotal(basket, invoice):
-        invoice.amount = basket.subtotal
-        invoice.save()
-
-    def create_items_in_the_basket(self, basket, items):
-        # create items
-        for item in items:
-            book = self.lock_the_book(item)
-            self.create_item_if_has_enough_remaining(basket, book, item)
+    def lock_the_books(items):
+        """
+        lock all the books in one query, ordered by pk to avoid dead locks
+        :return: {book_id: book}
+        """
+        book_ids = [item.get('book').pk for item in items]
+        books = Book.objects.select_for_update().filter(pk__in=book_ids).order_by('pk')
+        return {book.pk: book for book in books}
 
-    def create_item_if_has_enough_remaining(self, basket, book, item):
-        # check for enough remaining
-        if book.remaining >= item.get('count'):
-            self.create_item_in_the_basket(book, item.get('count'), basket)
-        else:
-            raise serializers.ValidationError(_("Book %d - %s underflow" % (book.pk, book.title)))
+    @staticmethod
+    def get_basket_item(book, count):
+        # price snapshot of the locked book
+        return Item(book=book, count=count, price=book.price, discount=book.discount)
 
     @staticmethod
-    def create_item_in_the_basket(_book, _count, basket):
-        item_serializer = ItemSerializer(data={'book': _book.pk, 'count': _count})
-        item_serializer.is_valid(raise_exception=True)
-        item_serializer.save(basket=basket)
+    def create_items_in_the_basket(basket, basket_items):
+        for item in basket_items:
+            item.basket = basket
+        Item.objects.bulk_create(basket_items)
+
+        # items with their primary keys, used to serialize the basket and its subtotal
+        prefetch_related_objects([basket], 'items')
 
     @staticmethod
-    def lock_the_book(item):
-        # lock the book
-        _book = item.get('book')
-        _count = item.get('count')
-        book = Book.objects.select_for_update().get(pk=_book.pk)
-        return book
+    def reserve_the_books(basket_items, invoice):
+        # count the items in the book stock ledger
+        move_book_stock({item.book_id: item.count for item in basket_items}, Invoice.STOCK_NONE, invoice.stock_status)
 
     @staticmethod
-    def create_basket(validated_data):
+    def create_basket(validated_data, amount):
         config = Config.get_instance()
 
-        # invoice amount will be updated after items put into basket
         delivery_fee = BasketCreate.get_delivery_fee(config, validated_data)
-        invoice = Invoice.objects.create(amount=1000, delivery_fee=delivery_fee)
+        invoice = Invoice.objects.create(amount=amount, delivery_fee=delivery_fee)
         basket = Basket.objects.create(**validated_data, invoice=invoice)
         return basket, invoice
 
@@ -0,0 +1,98 @@
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+from .cache import invalidate_catalog, invalidate_config, invalidate_user_auth
+from .images import is_stale, update_book_renditions
+from .models import Book, Person, Publisher, Config, UserProfile, invalidate_book_responses
+from .search import index_book, index_books
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_save, sender=Publisher)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Person)
+@receiver(post_delete, sender=Publisher)
+def invalidate_catalog_on_change(sender, **kwargs):
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=Book)
+def invalidate_book_on_save(sender, instance, **kwargs):
+    invalidate_book_responses([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.editors.through)
+@receiver(m2m_changed, sender=Book.translators.through)
+@receiver(m2m_changed, sender=Book.related_books.through)
+def invalidate_catalog_on_relation_change(sender, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        invalidate_catalog()
+
+
+@receiver(post_save, sender=Book)
+def index_book_on_save(sender, instance, **kwargs):
+    index_book(instance)
+
+
+@receiver(post_save, sender=Book)
+def update_image_renditions_on_save(sender, instance, **kwargs):
+    if instance.image and is_stale(instance.image.name, instance.image_renditions) or \
+            not instance.image and instance.image_renditions:
+        update_book_renditions(instance)
+
+
+@receiver(post_save, sender=Person)
+def index_person_books_on_save(sender, instance, **kwargs):
+    index_books(Book.objects.filter(
+        Q(authors=instance) | Q(editors=instance) | Q(translators=instance)
+    ).distinct())
+
+
+@receiver(post_save, sender=Publisher)
+def index_publisher_books_on_save(sender, instance, **kwargs):
+    index_books(Book.objects.filter(publisher=instance))
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.editors.through)
+@receiver(m2m_changed, sender=Book.translators.through)
+def index_book_on_people_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+
+    if not reverse:
+        index_book(instance)
+    elif pk_set:
+        index_books(Book.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=Config)
+@receiver(post_delete, sender=Config)
+def invalidate_config_on_change(sender, **kwargs):
+    Config.clear_cache()
+    invalidate_config()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_auth_on_token_change(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+    invalidate_user_auth(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_auth_on_user_change(sender, instance, **kwargs):
+    invalidate_user_auth(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_auth_on_profile_change(sender, instance, **kwargs):
+    invalidate_user_auth(instance.user_id)
@@ -0,0 +1,157 @@
+"""
+SMS queue of the verification codes
+
+the send_code endpoint only enqueues: the verification object is stored with a queued sms status
+and delivered after the commit by an in process worker thread, messages that could not be sent are
+retried with an exponential backoff by the process_sms_queue command until their code expires
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction, connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .helpers import kavenegar_send_sms
+from .models import UserProfilePhoneVerification
+
+
+class KavenegarTransport:
+    template = 'verify-abee'
+
+    def send_verification_code(self, phone_number, code):
+        kavenegar_send_sms(self.template, {'token': str(code)}, phone_number)
+
+
+class ConsoleTransport:
+    def send_verification_code(self, phone_number, code):
+        print("Sending: %s to %s" % (code, phone_number))
+
+
+class LocMemTransport:
+    """
+    keeps the sent messages in memory, used by the tests
+    """
+    outbox = []
+
+    def send_verification_code(self, phone_number, code):
+        LocMemTransport.outbox.append({'phone_number': phone_number, 'code': code})
+
+
+def get_transport():
+    return import_string(settings.SMS_TRANSPORT)()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.SMS_WORKER_THREADS, thread_name_prefix='sms')
+    return _executor
+
+
+def enqueue_verification_sms(verification_object):
+    """
+    the verification object is already queued by its sms status,
+    hand it to a worker thread once it is committed
+    """
+    if settings.SMS_WORKER_THREADS:
+        pk = verification_object.pk
+        transaction.on_commit(lambda: get_executor().submit(deliver_in_thread, pk))
+
+
+def deliver_in_thread(pk):
+    try:
+        deliver_verification_sms(pk)
+    finally:
+        # worker threads have their own database connections
+        connection.close()
+
+
+def get_retry_delay(attempts):
+    return timezone.timedelta(seconds=settings.SMS_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def get_error_description(error):
+    """
+    the exception class and the response status of a failed send,
+    exception messages may contain the gateway urls and their api keys
+    """
+    status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status_code:
+        return '%s (status %d)' % (error.__class__.__name__, status_code)
+    return error.__class__.__name__
+
+
+def deliver_verification_sms(pk, transport=None):
+    """
+    send the code of the given verification object if it is due
+
+    the message is claimed by an attempt counter and a next try datetime of SMS_CLAIM_TIMEOUT seconds
+    in a committed update, concurrent workers skip it, no lock or transaction is held while sending,
+    the result is recorded by a second update of the same attempt
+
+    :return: the new sms status or None if nothing was due
+    """
+    transport = transport or get_transport()
+    now = timezone.now()
+    queued = UserProfilePhoneVerification.objects.filter(pk=pk, sms_status=UserProfilePhoneVerification.SMS_QUEUED)
+
+    verification_object = queued.filter(sms_next_try_datetime__lte=now).select_related('user_profile').first()
+    if not verification_object:
+        return None
+
+    if verification_object.is_expired or not verification_object.is_usable:
+        # the code cannot be used anymore, a new one has to be requested
+        queued.update(sms_status=UserProfilePhoneVerification.SMS_FAILED, sms_last_error="code expired")
+        return UserProfilePhoneVerification.SMS_FAILED
+
+    attempts = verification_object.sms_attempts + 1
+    claimed = queued.filter(sms_attempts=verification_object.sms_attempts, sms_next_try_datetime__lte=now) \
+        .update(sms_attempts=attempts,
+                sms_next_try_datetime=now + timezone.timedelta(seconds=settings.SMS_CLAIM_TIMEOUT))
+    if not claimed:
+        # claimed by another worker
+        return None
+
+    try:
+        transport.send_verification_code(verification_object.user_profile.phone_number, verification_object.code)
+    except Exception as e:
+        changes = {'sms_last_error': get_error_description(e)}
+        if attempts >= settings.SMS_MAX_ATTEMPTS:
+            changes['sms_status'] = UserProfilePhoneVerification.SMS_FAILED
+        else:
+            changes['sms_next_try_datetime'] = now + get_retry_delay(attempts)
+    else:
+        changes = {'sms_status': UserProfilePhoneVerification.SMS_SENT, 'sms_sent_datetime': timezone.now()}
+
+    # unless the claim expired and another worker took the message
+    queued.filter(sms_attempts=attempts).update(**changes)
+    return changes.get('sms_status', UserProfilePhoneVerification.SMS_QUEUED)
+
+
+def process_sms_queue(batch_size=100):
+    """
+    deliver the due queued messages, oldest first
+
+    :return: {sms status: count}
+    """
+    due = UserProfilePhoneVerification.objects \
+        .filter(sms_status=UserProfilePhoneVerification.SMS_QUEUED, sms_next_try_datetime__lte=timezone.now()) \
+        .order_by('sms_next_try_datetime') \
+        .values_list('pk', flat=True)[:batch_size]
+
+    transport = get_transport()
+    results = {}
+    for pk in list(due):
+        sms_status = deliver_verification_sms(pk, transport)
+        if sms_status is not None:
+            results[sms_status] = results.get(sms_status, 0) + 1
+
+    return results
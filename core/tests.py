@@ -1,19 +1,82 @@
+import copy
+import csv
 import datetime
+import decimal
+import io
+import os
+import tempfile
 import json
+import time
+from unittest import mock, skipUnless
 
 import furl
+import requests
+from PIL import Image
 from django.utils.translation import gettext as _
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.core.management.base import SystemCheckError
+from django.db import connection
+from django.test import override_settings, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 from .models import *
 from django.urls import reverse
 
-from .serializers import InvoiceDetailedSerializer
-
-
-class TestBasket(APITestCase):
+from asgiref.sync import sync_to_async
+
+from .cache import bump_config_version, bump_auth_version, LRUCache, invalidate_catalog
+from .catalog_import import CatalogImporter
+from .checks import check_auth_cache
+from .images import backfill_renditions
+from .search import search_books
+from .export import get_fulfillment_rows, HEADER as EXPORT_HEADER, openpyxl
+from .benchmark import seed_catalog, Benchmark, PaymentLoadTest, create_user_profile
+from .gateway import get_client, get_metrics, reset_clients, close_async_clients, CircuitBreaker, GatewayError, \
+    CircuitOpenError
+from .gateway_stub import GatewayStub
+from .helpers import SharedKeyLock
+from .pagination import BookPageNumberPagination
+from .management.commands.explain_queries import Command as ExplainQueriesCommand
+from .serializers import InvoiceDetailedSerializer, BasketCreate
+from .vandar import apply_verification_result
+from .views import VerifyPaymentView, GetUserInfoView, BasketCreateView
+from .throttling import get_throttle_stats
+from .sms import LocMemTransport, process_sms_queue, deliver_verification_sms
+from rest_framework import serializers
+
+
+class GatewayStubMixin:
+    """
+    points the gateways to a local stub server
+    """
+    gateway_stub_responses = {}
+    gateway_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gateway_stub = GatewayStub(responses=cls.gateway_stub_responses).start()
+        cls.gateway_settings = override_settings(GATEWAYS=cls.gateway_stub.get_gateways(**cls.gateway_options))
+        cls.gateway_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.gateway_settings.disable()
+        cls.gateway_stub.stop()
+
+
+class TestBasket(GatewayStubMixin, APITestCase):
 
     def setUp(self):
+        # the config cached by the process was loaded from the rolled back data of another test
+        Config.clear_cache()
         self.createUserProfile()
         self.createBookB1AndB2()
 
@@ -113,8 +176,8 @@ class TestBasket(APITestCase):
     def list_books_ordering_pk_and_reverse_pk(self, endpoint):
         books_list_request_1 = self.client.get('%s?ordering=pk' % endpoint)
         books_list_request_1_reverse = self.client.get('%s?ordering=-pk' % endpoint)
-        books_list_request_1_response = json.loads(books_list_request_1.content)
-        books_list_request_1_reverse_response = json.loads(books_list_request_1_reverse.content)
+        books_list_request_1_response = json.loads(books_list_request_1.content).get('results')
+        books_list_request_1_reverse_response = json.loads(books_list_request_1_reverse.content).get('results')
         self.assertEqual(books_list_request_1.status_code, 200)
         self.assertEqual(books_list_request_1_reverse.status_code, 200)
         return books_list_request_1_response, books_list_request_1_reverse_response
@@ -122,6 +185,7 @@ class TestBasket(APITestCase):
     def test_basket_with_enough_book_remaining_1(self):
         response = self.createBasketWithB1AndB2Count(1, 2)
         self.assertEqual(response.status_code, 201)
+        self.refreshBooks()
         self.assertEqual(self.b1.remaining, 2)
         self.assertEqual(self.b2.remaining, 0)
 
@@ -133,6 +197,7 @@ class TestBasket(APITestCase):
         self.createAndAssertBasketWithMoreBookThanRemaining()
 
         # remaining should not change
+        self.refreshBooks()
         self.assertEqual(self.b1.remaining, 3)
         self.assertEqual(self.b2.remaining, 2)
 
@@ -216,6 +281,7 @@ class TestBasket(APITestCase):
     def assertEffectsOfInvalidBasketOnBookRemainingCount(self):
         # assert effect on book count remaining
         # all books remaining is back to init state
+        self.refreshBooks()
         self.assertEqual(self.b1.remaining, 3)
         self.assertEqual(self.b2.remaining, 2)
 
@@ -242,9 +308,150 @@ class TestBasket(APITestCase):
 
     def assertEffectOfBasketCreationOnBookRemainingCount(self):
         # assert effect on book count remaining
+        self.refreshBooks()
         self.assertEqual(self.b1.remaining, 2)
         self.assertEqual(self.b2.remaining, 0)
 
+    def test_basket_create_query_count(self):
+        books = [Book.objects.create(title="book %d" % i, price=1000, count=5) for i in range(20)]
+        # the config is cached by the process after the first request
+        Config.get_instance()
+
+        queries_2 = self.countBasketCreateQueries(books[:2])
+        queries_20 = self.countBasketCreateQueries(books)
+
+        # number of queries does not depend on the number of items
+        self.assertEqual(queries_2, queries_20)
+        for i, book in enumerate(books):
+            book.refresh_from_db()
+            self.assertEqual(book.remaining, 3 if i < 2 else 4)
+
+    def countBasketCreateQueries(self, books):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.basket_create_endpoint, data={
+                'items': [{'book': book.pk, 'count': 1} for book in books]
+            }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(json.loads(response.content).get('items')), len(books))
+        return len(context.captured_queries)
+
+    def test_basket_underflow_without_locking(self):
+        # not enough remaining is detected before opening a transaction
+        with CaptureQueriesContext(connection) as context:
+            self.createAndAssertBasketWithMoreBookThanRemaining()
+
+        self.assertFalse(any('SAVEPOINT' in query.get('sql') for query in context.captured_queries))
+
+    def test_basket_underflow_under_lock(self):
+        serializer = BasketCreate(data=self.get_the_sample_basket_data())
+        self.assertTrue(serializer.is_valid())
+
+        # another basket takes the books after validation
+        Book.objects.filter(pk=self.b2.pk).update(reserved_count=1)
+
+        with self.assertRaises(serializers.ValidationError) as context:
+            serializer.save(user_profile=self.user_profile)
+
+        self.assertEqual(context.exception.detail, {
+            'items': [_("Book %d - %s underflow") % (self.b2.pk, self.b2.title)]
+        })
+        self.assertEqual(Basket.objects.count(), 0)
+
+    def test_basket_with_repeated_book(self):
+        response = self.createBasketWithB1AndB2Count(1, 1)
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.post(self.basket_create_endpoint, data={
+            'items': [{'book': self.b1.pk, 'count': 1}, {'book': self.b1.pk, 'count': 1}]
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def refreshBooks(self):
+        # book stock counters are updated in the database
+        self.b1.refresh_from_db()
+        self.b2.refresh_from_db()
+
+    def test_book_remaining_without_queries(self):
+        self.createAndGetBasket()
+        self.refreshBooks()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.b1.remaining, 2)
+            self.assertEqual(self.b2.remaining, 0)
+
+    def test_reconcile_stock(self):
+        basket = self.createAndGetBasket()
+        Book.objects.update(sold_count=10, reserved_count=10)
+
+        call_command('reconcile_stock', stdout=io.StringIO())
+        self.assertEffectOfBasketCreationOnBookRemainingCount()
+
+        # an expired invoice is released, even without being saved
+        Invoice.objects.filter(pk=basket.invoice.pk).update(
+            last_try_datetime=timezone.now() - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME + 5))
+
+        call_command('reconcile_stock', '--expired-only', stdout=io.StringIO())
+        self.assertEffectsOfInvalidBasketOnBookRemainingCount()
+        basket.invoice.refresh_from_db()
+        self.assertEqual(basket.invoice.stock_status, Invoice.STOCK_NONE)
+
+    def expireInvoice(self, invoice):
+        Invoice.objects.filter(pk=invoice.pk).update(
+            last_try_datetime=timezone.now() - datetime.timedelta(minutes=PAYMENT_BUFFER_TIME + 5))
+
+    def test_expired_reservations_are_released_on_basket_create(self):
+        basket = self.createAndGetBasket()
+        self.expireInvoice(basket.invoice)
+
+        # the abandoned basket took all of b2, nothing else released it
+        response = self.createTheSampleBasket()
+        self.assertEqual(response.status_code, 201)
+        self.assertEffectOfBasketCreationOnBookRemainingCount()
+        basket.invoice.refresh_from_db()
+        self.assertEqual(basket.invoice.stock_status, Invoice.STOCK_NONE)
+
+    def test_basket_create_releases_only_its_books(self):
+        basket = self.createAndGetBasket()
+        self.expireInvoice(basket.invoice)
+
+        self.assertEqual(release_expired_reservations(book_ids=[Book.objects.create(title="other").pk]), 0)
+        self.assertEqual(release_expired_reservations(limit=1, book_ids=[self.b2.pk]), 1)
+        basket.invoice.refresh_from_db()
+        self.assertEqual(basket.invoice.stock_status, Invoice.STOCK_NONE)
+
+        self.assertEqual(BasketCreateView.getBookIds({'items': [{'book': self.b1.pk}, {'book': 'x'}, 'y']}),
+                         [self.b1.pk])
+        self.assertEqual(BasketCreateView.getBookIds({'items': 'z'}), [])
+
+    def test_expired_reservations_are_released_on_catalog_read(self):
+        basket = self.createAndGetBasket()
+        self.expireInvoice(basket.invoice)
+        caches[settings.CATALOG_CACHE].delete(RESERVATION_RELEASE_KEY)
+
+        response = self.client.get(reverse('book_detail', kwargs={'book_id': self.b2.pk}))
+        self.assertEqual(response.json().get('remaining'), 2)
+        self.assertEffectsOfInvalidBasketOnBookRemainingCount()
+
+    def test_invoice_save_locks_only_on_stock_changes(self):
+        invoice = self.createAndGetBasket().invoice
+
+        with CaptureQueriesContext(connection) as context:
+            invoice.payment_token = 'token'
+            invoice.save()
+        self.assertFalse(any('FOR UPDATE' in query.get('sql') or 'core_book' in query.get('sql')
+                             for query in context.captured_queries))
+
+        invoice.status = Invoice.REJECTED
+        invoice.save()
+        self.assertEffectsOfInvalidBasketOnBookRemainingCount()
+
+        # a stale instance does not overwrite the recorded stock status
+        Invoice.objects.filter(pk=invoice.pk).update(stock_status=Invoice.STOCK_SOLD)
+        invoice.save()
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.stock_status, Invoice.STOCK_SOLD)
+
     def assertBasketDataCorrectness(self, actual_total_amount, response):
         # assert basket data sanity
         api_response = json.loads(response.content)
@@ -337,8 +544,10 @@ class TestBasket(APITestCase):
         invoice.status = Invoice.PAYED
         invoice.save()
 
+        # a retried callback of a payed invoice is not a failure
         verify_response = self.attemptToVerifyInvoice(invoice)
-        self.assertEqual(verify_response.status_code, 400)
+        self.assertEqual(verify_response.status_code, 200)
+        self.assertEqual(verify_response.data.get('status'), Invoice.PAYED)
 
     def test_expired_basket_verification(self):
         invoice, payment_response = self.createBasketAndMakePayment()
@@ -348,6 +557,17 @@ class TestBasket(APITestCase):
         verify_response = self.attemptToVerifyInvoice(invoice)
         self.assertEqual(verify_response.status_code, 400)
 
+    def test_payment_when_gateway_is_down(self):
+        # open the circuit of vandar
+        circuit_breaker = get_client('vandar').circuit_breaker
+        self.addCleanup(reset_clients)
+        for _ in range(circuit_breaker.failure_threshold):
+            circuit_breaker.record_failure()
+
+        invoice, payment_response = self.createBasketAndMakePayment()
+        self.assertEqual(payment_response.data.get('status'), 503)
+        self.assertEqual(invoice.status, Invoice.CREATED)
+
     def test_verify_payment_and_redirect(self):
         invoice, payment_response = self.createBasketAndMakePayment()
         verify_and_redirect_endpoint = reverse('payment_verify_and_redirect',
@@ -398,6 +618,9 @@ class TestBasket(APITestCase):
 
 class UserCProfileTestCase(APITestCase):
 
+    def setUp(self):
+        caches[settings.THROTTLE_CACHE].clear()
+
     def test_user_profile_send_code_endpoint(self):
         send_code_endpoint = reverse('send_code')
         self.sendCodeAndAssert201(send_code_endpoint)
@@ -454,6 +677,42 @@ class UserCProfileTestCase(APITestCase):
         self.assertEqual(api_response.get('phone_number'),
                          _("Phone number not found"))
 
+    def test_wrong_code_counter_is_bounded(self):
+        user_profile = create_user_profile("09303131503", "09303131503")
+        vo = UserProfilePhoneVerification.objects.create(user_profile=user_profile).get('obj')
+
+        # parallel guesses all hold the same stale instance
+        for i in range(UserProfilePhoneVerification.MAX_QUERY):
+            stale_vo = copy.copy(vo)
+            with self.assertNumQueries(2):
+                remaining = GetUserInfoView.handle_wrong_code_and_get_remaining_query_times(stale_vo)
+            self.assertEqual(remaining, UserProfilePhoneVerification.MAX_QUERY - (i + 1))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(GetUserInfoView.handle_wrong_code_and_get_remaining_query_times(copy.copy(vo)), 0)
+
+        vo.refresh_from_db()
+        self.assertEqual(vo.query_times, UserProfilePhoneVerification.MAX_QUERY)
+        self.assertTrue(vo.burnt)
+
+    def test_using_a_stale_code_keeps_the_other_fields(self):
+        user_profile = create_user_profile("09303131503", "09303131503")
+        vo = UserProfilePhoneVerification.objects.create(user_profile=user_profile).get('obj')
+        stale_vo = copy.copy(vo)
+
+        # a wrong guess and the sms worker update the row meanwhile
+        GetUserInfoView.handle_wrong_code_and_get_remaining_query_times(copy.copy(vo))
+        UserProfilePhoneVerification.objects.filter(pk=vo.pk).update(sms_status=UserProfilePhoneVerification.SMS_SENT)
+
+        self.assertTrue(GetUserInfoView.use_the_code(stale_vo))
+        vo.refresh_from_db()
+        self.assertTrue(vo.used)
+        self.assertEqual(vo.query_times, 1)
+        self.assertEqual(vo.sms_status, UserProfilePhoneVerification.SMS_SENT)
+
+        # a code is used once
+        self.assertFalse(GetUserInfoView.use_the_code(copy.copy(stale_vo)))
+
     def test_user_profile_send_code_wrong_code_right_code(self):
         send_code_endpoint = reverse('send_code')
         get_user_info = reverse('get_user_info')
@@ -564,12 +823,290 @@ class UserCProfileTestCase(APITestCase):
         self.assertGreaterEqual(api_response.keys(), new_user_profile_data.keys())
 
 
+class TestCachedTokenAuthentication(APITestCase):
+
+    def setUp(self):
+        self.user_profile = create_user_profile("09303131503", "09303131503")
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_profile.token)
+        self.user_profile_endpoint = reverse('user_profile_retrieve_update')
+
+    def test_warm_request_without_queries(self):
+        self.client.get(self.user_profile_endpoint)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.user_profile_endpoint)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('phone_number'), "09303131503")
+        self.assertEqual(response.data.get('token'), self.user_profile.token)
+
+    def test_token_rotation(self):
+        old_token = self.user_profile.token
+        self.client.get(self.user_profile_endpoint)
+
+        Token.objects.filter(user=self.user_profile.user).get().delete()
+        new_token = Token.objects.create(user=self.user_profile.user)
+
+        self.assertEqual(self.client.get(self.user_profile_endpoint).status_code, 401)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + new_token.key)
+        response = self.client.get(self.user_profile_endpoint)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.data.get('token'), old_token)
+
+    def test_profile_update(self):
+        self.client.get(self.user_profile_endpoint)
+        response = self.client.put(self.user_profile_endpoint, data={'phone_number': "09303131503", 'first_name': "Ali"})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.user_profile_endpoint)
+        self.assertEqual(response.data.get('first_name'), "Ali")
+
+    def test_changed_by_another_process(self):
+        self.client.get(self.user_profile_endpoint)
+
+        # another process changes the profile, it bumps the shared auth version of the user
+        UserProfile.objects.filter(pk=self.user_profile.pk).update(first_name="Ali")
+        bump_auth_version(self.user_profile.user_id)
+
+        response = self.client.get(self.user_profile_endpoint)
+        self.assertEqual(response.data.get('first_name'), "Ali")
+
+    def test_lru_cache(self):
+        lru_cache = LRUCache(max_size=2, ttl=60)
+        lru_cache.set('a', 1)
+        lru_cache.set('b', 2)
+        lru_cache.get('a')
+        lru_cache.set('c', 3)
+
+        # the least recently used entry is dropped
+        self.assertEqual([lru_cache.get(key) for key in ['a', 'b', 'c']], [1, None, 3])
+
+        expired_cache = LRUCache(max_size=2, ttl=-1)
+        expired_cache.set('a', 1)
+        self.assertIsNone(expired_cache.get('a'))
+
+    @override_settings(WORKER_PROCESSES=4)
+    def test_process_local_auth_cache_check(self):
+        self.assertEqual([error.id for error in check_auth_cache(None)], ['core.E001'])
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                                       'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                  'LOCATION': 'cache'}},
+                               AUTH_CACHE='shared'):
+            self.assertEqual(check_auth_cache(None), [])
+
+        # only the deployment checks fail
+        call_command('check', stdout=io.StringIO())
+        with self.assertRaisesMessage(SystemCheckError, 'core.E001'):
+            call_command('check', deploy=True, stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class FailingTransport:
+    def send_verification_code(self, phone_number, code):
+        raise IOError("provider is down")
+
+
+class HTTPErrorTransport:
+    def send_verification_code(self, phone_number, code):
+        response = requests.Response()
+        response.status_code = 403
+        response.url = 'https://api.kavenegar.com/v1/the-api-key/verify/lookup.json'
+        response.raise_for_status()
+
+
+class ConcurrentTransport:
+    """
+    delivers the message being sent again, from another worker
+    """
+    results = []
+
+    def send_verification_code(self, phone_number, code):
+        pk = UserProfilePhoneVerification.objects.get(code=code).pk
+        ConcurrentTransport.results.append(deliver_verification_sms(pk, LocMemTransport()))
+
+
+@override_settings(SMS_TRANSPORT='core.sms.LocMemTransport', SMS_MAX_ATTEMPTS=3, SMS_RETRY_BACKOFF=5)
+class TestSmsQueue(APITestCase):
+
+    def setUp(self):
+        caches[settings.THROTTLE_CACHE].clear()
+        LocMemTransport.outbox = []
+
+    def sendCode(self):
+        response = self.client.post(reverse('send_code'), data={'phone_number': "09303131503"})
+        self.assertEqual(response.status_code, 201)
+        return UserProfilePhoneVerification.objects.get(pk=json.loads(response.content).get('pk'))
+
+    def test_send_code_only_enqueues(self):
+        verification_object = self.sendCode()
+
+        self.assertEqual(verification_object.sms_status, UserProfilePhoneVerification.SMS_QUEUED)
+        self.assertEqual(LocMemTransport.outbox, [])
+
+        process_sms_queue()
+        verification_object.refresh_from_db()
+
+        self.assertEqual(verification_object.sms_status, UserProfilePhoneVerification.SMS_SENT)
+        self.assertEqual(verification_object.sms_attempts, 1)
+        self.assertIsNotNone(verification_object.sms_sent_datetime)
+        self.assertEqual(LocMemTransport.outbox, [{'phone_number': "09303131503", 'code': verification_object.code}])
+
+        # sent messages are not sent again
+        process_sms_queue()
+        self.assertEqual(len(LocMemTransport.outbox), 1)
+
+    @override_settings(SMS_TRANSPORT='core.tests.FailingTransport')
+    def test_retry_with_backoff(self):
+        verification_object = self.sendCode()
+
+        process_sms_queue()
+        verification_object.refresh_from_db()
+        self.assertEqual(verification_object.sms_status, UserProfilePhoneVerification.SMS_QUEUED)
+        self.assertEqual(verification_object.sms_attempts, 1)
+        self.assertEqual(verification_object.sms_last_error, "OSError")
+        self.assertGreater(verification_object.sms_next_try_datetime, timezone.now() + timezone.timedelta(seconds=4))
+
+        # not due yet
+        self.assertEqual(process_sms_queue(), {})
+
+        for attempts in [2, 3]:
+            UserProfilePhoneVerification.objects.filter(pk=verification_object.pk) \
+                .update(sms_next_try_datetime=timezone.now())
+            process_sms_queue()
+            verification_object.refresh_from_db()
+            self.assertEqual(verification_object.sms_attempts, attempts)
+
+        self.assertEqual(verification_object.sms_status, UserProfilePhoneVerification.SMS_FAILED)
+
+    @override_settings(SMS_TRANSPORT='core.tests.HTTPErrorTransport')
+    def test_error_without_the_gateway_url(self):
+        verification_object = self.sendCode()
+
+        process_sms_queue()
+        verification_object.refresh_from_db()
+        self.assertEqual(verification_object.sms_last_error, "HTTPError (status 403)")
+
+    @override_settings(SMS_TRANSPORT='core.tests.ConcurrentTransport')
+    def test_claimed_message_is_not_sent_twice(self):
+        ConcurrentTransport.results = []
+        verification_object = self.sendCode()
+
+        self.assertEqual(process_sms_queue(), {UserProfilePhoneVerification.SMS_SENT: 1})
+        self.assertEqual(ConcurrentTransport.results, [None])
+        self.assertEqual(LocMemTransport.outbox, [])
+
+    def test_expired_code_is_not_sent(self):
+        verification_object = self.sendCode()
+        UserProfilePhoneVerification.objects.filter(pk=verification_object.pk) \
+            .update(create_date=timezone.now() - timezone.timedelta(minutes=UserProfilePhoneVerification.RETRY_TIME))
+
+        process_sms_queue()
+        verification_object.refresh_from_db()
+
+        self.assertEqual(verification_object.sms_status, UserProfilePhoneVerification.SMS_FAILED)
+        self.assertEqual(LocMemTransport.outbox, [])
+
+    def test_process_sms_queue_command(self):
+        self.sendCode()
+        out = io.StringIO()
+        call_command('process_sms_queue', stdout=out)
+
+        self.assertIn("1 sent", out.getvalue())
+        self.assertEqual(len(LocMemTransport.outbox), 1)
+
+
+class TestThrottling(APITestCase):
+
+    def setUp(self):
+        caches[settings.THROTTLE_CACHE].clear()
+
+    def sendCode(self, phone_number, **extra):
+        return self.client.post(reverse('send_code'), data={'phone_number': phone_number}, **extra)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': '2/hour', 'ip': None, 'global': None})
+    def test_phone_number_limit(self):
+        self.assertEqual(self.sendCode("09303131503").status_code, 201)
+        self.assertEqual(self.client.post(reverse('get_user_info'), data={
+            'phone_number': "09303131503", 'code': "wrong"}).status_code, 400)
+
+        # the same phone number in another format, rejected before any database work
+        with self.assertNumQueries(0):
+            response = self.sendCode("+989303131503")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(UserProfilePhoneVerification.objects.count(), 1)
+
+        self.assertEqual(self.sendCode("09303131504").status_code, 201)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': None, 'ip': '2/minute', 'global': None})
+    def test_ip_limit(self):
+        self.assertEqual(self.sendCode("09303131503").status_code, 201)
+        self.assertEqual(self.sendCode("09303131504").status_code, 201)
+        self.assertEqual(self.sendCode("09303131505").status_code, 429)
+        self.assertEqual(self.sendCode("09303131505", REMOTE_ADDR='10.0.0.2').status_code, 201)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': None, 'ip': '1/minute', 'global': None})
+    def test_forwarded_for_is_not_trusted(self):
+        self.assertEqual(self.sendCode("09303131503", HTTP_X_FORWARDED_FOR='10.0.0.3').status_code, 201)
+        self.assertEqual(self.sendCode("09303131504", HTTP_X_FORWARDED_FOR='10.0.0.4').status_code, 429)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': '5/minute', 'ip': '1/minute', 'global': None})
+    def test_rejected_requests_are_not_counted_by_the_next_throttles(self):
+        self.assertEqual(self.sendCode("09303131503").status_code, 201)
+        self.assertEqual(self.sendCode("09303131503").status_code, 429)
+
+        self.assertEqual(get_throttle_stats().get('phone'), {'allowed': 1, 'rejected': 0})
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': None, 'ip': None, 'global': '1/minute'})
+    def test_global_limit(self):
+        self.assertEqual(self.sendCode("09303131503").status_code, 201)
+        self.assertEqual(self.sendCode("09303131504", REMOTE_ADDR='10.0.0.2').status_code, 429)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': '2/minute', 'ip': None, 'global': None})
+    def test_sliding_window(self):
+        start = (time.time() // 60 + 1) * 60
+        with mock.patch('core.throttling.OTPRateThrottle.timer', side_effect=lambda: now):
+            now = start
+            self.assertEqual(self.sendCode("09303131503").status_code, 201)
+            self.assertEqual(self.sendCode("09303131503").status_code, 400)
+
+            # the previous window still counts in full
+            now = start + 60
+            self.assertEqual(self.sendCode("09303131503").status_code, 429)
+
+            # half of it has slid out
+            now = start + 90
+            self.assertEqual(self.sendCode("09303131503").status_code, 400)
+            self.assertEqual(self.sendCode("09303131503").status_code, 429)
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': '1/hour', 'ip': None, 'global': None})
+    def test_stats(self):
+        self.sendCode("09303131503")
+        self.sendCode("09303131503")
+
+        response = self.client.get(reverse('throttle_stats'))
+        self.assertEqual(response.status_code, 401)
+
+        admin = User.objects.create_superuser('admin', password='admin')
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('throttle_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {
+            'global': {'allowed': 0, 'rejected': 0},
+            'ip': {'allowed': 0, 'rejected': 0},
+            'phone': {'allowed': 1, 'rejected': 1},
+        })
+
+
 class TestBook(APITestCase):
 
     def setUp(self) -> None:
         self.b1 = Book.objects.create(title="b1")
         self.b2 = Book.objects.create(title="b2")
         self.b3 = Book.objects.create(title="b3")
+        # the queries of the catalog reads are counted, expired reservations are released by the first one
+        caches[settings.CATALOG_CACHE].set(RESERVATION_RELEASE_KEY, True)
 
     def test_add_related_books(self):
         self.makeRelationsForB1()
@@ -589,10 +1126,1186 @@ class TestBook(APITestCase):
     def test_add_self_to_related(self):
         self.b1.related_books.add(self.b1)
 
+    def test_book_list_query_count(self):
+        self.makeRelationsForB1()
+        self.addBooksWithRelations(5)
+        queries_5 = self.countBookListQueries()
+
+        self.addBooksWithRelations(20)
+        queries_25 = self.countBookListQueries()
+
+        # number of queries does not depend on the number of books
+        self.assertEqual(queries_5, queries_25)
+
+    def test_book_list_page_pagination(self):
+        self.addBooksWithRelations(5)
+
+        response = self.client.get('%s?pagination=page&page_size=3&page=2' % reverse('books_list'))
+        api_response = json.loads(response.content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(api_response.get('count'), 8)
+        self.assertEqual(len(api_response.get('results')), 3)
+
+    def test_book_list_cursor_pagination(self):
+        self.addBooksWithRelations(5)
+        Book.objects.filter(pk__in=[self.b1.pk, self.b2.pk]).update(price=2000)
+
+        for ordering in ['pk', '-pk', 'price,pk', '-price,-pk', 'title,pk']:
+            all_books = json.loads(self.client.get('%s?page_size=100&ordering=%s' % (
+                reverse('books_list'), ordering)).content).get('results')
+            paginated_books = self.getAllPagesWithCursor(ordering)
+
+            self.assertListEqual([book.get('pk') for book in paginated_books],
+                                 [book.get('pk') for book in all_books])
+
+    def test_book_list_paginated_by_default(self):
+        self.addBooksWithRelations(25)
+
+        api_response = json.loads(self.client.get(reverse('books_list')).content)
+        self.assertEqual(api_response.get('count'), 28)
+        self.assertEqual(len(api_response.get('results')), BookPageNumberPagination.page_size)
+
+        # the whole list can not be requested
+        response = self.client.get('%s?pagination=none' % reverse('books_list'))
+        self.assertEqual(len(json.loads(response.content).get('results')), BookPageNumberPagination.page_size)
+        with mock.patch.object(BookPageNumberPagination, 'max_page_size', 5):
+            response = self.client.get('%s?page_size=1000' % reverse('books_list'))
+        self.assertEqual(len(json.loads(response.content).get('results')), 5)
+
+    def test_book_list_cursor_seeks_on_the_whole_ordering(self):
+        self.addBooksWithRelations(10)
+        Book.objects.update(price=1000)
+
+        with CaptureQueriesContext(connection) as context:
+            paginated_books = self.getAllPagesWithCursor('price')
+
+        self.assertListEqual([book.get('pk') for book in paginated_books],
+                             list(Book.objects.order_by('price', 'pk').values_list('pk', flat=True)))
+        # the equal prices are not skipped by an offset
+        self.assertFalse(any('OFFSET' in query.get('sql') for query in context.captured_queries))
+
+    def test_book_list_sparse_fields(self):
+        self.addBooksWithRelations(5)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('%s?pagination=cursor&fields=pk,title,remaining' % reverse('books_list'))
+        api_response = json.loads(response.content).get('results')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(api_response[0].keys()), {'pk', 'title', 'remaining'})
+
+        response = self.client.get('%s?fields=pk&expand=authors' % reverse('books_list'))
+        self.assertEqual(set(json.loads(response.content).get('results')[0].keys()), {'pk', 'authors'})
+
+    def test_book_list_compact(self):
+        self.addBooksWithRelations(5)
+
+        response = self.client.get('%s?compact=true' % reverse('books_list'))
+        api_response = json.loads(response.content).get('results')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(api_response[0].keys()),
+                         {'pk', 'title', 'price', 'discount', 'final_price', 'image', 'image_renditions',
+                          'remaining'})
+
+        response = self.client.get('%s?compact=true&expand=publisher' % reverse('books_list'))
+        self.assertIn('publisher', json.loads(response.content).get('results')[0])
+
+    def test_book_detail_sparse_fields(self):
+        self.makeRelationsForB1()
+        response = self.client.get('%s?fields=pk,related_books' % reverse('book_detail', kwargs={'book_id': self.b1.pk}))
+        api_response = json.loads(response.content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(api_response.keys()), {'pk', 'related_books'})
+        self.assertEqual(len(api_response.get('related_books')), 3)
+
+    def getAllPagesWithCursor(self, ordering):
+        books = []
+        url = '%s?pagination=cursor&page_size=3&ordering=%s' % (reverse('books_list'), ordering)
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            api_response = json.loads(response.content)
+            self.assertLessEqual(len(api_response.get('results')), 3)
+            books += api_response.get('results')
+            url = api_response.get('next')
+        return books
+
+    def addBooksWithRelations(self, n):
+        publisher = Publisher.objects.create(name="publisher")
+        person = Person.objects.create(first_name="person")
+
+        for i in range(n):
+            book = Book.objects.create(title="book %d" % i, publisher=publisher)
+            book.authors.add(person)
+            book.editors.add(person)
+            book.translators.add(person)
+            book.related_books.add(self.b1)
+
+    def countBookListQueries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('books_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+
+class TestCatalogCache(APITestCase):
+
+    def setUp(self) -> None:
+        Config.clear_cache()
+        self.b1 = Book.objects.create(title="b1", price=1000, count=2)
+        self.endpoint = reverse('book_detail', kwargs={'book_id': self.b1.pk})
+
+    def test_cached_book_detail(self):
+        response = self.client.get(self.endpoint)
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(self.endpoint)
+
+        self.assertEqual(json.loads(cached_response.content), json.loads(response.content))
+        self.assertEqual(cached_response['ETag'], response['ETag'])
+
+    def test_not_modified(self):
+        etag = self.client.get(self.endpoint)['ETag']
+
+        response = self.client.get(self.endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidate_on_book_save(self):
+        self.client.get(self.endpoint)
+
+        self.b1.title = "new title"
+        self.b1.save()
+
+        response = self.client.get(self.endpoint)
+        self.assertEqual(json.loads(response.content).get('title'), "new title")
+
+    def test_invalidate_on_basket_create(self):
+        self.assertEqual(json.loads(self.client.get(self.endpoint).content).get('remaining'), 2)
+
+        user = User.objects.create_user(username="spsina", password="thecode")
+        UserProfile.objects.create(user=user, phone_number="09303131503")
+        self.client.login(username="spsina", password="thecode")
+        response = self.client.post(reverse('basket_create'), data={
+            'items': [{'book': self.b1.pk, 'count': 1}]
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(json.loads(self.client.get(self.endpoint).content).get('remaining'), 1)
+
+    def test_cache_key_contains_the_host(self):
+        Book.objects.filter(pk=self.b1.pk).update(image='covers/cover.jpg')
+        invalidate_catalog()
+
+        self.client.get(self.endpoint, HTTP_HOST='localhost')
+        response = self.client.get(self.endpoint, HTTP_HOST='127.0.0.1')
+        self.assertTrue(json.loads(response.content).get('image').startswith('http://127.0.0.1/'))
+
+    def test_stock_changes_invalidate_only_the_affected_books(self):
+        b2 = Book.objects.create(title="b2", price=1000, count=2)
+        b3 = Book.objects.create(title="b3", price=1000, count=2)
+        b3.related_books.add(self.b1)
+        endpoints = {book: reverse('book_detail', kwargs={'book_id': book.pk}) for book in [b2, b3]}
+        for endpoint in endpoints.values():
+            self.client.get(endpoint)
+
+        move_book_stock({self.b1.pk: 1}, Invoice.STOCK_NONE, Invoice.STOCK_RESERVED)
+
+        with self.assertNumQueries(0):
+            self.client.get(endpoints[b2])
+        # b3 shows the remaining of its related b1
+        response = self.client.get(endpoints[b3])
+        self.assertEqual(json.loads(response.content).get('related_books')[0].get('remaining'), 1)
+        self.assertEqual(json.loads(self.client.get(self.endpoint).content).get('remaining'), 1)
+
+    def test_list_cache_key_contains_query_params(self):
+        Book.objects.create(title="b2")
+
+        self.assertEqual(len(json.loads(self.client.get(reverse('books_list')).content).get('results')), 2)
+        response = self.client.get('%s?page_size=1' % reverse('books_list'))
+        self.assertEqual(len(json.loads(response.content).get('results')), 1)
+
+
+class TestBookFilter(APITestCase):
+
+    def setUp(self) -> None:
+        self.p1 = Publisher.objects.create(name="p1")
+        self.p2 = Publisher.objects.create(name="p2")
+        self.author = Person.objects.create(first_name="sina")
+        self.translator = Person.objects.create(first_name="ali")
+
+        self.b1 = Book.objects.create(title="b1", publisher=self.p1, price=1000, count=1, cover_type="hard")
+        self.b2 = Book.objects.create(title="b2", publisher=self.p1, price=1200, discount=0.2, count=2,
+                                      sold_count=1, reserved_count=1)
+        self.b3 = Book.objects.create(title="b3", publisher=self.p2, price=3000, count=5, cover_type="soft")
+
+        self.b1.authors.add(self.author)
+        self.b2.authors.add(self.author)
+        self.b2.translators.add(self.translator)
+
+    def filterBooks(self, **params):
+        response = self.client.get(reverse('books_list'), data=params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def assertFiltered(self, books, **params):
+        self.assertEqual([book.get('pk') for book in self.filterBooks(ordering='pk', **params).get('results')],
+                         [book.pk for book in books])
+
+    def test_filters(self):
+        self.assertFiltered([self.b1, self.b2], publisher=self.p1.pk)
+        self.assertFiltered([self.b1, self.b2, self.b3], publisher='%d,%d' % (self.p1.pk, self.p2.pk))
+        self.assertFiltered([self.b1, self.b2], author=self.author.pk)
+        self.assertFiltered([self.b2], translator=self.translator.pk)
+        self.assertFiltered([self.b2, self.b3], min_price=1100)
+        self.assertFiltered([self.b1, self.b2], max_price=1200)
+        self.assertFiltered([self.b2], min_final_price=960, max_final_price=960)
+        self.assertFiltered([self.b3], cover_type="soft")
+        self.assertFiltered([self.b1, self.b3], in_stock='true')
+        self.assertFiltered([self.b1], in_stock='true', publisher=self.p1.pk)
+
+    def test_invalid_filter(self):
+        response = self.client.get(reverse('books_list'), data={'publisher': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_facets(self):
+        api_response = self.filterBooks(facets='true', publisher=self.p1.pk)
+        facets = api_response.get('facets')
+
+        self.assertEqual(len(api_response.get('results')), 2)
+        self.assertEqual(facets.get('total'), 2)
+        self.assertEqual(facets.get('in_stock'), 1)
+        self.assertEqual(facets.get('publishers'), [{'pk': self.p1.pk, 'name': 'p1', 'count': 2}])
+        self.assertEqual(facets.get('authors')[0].get('count'), 2)
+        self.assertEqual(facets.get('translators')[0].get('pk'), self.translator.pk)
+        self.assertEqual(facets.get('cover_types'), [{'cover_type': 'hard', 'count': 1}])
+        self.assertEqual(facets.get('price'), {'min': 1000, 'max': 1200})
+
+    def test_facets_paginated(self):
+        api_response = self.filterBooks(facets='true', pagination='page', page_size=1)
+        self.assertEqual(len(api_response.get('results')), 1)
+        self.assertEqual(api_response.get('facets').get('total'), 3)
+
+
+class TestImageRenditions(APITestCase):
+
+    def setUp(self) -> None:
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    @staticmethod
+    def createCover(name='cover.png', size=(1200, 1800)):
+        output = io.BytesIO()
+        Image.new('RGB', size, color=(200, 30, 30)).save(output, 'PNG')
+        return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+    def test_renditions_on_upload(self):
+        book = Book.objects.create(title="book", image=self.createCover())
+
+        book.refresh_from_db()
+        self.assertEqual(book.image_renditions.get('source'), book.image.name)
+        for rendition, size in settings.IMAGE_RENDITIONS.items():
+            with default_storage.open(book.image_renditions.get(rendition)) as file:
+                image = Image.open(file)
+                self.assertEqual(image.format, 'WEBP')
+                self.assertLessEqual(image.size, size)
+                self.assertEqual(image.size[1], size[1])
+
+        # saving again does not render again
+        with mock.patch('core.images.create_renditions') as create_renditions:
+            book.save()
+        create_renditions.assert_not_called()
+
+        book.image = self.createCover('another.png', size=(100, 100))
+        book.save()
+        book.refresh_from_db()
+        self.assertEqual(book.image_renditions.get('source'), book.image.name)
+
+    def test_renditions_of_same_named_covers(self):
+        book = Book.objects.create(title="book", image=self.createCover('cover.jpg'))
+        another = Book.objects.create(title="another", image=self.createCover('cover.png', size=(100, 100)))
+        again = Book.objects.create(title="again", image=self.createCover('cover.png', size=(200, 200)))
+
+        names = [book.image_renditions.get('thumbnail'), another.image_renditions.get('thumbnail'),
+                 again.image_renditions.get('thumbnail')]
+        self.assertEqual(len(set(names)), 3)
+        for name in names:
+            self.assertTrue(default_storage.exists(name))
+
+    def test_old_renditions_deleted(self):
+        book = Book.objects.create(title="book", image=self.createCover())
+        old_renditions = dict(book.image_renditions)
+
+        book.image = self.createCover('another.png', size=(100, 100))
+        book.save()
+        for rendition in settings.IMAGE_RENDITIONS:
+            self.assertFalse(default_storage.exists(old_renditions.get(rendition)))
+            self.assertTrue(default_storage.exists(book.image_renditions.get(rendition)))
+
+        new_renditions = dict(book.image_renditions)
+        book.image = None
+        book.save()
+        self.assertEqual(Book.objects.get(pk=book.pk).image_renditions, {})
+        self.assertFalse(default_storage.exists(new_renditions.get('thumbnail')))
+
+    def test_unreadable_cover(self):
+        book = Book.objects.create(title="missing cover", image='missing.png')
+        self.assertEqual(Book.objects.get(pk=book.pk).image_renditions, {})
+
+        book.image = SimpleUploadedFile('broken.png', b'not an image', content_type='image/png')
+        book.save()
+        self.assertEqual(Book.objects.get(pk=book.pk).image_renditions, {})
+
+        response = self.client.get(reverse('book_detail', kwargs={'book_id': book.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_serializer_urls(self):
+        book = Book.objects.create(title="book", image=self.createCover())
+        book_without_cover = Book.objects.create(title="no cover")
+
+        response = self.client.get(reverse('book_detail', kwargs={'book_id': book.pk}))
+        urls = json.loads(response.content).get('image_renditions')
+        self.assertEqual(set(urls.keys()), set(settings.IMAGE_RENDITIONS.keys()))
+        self.assertTrue(urls.get('thumbnail').startswith('http://testserver/media/renditions/'))
+        self.assertTrue(urls.get('thumbnail').endswith('-thumbnail.webp'))
+
+        response = self.client.get(reverse('book_detail', kwargs={'book_id': book_without_cover.pk}))
+        self.assertIsNone(json.loads(response.content).get('image_renditions'))
+
+        # missing renditions fall back to the original cover
+        Book.objects.filter(pk=book.pk).update(image_renditions={})
+        invalidate_catalog()
+        response = self.client.get(reverse('book_detail', kwargs={'book_id': book.pk}))
+        api_response = json.loads(response.content)
+        self.assertEqual(api_response.get('image_renditions').get('medium'), api_response.get('image'))
+
+    def test_backfill_command(self):
+        book = Book.objects.create(title="book", image=self.createCover())
+        broken = Book.objects.create(title="broken")
+        Book.objects.filter(pk=book.pk).update(image_renditions={})
+        Book.objects.filter(pk=broken.pk).update(image='missing.png')
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('create_image_renditions', workers=0, stdout=out, stderr=err)
+        self.assertIn("renditions of 1 books created", out.getvalue())
+        self.assertIn("1 covers could not be read", err.getvalue())
+
+        book.refresh_from_db()
+        self.assertEqual(book.image_renditions.get('source'), book.image.name)
+
+        # nothing left to do
+        self.assertEqual(backfill_renditions(Book.objects.filter(pk=book.pk), workers=0), (0, 0))
+
+        # rendered by worker processes
+        Book.objects.filter(pk=book.pk).update(image_renditions={})
+        self.assertEqual(backfill_renditions(Book.objects.filter(pk=book.pk), workers=2), (1, 0))
+
+
+class TestCatalogImport(APITestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        # an existing person in another spelling
+        self.author = Person.objects.create(first_name="صادق", last_name="هدايت")
+
+    def writeFile(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def writeCsv(self, rows):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=['isbn', 'title', 'publisher', 'price', 'discount', 'count',
+                                                 'authors', 'translators', 'related_books'])
+        writer.writeheader()
+        writer.writerows(rows)
+        return self.writeFile('catalog.csv', out.getvalue())
+
+    def importCatalog(self, path, **options):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_catalog', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv(self):
+        out, err = self.importCatalog(self.writeCsv([
+            {'isbn': '978-964-312-001-1', 'title': "بوف کور", 'publisher': "نشر نی", 'price': 1000,
+             'discount': '0.1', 'count': 5, 'authors': "صادق هدایت", 'related_books': "9789643120028"},
+            {'isbn': '9789643120028', 'title': "سه قطره خون", 'publisher': " نشر ني ", 'price': 2000,
+             'count': 3, 'authors': "صادق  هدایت|Jane Doe", 'translators': "Jane Doe"},
+            {'isbn': '', 'title': "no isbn"},
+            {'isbn': '123', 'title': "bad price", 'price': "free"},
+        ]))
+
+        self.assertIn("2 books created", out)
+        self.assertIn("2 skipped", out)
+        self.assertIn("row 3 skipped", err)
+
+        self.assertEqual(Publisher.objects.count(), 1)
+        self.assertEqual(Person.objects.count(), 2)
+
+        first = Book.objects.get(isbn='978-964-312-001-1')
+        second = Book.objects.get(isbn='9789643120028')
+        self.assertEqual(first.discount, decimal.Decimal('0.1'))
+        self.assertEqual(first.publisher, second.publisher)
+        self.assertEqual(list(first.authors.all()), [self.author])
+        self.assertEqual(second.authors.count(), 2)
+        self.assertEqual(second.translators.get().first_name, "Jane")
+        self.assertEqual(list(first.related_books.all()), [second])
+
+        # searchable without saving the books one by one
+        self.assertEqual(list(search_books(Book.objects.all(), "هدایت").order_by('pk')), [first, second])
+
+    def test_reimport_updates(self):
+        self.importCatalog(self.writeCsv([
+            {'isbn': '9789643120011', 'title': "بوف کور", 'price': 1000, 'authors': "صادق هدایت"},
+        ]))
+        book = Book.objects.get()
+
+        path = self.writeFile('catalog.jsonl', "\n".join(json.dumps(row) for row in [
+            {'isbn': '978-964-312-001-1', 'price': 1500, 'authors': ["Jane Doe"]},
+            {'isbn': '9789643120028', 'title': "سه قطره خون", 'authors': "صادق هدایت"},
+        ]))
+        out, err = self.importCatalog(path)
+        self.assertIn("1 books created, 1 updated", out)
+
+        book.refresh_from_db()
+        self.assertEqual(book.title, "بوف کور")
+        self.assertEqual(book.price, 1500)
+        self.assertEqual([person.first_name for person in book.authors.all()], ["Jane"])
+        self.assertEqual(Book.objects.get(isbn='9789643120028').authors.get(), self.author)
+
+    def test_invalid_values_skipped(self):
+        importer = CatalogImporter(index=False)
+        stats = importer.run([
+            {'isbn': '1000001', 'title': "x" * 1025},
+            {'isbn': '1' * 21, 'title': "long isbn"},
+            {'isbn': '1000003', 'title': "negative count", 'count': -1},
+            {'isbn': '1000004', 'title': "full discount", 'discount': '1.5'},
+            {'isbn': '1000005', 'title': "long author", 'authors': ["a" * 121]},
+            {'isbn': '1000006', 'title': "long publisher", 'publisher': "p" * 121},
+            {'isbn': '1000007', 'title': "valid", 'count': 2, 'authors': ["Jane Doe"]},
+        ])
+
+        self.assertEqual(stats['skipped'], 6)
+        self.assertEqual([line for line, error in importer.errors], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(list(Book.objects.values_list('title', flat=True)), ["valid"])
+        self.assertEqual(set(importer.books), {'1000007'})
+        self.assertEqual(Person.objects.exclude(pk=self.author.pk).get().first_name, "Jane")
+        self.assertFalse(Publisher.objects.exists())
+
+    def test_empty_and_invalid_names(self):
+        path = self.writeFile('catalog.jsonl', "\n".join(json.dumps(row) for row in [
+            {'isbn': '111', 'title': "A", 'authors': ["Ali", ""]},
+            {'isbn': '112', 'title': "B", 'authors': ["Ali", 12]},
+            {'isbn': '113', 'title': "C", 'related_books': {'isbn': '111'}},
+        ]))
+        out, err = self.importCatalog(path)
+        self.assertIn("1 books created", out)
+        self.assertIn("row 2 skipped: authors is not a list of strings", err)
+        self.assertIn("row 3 skipped: related_books is not a list of strings", err)
+        self.assertEqual([person.first_name for person in Book.objects.get(isbn='111').authors.all()], ["Ali"])
+
+        out, err = self.importCatalog(self.writeCsv([
+            {'isbn': '114', 'title': "D", 'authors': "Ali|\u200c"},
+        ]))
+        self.assertIn("1 books created", out)
+        self.assertEqual([person.first_name for person in Book.objects.get(isbn='114').authors.all()], ["Ali"])
+
+    def test_reimport_unchanged(self):
+        rows = [{'isbn': '1000001', 'title': "book", 'publish_date': 1399, 'price': "1000", 'discount': 0.1}]
+        CatalogImporter(index=False).run(rows)
+
+        with CaptureQueriesContext(connection) as context:
+            CatalogImporter(index=False).run(rows)
+        self.assertFalse([query for query in context.captured_queries if query['sql'].startswith('UPDATE')])
+        self.assertEqual(Book.objects.get().publish_date, "1399")
+
+    def test_query_count(self):
+        def countQueries(n, offset):
+            importer = CatalogImporter(chunk_size=1000, index=False)
+            rows = [{'isbn': str(1000000 + offset + i), 'title': "book %d" % i, 'publisher': "publisher %d" % i,
+                     'authors': ["author %d" % i, "author"]} for i in range(n)]
+            with CaptureQueriesContext(connection) as context:
+                importer.run(rows)
+            return len(context.captured_queries)
+
+        self.assertEqual(countQueries(5, 0), countQueries(50, 100))
+
+
+class TestBookSearch(APITestCase):
+
+    def setUp(self) -> None:
+        publisher = Publisher.objects.create(name="نشر نی")
+        author = Person.objects.create(first_name="صادق", last_name="هدایت")
+
+        # arabic yeh and kaf
+        self.b1 = Book.objects.create(title="بوف كور", description="داستان", isbn="978-964-312-001-1",
+                                      publisher=publisher)
+        self.b1.authors.add(author)
+
+        self.b2 = Book.objects.create(title="Python Programming", description="a book about snakes")
+        self.b3 = Book.objects.create(title="Snakes of Iran", description="python")
+
+    def search(self, query):
+        response = self.client.get(reverse('books_search'), data={'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [book.get('pk') for book in json.loads(response.content).get('results')]
+
+    def test_persian_normalization(self):
+        self.assertEqual(self.search("بوف کور"), [self.b1.pk])
+        self.assertEqual(self.search("هدايت"), [self.b1.pk])
+        self.assertEqual(self.search("نی"), [self.b1.pk])
+
+    def test_isbn(self):
+        self.assertEqual(self.search("9789643120011"), [self.b1.pk])
+        self.assertEqual(self.search("978-964-312-001-1"), [self.b1.pk])
+
+    def test_ranking_and_prefix(self):
+        self.assertEqual(self.search("pyth"), [self.b2.pk, self.b3.pk])
+        self.assertEqual(self.search("snakes"), [self.b3.pk, self.b2.pk])
+        self.assertEqual(self.search("python iran"), [self.b3.pk])
+        self.assertEqual(self.search("missing"), [])
+
+    def test_index_updates(self):
+        author = Person.objects.create(first_name="George", last_name="Orwell")
+        self.b2.authors.add(author)
+        self.assertEqual(self.search("orwell"), [self.b2.pk])
+
+        author.last_name = "Blair"
+        author.save()
+        self.assertEqual(self.search("orwell"), [])
+        self.assertEqual(self.search("blair"), [self.b2.pk])
+
+        self.b2.title = "Animal Farm"
+        self.b2.save()
+        self.assertEqual(self.search("farm"), [self.b2.pk])
+
+    @skipUnless(connection.vendor == 'sqlite', "sqlite query plan")
+    def test_search_is_driven_by_the_terms(self):
+        plan = search_books(Book.objects.catalog(relations=[]), "pyth snakes").explain()
+
+        # the books are only read by the primary key of the matching terms
+        self.assertNotRegex(plan, r'\bSCAN( TABLE)? core_book\b')
+        self.assertRegex(plan, r'SEARCH( TABLE)? core_book USING INTEGER PRIMARY KEY')
+        self.assertRegex(plan, r'SEARCH( TABLE)? U0 USING (COVERING )?INDEX \w+ \(term>\? AND term<\?\)')
+
+
+class TestGateway(GatewayStubMixin, APITestCase):
+    gateway_stub_responses = {
+        '/broken': (500, {}),
+        '/slow': (200, {}),
+    }
+    gateway_options = {
+        'TIMEOUTS': {'slow': (1, 0.2)},
+        'FAILURE_THRESHOLD': 2,
+        'RESET_TIMEOUT': 60,
+    }
+
+    def setUp(self):
+        reset_clients()
+        self.gateway_stub.requests.clear()
+        self.gateway_stub.delay = 0
+        caches[settings.THROTTLE_CACHE].clear()
+
+    def test_keep_alive(self):
+        client = get_client('kavenegar')
+        client.get('lookup', '/v1/key/verify/lookup.json')
+        client.get('lookup', '/v1/key/verify/lookup.json')
+
+        # both requests are sent on the same connection
+        ports = [port for method, path, port in self.gateway_stub.requests]
+        self.assertEqual(len(ports), 2)
+        self.assertEqual(ports[0], ports[1])
+        self.assertEqual(get_metrics().get('kavenegar').get('endpoints').get('lookup').get('requests'), 2)
+
+    @override_settings(SMS_TRANSPORT='core.sms.KavenegarTransport')
+    def test_sms_through_the_stub(self):
+        self.client.post(reverse('send_code'), data={'phone_number': "09303131503"})
+        process_sms_queue()
+
+        self.assertEqual(UserProfilePhoneVerification.objects.get().sms_status, UserProfilePhoneVerification.SMS_SENT)
+        self.assertTrue(self.gateway_stub.requests[0][1].endswith('/verify/lookup.json'))
+
+    def test_read_timeout(self):
+        self.gateway_stub.delay = 0.5
+        client = get_client('vandar')
+
+        with self.assertRaises(GatewayError):
+            client.get('slow', '/slow')
+        self.assertEqual(client.get_metrics().get('endpoints').get('slow').get('failures'), 1)
+
+    def test_circuit_breaker(self):
+        client = get_client('vandar')
+
+        for _ in range(2):
+            with self.assertRaises(GatewayError):
+                client.post('broken', '/broken')
+
+        # the circuit is open, the gateway is not called anymore
+        with self.assertRaises(CircuitOpenError):
+            client.post('broken', '/broken')
+        self.assertEqual(len(self.gateway_stub.requests), 2)
+        self.assertEqual(client.get_metrics().get('endpoints').get('broken').get('rejected'), 1)
+
+    def test_half_open_circuit(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+        # a single trial request after the reset timeout
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertFalse(circuit_breaker.allow_request())
+
+        circuit_breaker.record_success()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(circuit_breaker.allow_request())
+
+    def test_unexpected_error_resolves_the_half_open_trial(self):
+        client = get_client('vandar')
+        # open since the reset timeout, the next request is the trial
+        client.circuit_breaker.state = CircuitBreaker.OPEN
+        client.circuit_breaker.opened_at = time.monotonic() - client.circuit_breaker.reset_timeout
+
+        with mock.patch.object(client.session, 'request', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                client.post('broken', '/broken')
+        self.assertEqual(client.circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_error_without_the_gateway_url(self):
+        client = get_client('kavenegar')
+        client.timeouts = {'lookup': (1, 0.2)}
+        self.gateway_stub.delay = 0.5
+
+        with self.assertRaises(GatewayError) as context:
+            client.get('lookup', '/v1/the-api-key/verify/lookup.json', params={'token': '1234'})
+        self.assertNotIn('the-api-key', str(context.exception))
+        self.assertNotIn('1234', str(context.exception))
+
+    def test_metrics_view(self):
+        get_client('vandar').post('slow', '/slow')
+
+        self.assertEqual(self.client.get(reverse('gateway_metrics')).status_code, 401)
+
+        self.client.force_authenticate(User.objects.create_superuser('admin', password='admin'))
+        response = self.client.get(reverse('gateway_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content).get('vandar').get('endpoints').get('slow').get('requests'), 1)
+
+
+class TestAsyncViews(GatewayStubMixin, APITestCase):
+
+    def setUp(self):
+        Config.clear_cache()
+        reset_clients()
+        caches[settings.THROTTLE_CACHE].clear()
+        seed_catalog(n_books=10, n_baskets=0)
+        self.benchmark = Benchmark(repeats=0)
+
+    def createInvoice(self):
+        return Invoice.objects.get(internal_id=self.benchmark.create_basket().data.get('invoice').get('internal_id'))
+
+    async def test_make_and_verify_payment(self):
+        invoice = await sync_to_async(self.createInvoice)()
+
+        response = await self.async_client.get(reverse('payment_make_async',
+                                                        kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content).get('redirect_to'),
+                         self.gateway_stub.base_url + '/v3/stub-token')
+
+        await sync_to_async(invoice.refresh_from_db)()
+        self.assertEqual(invoice.status, Invoice.IN_PAYMENT)
+
+        response = await self.async_client.get(reverse('payment_verify_async',
+                                                        kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content).get('status'), Invoice.PAYED)
+
+        # the same invoice cannot be payed twice
+        response = await self.async_client.get(reverse('payment_make_async',
+                                                        kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 400)
+        await close_async_clients()
+
+    async def test_payment_when_gateway_is_down(self):
+        invoice = await sync_to_async(self.createInvoice)()
+        circuit_breaker = get_client('vandar').circuit_breaker
+        for _ in range(circuit_breaker.failure_threshold):
+            circuit_breaker.record_failure()
+
+        response = await self.async_client.get(reverse('payment_make_async',
+                                                        kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(json.loads(response.content).get('status'), 503)
+
+        await sync_to_async(invoice.refresh_from_db)()
+        self.assertEqual(invoice.status, Invoice.CREATED)
+
+    async def test_send_code(self):
+        response = await self.async_client.post(reverse('send_code_async'), data={'phone_number': "09303131503"},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content).get('sms_status'), UserProfilePhoneVerification.SMS_QUEUED)
+
+        # only one code at a time
+        response = await self.async_client.post(reverse('send_code_async'), data={'phone_number': "09303131503"},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = await self.async_client.post(reverse('send_code_async'), data={'phone_number': "123"},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('phone_number', json.loads(response.content))
+
+    @override_settings(OTP_THROTTLE_RATES={'phone': '1/hour', 'ip': None, 'global': None})
+    async def test_send_code_throttled(self):
+        response = await self.async_client.post(reverse('send_code_async'), data={'phone_number': "09303131503"},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+        response = await self.async_client.post(reverse('send_code_async'), data={'phone_number': "09303131503"},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+
+
+class TestReconcileInvoices(GatewayStubMixin, APITestCase):
+
+    def setUp(self):
+        Config.clear_cache()
+        reset_clients()
+        self.gateway_stub.responses = dict(GatewayStub.default_responses)
+        self.gateway_stub.requests.clear()
+        seed_catalog(n_books=10, n_baskets=0)
+        self.benchmark = Benchmark(repeats=0)
+
+    def createInvoice(self, status, expired=True):
+        invoice = Invoice.objects.get(internal_id=self.benchmark.create_basket().data.get('invoice').get('internal_id'))
+        last_try_datetime = timezone.now()
+        if expired:
+            last_try_datetime -= datetime.timedelta(minutes=PAYMENT_BUFFER_TIME + 5)
+
+        # like an abandoned payment, the reservation is left as it is
+        Invoice.objects.filter(pk=invoice.pk).update(status=status, payment_token="token-%d" % invoice.pk,
+                                                     last_try_datetime=last_try_datetime)
+        invoice.refresh_from_db()
+        return invoice
+
+    def reconcileInvoices(self):
+        out = io.StringIO()
+        call_command('reconcile_invoices', '--rate', '0', stdout=out)
+        return out.getvalue()
+
+    def test_reconcile_invoices(self):
+        payed = self.createInvoice(Invoice.IN_PAYMENT)
+        rejected = self.createInvoice(Invoice.CREATED)
+        in_payment = self.createInvoice(Invoice.IN_PAYMENT, expired=False)
+
+        self.assertIn("1 payed, 1 rejected, 0 left", self.reconcileInvoices())
+
+        for invoice, status, stock_status in [
+            (payed, Invoice.PAYED, Invoice.STOCK_SOLD),
+            (rejected, Invoice.REJECTED, Invoice.STOCK_NONE),
+            (in_payment, Invoice.IN_PAYMENT, Invoice.STOCK_RESERVED),
+        ]:
+            invoice.refresh_from_db()
+            self.assertEqual(invoice.status, status)
+            self.assertEqual(invoice.stock_status, stock_status)
+
+        # the stock ledger matches the invoices
+        reserved = Item.objects.filter(basket__invoice=in_payment).aggregate(total=Sum('count')).get('total')
+        sold = Item.objects.filter(basket__invoice=payed).aggregate(total=Sum('count')).get('total')
+        totals = Book.objects.aggregate(reserved=Sum('reserved_count'), sold=Sum('sold_count'))
+        self.assertEqual(totals.get('reserved'), reserved)
+        self.assertEqual(totals.get('sold'), sold)
+
+        # verification requests are only sent for the expired in payment invoices
+        self.assertEqual(len(self.gateway_stub.requests), 1)
+
+    def test_rejected_payment(self):
+        self.gateway_stub.responses['/api/v3/verify'] = (200, {'status': 0, 'errors': ["not payed"]})
+        invoice = self.createInvoice(Invoice.IN_PAYMENT)
+
+        self.reconcileInvoices()
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, Invoice.REJECTED)
+        self.assertEqual(invoice.stock_status, Invoice.STOCK_NONE)
+
+    def test_gateway_failure(self):
+        self.gateway_stub.responses['/api/v3/verify'] = (500, {})
+        invoice = self.createInvoice(Invoice.IN_PAYMENT)
+
+        # left for the next run
+        self.assertIn("0 payed, 0 rejected, 1 left", self.reconcileInvoices())
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, Invoice.IN_PAYMENT)
+
+
+class TestPaymentVerification(GatewayStubMixin, APITestCase):
+
+    def setUp(self):
+        Config.clear_cache()
+        reset_clients()
+        self.gateway_stub.requests.clear()
+        seed_catalog(n_books=10, n_baskets=0)
+        self.benchmark = Benchmark(repeats=0)
+
+    def createInvoiceInPayment(self):
+        internal_id = self.benchmark.create_basket().data.get('invoice').get('internal_id')
+        self.client.get(reverse('payment_make', kwargs={'internal_id': internal_id}))
+        return Invoice.objects.get(internal_id=internal_id)
+
+    def verifyRequests(self):
+        return [path for method, path, port in self.gateway_stub.requests if path == '/api/v3/verify']
+
+    @mock.patch('core.views.DEBUG', False)
+    def test_duplicate_callbacks(self):
+        invoice = self.createInvoiceInPayment()
+        verify_endpoint = reverse('payment_verify', kwargs={'internal_id': invoice.internal_id})
+
+        response = self.client.get(verify_endpoint)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('status'), Invoice.PAYED)
+
+        # retries are answered from the database
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(verify_endpoint)
+        self.assertEqual(response.data.get('status'), Invoice.PAYED)
+        self.assertLessEqual(len(context.captured_queries), 3)
+
+        self.client.get(reverse('payment_verify_and_redirect', kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(len(self.verifyRequests()), 1)
+
+    @mock.patch('core.views.DEBUG', False)
+    def test_verification_waits_for_the_in_flight_one(self):
+        invoice = self.createInvoiceInPayment()
+        verify_endpoint = reverse('payment_verify', kwargs={'internal_id': invoice.internal_id})
+
+        # the first callback, in another process, holds the lock and verifies the invoice meanwhile
+        lock = VerifyPaymentView.verification_lock
+        token = lock.acquire(str(invoice.internal_id), 60)
+        is_held = lock.is_held
+
+        def verify_meanwhile(key):
+            Invoice.objects.filter(pk=invoice.pk).update(status=Invoice.PAYED)
+            lock.release(key, token)
+            return is_held(key)
+
+        with mock.patch.object(lock, 'is_held', verify_meanwhile):
+            response = self.client.get(verify_endpoint)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.get('status'), Invoice.PAYED)
+        self.assertEqual(self.verifyRequests(), [])
+
+    @mock.patch('core.views.DEBUG', False)
+    @override_settings(VERIFICATION_WAIT=0)
+    def test_verification_in_flight_in_another_process(self):
+        invoice = self.createInvoiceInPayment()
+        lock = VerifyPaymentView.verification_lock
+        token = lock.acquire(str(invoice.internal_id), 60)
+        self.addCleanup(lock.release, str(invoice.internal_id), token)
+
+        response = self.client.get(reverse('payment_verify', kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 503)
+        response = self.client.get(reverse('payment_verify_async', kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.verifyRequests(), [])
+
+    @mock.patch('core.views.DEBUG', False)
+    def test_no_lock_is_held_while_calling_vandar(self):
+        invoice = self.createInvoiceInPayment()
+        client = get_client('vandar')
+        savepoints = len(connection.savepoint_ids)
+        post_json = client.post_json
+
+        def check_savepoints(*args, **kwargs):
+            self.assertEqual(len(connection.savepoint_ids), savepoints)
+            return post_json(*args, **kwargs)
+
+        with mock.patch.object(client, 'post_json', check_savepoints):
+            response = self.client.get(reverse('payment_verify', kwargs={'internal_id': invoice.internal_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.verifyRequests()), 1)
+
+    def test_success_wins_over_a_concurrent_rejection(self):
+        invoice = self.createInvoiceInPayment()
+        Invoice.objects.filter(pk=invoice.pk).update(status=Invoice.REJECTED)
+
+        self.assertTrue(apply_verification_result(invoice, {'status': 1, 'transId': 1, 'cardNumber': '6037'}))
+        # a late rejection does not override the payment
+        apply_verification_result(invoice, {'status': 0})
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, Invoice.PAYED)
+
+    def test_shared_key_lock(self):
+        key_lock = SharedKeyLock('test')
+
+        with key_lock("a", 60) as acquired:
+            self.assertTrue(acquired)
+            with key_lock("a", 60) as acquired_again:
+                self.assertFalse(acquired_again)
+            self.assertTrue(key_lock.is_held("a"))
+            self.assertFalse(key_lock.wait("a", 0))
+        self.assertTrue(key_lock.wait("a", 0))
+
+        # an expired key acquired again is not released by its previous holder
+        token = key_lock.acquire("a", 60)
+        key_lock.release("a", "expired token")
+        self.assertTrue(key_lock.is_held("a"))
+        key_lock.release("a", token)
+        self.assertFalse(key_lock.is_held("a"))
+
+
+class TestFulfillmentExport(APITestCase):
+
+    def setUp(self) -> None:
+        seed_catalog(n_books=2, n_baskets=0)
+        self.books = list(Book.objects.order_by('pk'))
+        self.user_profile = create_user_profile("09303131503", "09303131503")
+        self.user_profile.first_name = "Sina"
+        self.user_profile.city = "Tehran"
+        self.user_profile.save()
+
+        self.first = self.createBasket(Invoice.PAYED, counts=[2, 1])
+        self.second = self.createBasket(Invoice.PAYED, counts=[3])
+        self.createBasket(Invoice.PAYED, counts=[1], status=Basket.DONE)
+        self.createBasket(Invoice.REJECTED, counts=[1])
+
+    def createBasket(self, invoice_status, counts, status=Basket.PENDING):
+        invoice = Invoice.objects.create(amount=0, delivery_fee=0, status=invoice_status)
+        basket = Basket.objects.create(user_profile=self.user_profile, invoice=invoice, status=status)
+        Item.objects.bulk_create([Item(basket=basket, book=book, count=count, price=1000)
+                                  for book, count in zip(self.books, counts)])
+        return basket
+
+    def readCsv(self, content):
+        return list(csv.reader(io.StringIO(content.lstrip('\ufeff'))))
+
+    def test_rows(self):
+        with self.assertNumQueries(1):
+            rows = list(get_fulfillment_rows(chunk_size=1))
+
+        self.assertEqual(rows[0], EXPORT_HEADER)
+        self.assertEqual([row[0] for row in rows[1:]], [self.first.pk, self.second.pk])
+
+        first = dict(zip(EXPORT_HEADER, rows[1]))
+        self.assertEqual(first.get('invoice'), str(self.first.invoice.internal_id))
+        self.assertEqual(first.get('first name'), "Sina")
+        self.assertEqual(first.get('city'), "Tehran")
+        self.assertEqual(first.get('items'), "%s x 2 | %s x 1" % (self.books[0].title, self.books[1].title))
+        self.assertEqual(first.get('count'), 3)
+
+    def test_formulas_are_escaped(self):
+        self.user_profile.first_name = "=HYPERLINK(\"http://example.com\")"
+        self.user_profile.address = "@SUM(1+1)"
+        self.user_profile.save()
+        Book.objects.filter(pk=self.books[0].pk).update(title="+cmd")
+
+        first = dict(zip(EXPORT_HEADER, list(get_fulfillment_rows())[1]))
+        self.assertEqual(first.get('first name'), "'=HYPERLINK(\"http://example.com\")")
+        self.assertEqual(first.get('address'), "'@SUM(1+1)")
+        self.assertEqual(first.get('items'), "'+cmd x 2 | %s x 1" % self.books[1].title)
+        self.assertEqual(first.get('city'), "Tehran")
+
+    def test_admin_action(self):
+        admin = User.objects.create_superuser('admin', password='admin')
+        self.client.force_login(admin)
+
+        response = self.client.post(reverse('admin:core_basket_changelist'), data={
+            'action': 'export_fulfillment_csv',
+            '_selected_action': [self.second.pk, self.second.pk + 1],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment', response['Content-Disposition'])
+
+        rows = self.readCsv(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.second.pk)])
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_fulfillment', stdout=out)
+        rows = self.readCsv(out.getvalue())
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.first.pk), str(self.second.pk)])
+
+    @skipUnless(openpyxl, "openpyxl is not installed")
+    def test_xlsx(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'fulfillment.xlsx')
+            call_command('export_fulfillment', format='xlsx', output=output)
+            rows = list(openpyxl.load_workbook(output).active.values)
+
+        self.assertEqual(list(rows[0]), EXPORT_HEADER)
+        self.assertEqual([row[0] for row in rows[1:]], [self.first.pk, self.second.pk])
+
+    def test_xlsx_without_openpyxl(self):
+        with mock.patch('core.export.openpyxl', None), self.assertRaises(CommandError):
+            call_command('export_fulfillment', format='xlsx', output=os.devnull)
+
+
+class TestBookAdmin(APITestCase):
+
+    def setUp(self) -> None:
+        admin = User.objects.create_superuser('admin', password='admin')
+        self.client.force_login(admin)
+
+    def createBook(self, title, count, sold_count=0, reserved_count=0):
+        return Book.objects.create(title=title, price=1000, count=count,
+                                   sold_count=sold_count, reserved_count=reserved_count)
+
+    def getChangelist(self, **params):
+        response = self.client.get(reverse('admin:core_book_changelist'), data=params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def test_query_count(self):
+        self.createBook("one", count=10)
+        with CaptureQueriesContext(connection) as context:
+            self.getChangelist()
+
+        for i in range(20):
+            self.createBook("book %d" % i, count=10, sold_count=2, reserved_count=1)
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.getChangelist()
+
+    def test_stock_columns(self):
+        self.createBook("low", count=10, sold_count=4, reserved_count=3)
+        self.createBook("out", count=5, sold_count=5)
+        self.createBook("plenty", count=100, sold_count=1)
+
+        cl = self.getChangelist()
+        remaining = cl.list_display.index('remaining')
+        self.assertEqual([book.title for book in self.getChangelist(o=remaining).result_list],
+                         ["out", "low", "plenty"])
+        self.assertEqual([book.title for book in self.getChangelist(o='-%d' % remaining).result_list],
+                         ["plenty", "low", "out"])
+
+        self.assertEqual([book.title for book in self.getChangelist(stock='out').result_list], ["out"])
+        self.assertEqual([book.title for book in self.getChangelist(stock='low').result_list], ["low"])
+        self.assertEqual(sorted(book.title for book in self.getChangelist(stock='in').result_list),
+                         ["low", "plenty"])
+
+        book = Book.objects.with_stock().get(title="low")
+        self.assertEqual(book.remaining_amount, book.remaining)
+
+
+class TestBasketAdmin(APITestCase):
+
+    def setUp(self) -> None:
+        seed_catalog(n_books=5, n_baskets=0)
+        self.book_ids = list(Book.objects.values_list('pk', flat=True))
+        self.user_profile = create_user_profile("09303131503", "09303131503")
+        self.user_profile.first_name = "Sina"
+        self.user_profile.save()
+
+        admin = User.objects.create_superuser('admin', password='admin')
+        self.client.force_login(admin)
+
+    def createBaskets(self, n):
+        for _ in range(n):
+            basket = Basket.objects.create(user_profile=self.user_profile, invoice=Invoice.objects.create(amount=0, delivery_fee=0))
+            Item.objects.bulk_create([Item(basket=basket, book_id=book_id, count=2, price=1000, discount=0.15)
+                                      for book_id in self.book_ids[:3]])
+
+    def getChangelistQueryCount(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:core_basket_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def test_changelist_query_count(self):
+        self.createBaskets(2)
+        response, query_count = self.getChangelistQueryCount()
+
+        self.createBaskets(20)
+        response, more_baskets_query_count = self.getChangelistQueryCount()
+
+        self.assertEqual(query_count, more_baskets_query_count)
+        self.assertLessEqual(query_count, 10)
+        self.assertContains(response, "Sina")
+
+    def test_subtotal(self):
+        self.createBaskets(1)
+        basket = Basket.objects.with_subtotal().get()
+        self.assertEqual(basket.subtotal_amount, basket.subtotal)
+        self.assertEqual(basket.subtotal_amount, 3 * 2 * 850)
+
+        empty_basket = Basket.objects.create(user_profile=self.user_profile, invoice=Invoice.objects.create(amount=0, delivery_fee=0))
+        self.assertEqual(Basket.objects.with_subtotal().get(pk=empty_basket.pk).subtotal_amount, 0)
+
+    def test_subtotal_of_searched_baskets(self):
+        Book.objects.filter(pk__in=self.book_ids[:3]).update(title="alpha")
+        self.createBaskets(1)
+
+        # the search joins the items again
+        response = self.client.get(reverse('admin:core_basket_changelist'), data={'q': "alpha"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([basket.subtotal_amount for basket in response.context['cl'].result_list], [3 * 2 * 850])
+
+
+class TestExplainQueries(APITestCase):
+
+    def test_hot_queries_use_indexes(self):
+        call_command('explain_queries', '--check', stdout=io.StringIO())
+
+    def test_full_scan_detection(self):
+        is_full_scan = ExplainQueriesCommand.is_full_scan
+
+        self.assertTrue(is_full_scan('3 0 0 SCAN core_book', 'core_book'))
+        self.assertTrue(is_full_scan('Seq Scan on core_book  (cost=0.00..1.01 rows=1 width=4)', 'core_book'))
+        self.assertFalse(is_full_scan('3 0 0 SCAN core_book USING INDEX book_not_deleted_idx', 'core_book'))
+        self.assertFalse(is_full_scan('Index Scan using book_not_deleted_idx on core_book', 'core_book'))
+
+
+class TestBenchmark(APITestCase):
+
+    def setUp(self):
+        Config.clear_cache()
+
+    def test_benchmark_report(self):
+        seed_catalog(n_books=30, n_baskets=10)
+        report = Benchmark(repeats=2).run()
+
+        for endpoint, result in report.items():
+            self.assertEqual(result.get('requests'), 2)
+            if endpoint == 'basket_create_underflow':
+                self.assertEqual(result.get('status_codes'), [400])
+            else:
+                self.assertTrue(all(200 <= status < 300 for status in result.get('status_codes')), endpoint)
+            self.assertGreater(result.get('latency_ms').get('max'), 0)
+
+
+class TestPaymentLoadTest(TransactionTestCase):
+    """
+    the sync workers are threads with their own database connections, they only see committed rows
+    """
+
+    def setUp(self):
+        Config.clear_cache()
+
+    def test_payment_load_test(self):
+        seed_catalog(n_books=10, n_baskets=0)
+        report = PaymentLoadTest(requests=4, concurrency=3, workers=2, gateway_delay=0.2).run()
+
+        self.assertEqual(report.get('sync').get('redirects'), 4)
+        self.assertEqual(report.get('async').get('redirects'), 4)
+        # the two workers wait for the gateway at the same time
+        self.assertLess(report.get('sync').get('seconds'), 4 * 0.2)
+
 
 class TestConfig(APITestCase):
 
     def setUp(self) -> None:
+        Config.clear_cache()
         config = Config.get_instance()
         config.delivery_fee = 1400
         config.save()
@@ -606,3 +2319,52 @@ class TestConfig(APITestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.content).get('delivery_fee'), self.config.delivery_fee)
+
+    def test_cached_config(self):
+        get_config_endpoint = reverse('get_config')
+        self.client.get(get_config_endpoint)
+
+        # the config is served by this process without queries
+        with self.assertNumQueries(0):
+            response = self.client.get(get_config_endpoint)
+        self.assertEqual(json.loads(response.content).get('delivery_fee'), 1400)
+
+        # changes of the returned copies are not cached
+        config = Config.get_instance()
+        config.delivery_fee = 0
+        self.assertEqual(Config.get_instance().delivery_fee, 1400)
+
+    def test_save_invalidates_config(self):
+        config = Config.get_instance()
+        config.delivery_fee = 2000
+
+        with CaptureQueriesContext(connection) as context:
+            config.save()
+        # the singleton only deletes the other rows when it is created
+        self.assertFalse(any('DELETE' in query.get('sql') for query in context.captured_queries))
+
+        self.assertEqual(Config.get_instance().delivery_fee, 2000)
+        self.assertEqual(Config.objects.count(), 1)
+
+    def test_config_changed_by_another_process(self):
+        Config.get_instance()
+
+        # another process saves the config, it bumps the shared version
+        Config.objects.update(delivery_fee=3000)
+        bump_config_version()
+
+        # seen after the check interval
+        self.assertEqual(Config.get_instance().delivery_fee, 1400)
+        with override_settings(CONFIG_CHECK_INTERVAL=0):
+            self.assertEqual(Config.get_instance().delivery_fee, 3000)
+
+    def test_config_reloaded_after_max_age(self):
+        Config.get_instance()
+
+        # the version was not shared with this process (process local cache)
+        Config.objects.update(delivery_fee=3000)
+
+        with override_settings(CONFIG_CHECK_INTERVAL=0):
+            self.assertEqual(Config.get_instance().delivery_fee, 1400)
+            with override_settings(CONFIG_MAX_AGE=0):
+                self.assertEqual(Config.get_instance().delivery_fee, 3000)
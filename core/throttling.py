@@ -0,0 +1,153 @@
+"""
+Rate limits of the one time password endpoints (send code and get info)
+
+checked by the views before any database or sms work, per phone number, per ip and globally,
+the rates are settings.OTP_THROTTLE_RATES and the counters are kept in settings.THROTTLE_CACHE
+"""
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import SimpleRateThrottle
+
+STATS_KEY = 'throttle:stats:%s:%s'
+
+
+class OTPRateThrottle(SimpleRateThrottle):
+    """
+    sliding window rate limit, the requests of the current and the previous fixed windows are counted
+    with atomic cache increments and the previous window is weighted by its part still in the sliding window
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.THROTTLE_CACHE]
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.now = None
+
+    def get_rate(self):
+        # read on every request, so the rates can be changed by the settings
+        return settings.OTP_THROTTLE_RATES.get(self.scope)
+
+    def get_ident_of(self, request):
+        raise NotImplementedError
+
+    def get_cache_key(self, request, view):
+        ident = self.get_ident_of(request)
+        if not ident:
+            return None
+        return 'throttle:%s:%s' % (self.scope, ident)
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        window = int(self.now // self.duration)
+        current_key = '%s:%d' % (self.key, window)
+
+        counts = self.cache.get_many(['%s:%d' % (self.key, window - 1), current_key])
+        previous_weight = 1 - (self.now % self.duration) / self.duration
+        estimated = counts.get('%s:%d' % (self.key, window - 1), 0) * previous_weight + counts.get(current_key, 0)
+
+        if estimated >= self.num_requests:
+            record(self.cache, self.scope, 'rejected')
+            return False
+
+        self.cache.add(current_key, 0, timeout=2 * self.duration)
+        try:
+            self.cache.incr(current_key)
+        except ValueError:
+            # expired meanwhile
+            self.cache.set(current_key, 1, timeout=2 * self.duration)
+
+        record(self.cache, self.scope, 'allowed')
+        return True
+
+    def wait(self):
+        # at the latest, the current window becomes the weighted previous one
+        return self.duration - self.now % self.duration
+
+
+class PhoneNumberRateThrottle(OTPRateThrottle):
+    scope = 'phone'
+
+    def get_ident_of(self, request):
+        digits = re.sub(r'\D', '', str(request.data.get('phone_number') or ''))
+        # 0912..., 98912... and +98912... are the same phone number
+        return digits[-10:] or None
+
+
+class IPRateThrottle(OTPRateThrottle):
+    """
+    X-Forwarded-For is only trusted for settings.REST_FRAMEWORK['NUM_PROXIES'] proxies,
+    the client address otherwise, so the limit cannot be bypassed by forged headers
+    """
+    scope = 'ip'
+
+    def get_ident_of(self, request):
+        return self.get_ident(request)
+
+
+class GlobalRateThrottle(OTPRateThrottle):
+    scope = 'global'
+
+    def get_ident_of(self, request):
+        return 'all'
+
+
+OTP_THROTTLE_CLASSES = [GlobalRateThrottle, IPRateThrottle, PhoneNumberRateThrottle]
+
+
+class OTPThrottleMixin:
+    """
+    the otp throttles of a rest framework view, checked in order up to the first rejecting one,
+    so a rejected request is not counted by the following throttles
+    """
+    throttle_classes = OTP_THROTTLE_CLASSES
+
+    def check_throttles(self, request):
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                self.throttled(request, throttle.wait())
+
+
+def record(cache, scope, result):
+    key = STATS_KEY % (scope, result)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def get_throttle_stats():
+    """
+    :return: {scope: {'allowed': count, 'rejected': count}} since the cache was cleared
+    """
+    cache = caches[settings.THROTTLE_CACHE]
+    scopes = [throttle.scope for throttle in OTP_THROTTLE_CLASSES]
+    keys = [STATS_KEY % (scope, result) for scope in scopes for result in ['allowed', 'rejected']]
+    counts = cache.get_many(keys)
+
+    return {scope: {
+        result: counts.get(STATS_KEY % (scope, result), 0) for result in ['allowed', 'rejected']
+    } for scope in scopes}
+
+
+def get_throttle_wait(request):
+    """
+    check the otp throttles outside of the rest framework views
+
+    :param request: rest framework request
+    :return: seconds to wait, None if the request is allowed
+    """
+    for throttle_class in OTP_THROTTLE_CLASSES:
+        throttle = throttle_class()
+        if not throttle.allow_request(request, None):
+            return throttle.wait()
+    return None
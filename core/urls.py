@@ -1,7 +1,10 @@
 from django.urls import path
 from .views import BookRetrieveView, BookListView, \
     BasketCreateView, MakePaymentView, UserProfileSendCode, GetUserInfoView, UserProfileRUView, VerifyPaymentView, \
-    GetConfigView, VerifyPaymentAndRedirectView
+    GetConfigView, VerifyPaymentAndRedirectView, BookSearchView, ThrottleStatsView, \
+    GatewayMetricsView
+
+from . import async_views
 
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
@@ -28,6 +31,7 @@ urlpatterns = [
     # book
     path('book/<int:book_id>/', BookRetrieveView.as_view(), name="book_detail"),
     path('book/list/', BookListView.as_view(), name="books_list"),
+    path('book/search/', BookSearchView.as_view(), name="books_search"),
 
     # basket
     path('basket/create/', BasketCreateView.as_view(), name="basket_create"),
@@ -41,6 +45,16 @@ urlpatterns = [
     # config
     path('config/', GetConfigView.as_view(), name="get_config"),
 
+    # monitoring
+    path('throttle/stats/', ThrottleStatsView.as_view(), name="throttle_stats"),
+    path('gateway/metrics/', GatewayMetricsView.as_view(), name="gateway_metrics"),
+
+
+    # async views, for ASGI servers
+    path('async/user-profile/send/code/', async_views.send_code, name="send_code_async"),
+    path('async/payment/make/<internal_id>/', async_views.make_payment, name="payment_make_async"),
+    path('async/payment/verify/<internal_id>/', async_views.verify_payment, name="payment_verify_async"),
+
 
     # docs
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
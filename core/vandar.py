@@ -1,12 +1,13 @@
-import json
 import math
 
-import requests
+from asgiref.sync import sync_to_async
+from django.db import transaction
 from django.urls import reverse
 from django.utils import timezone
 
 from BookStore.secret import VANDAR_API_KEY
 from BookStore.settings import DEBUG
+from core.gateway import get_client, get_async_client, GatewayError
 from core.models import Invoice
 
 
@@ -22,6 +23,36 @@ def vandar_prepare_for_payment(invoice, request):
     if not invoice.basket.is_valid_for_payment:
         return {'status': 400, 'details': ["Invalid Invoice", ]}
 
+    vandar = get_client('vandar')
+    try:
+        result_data = vandar.post_json('send', '/api/v3/send', data=get_payment_data(invoice, request))
+    except GatewayError:
+        return {'details': ["Payment gateway is not available", ], 'status': 503}
+
+    return handle_payment_result(invoice, result_data, vandar)
+
+
+async def vandar_prepare_for_payment_async(invoice, request):
+    """
+    vandar_prepare_for_payment of the async views, the database work runs in a thread
+    """
+
+    # validate invoice
+    if not await sync_to_async(lambda: invoice.basket.is_valid_for_payment)():
+        return {'status': 400, 'details': ["Invalid Invoice", ]}
+
+    data = await sync_to_async(get_payment_data)(invoice, request)
+
+    vandar = get_async_client('vandar')
+    try:
+        result_data = await vandar.post_json('send', '/api/v3/send', data=data)
+    except GatewayError:
+        return {'details': ["Payment gateway is not available", ], 'status': 503}
+
+    return await sync_to_async(handle_payment_result)(invoice, result_data, vandar.client)
+
+
+def get_payment_data(invoice, request):
     # generate callback url
 
     callback = request.build_absolute_uri(
@@ -32,17 +63,14 @@ def vandar_prepare_for_payment(invoice, request):
     if DEBUG:
         callback = "https://abee.ir/"
 
-    result = requests.post(
-        'https://ipg.vandar.io/api/v3/send',
-        data={
-            'api_key': VANDAR_API_KEY,
-            'amount': math.ceil(invoice.total_payable_amount) * 10,
-            'callback_url': callback
-        }
-    )
+    return {
+        'api_key': VANDAR_API_KEY,
+        'amount': math.ceil(invoice.total_payable_amount) * 10,
+        'callback_url': callback
+    }
 
-    result_data = json.loads(result.text)
 
+def handle_payment_result(invoice, result_data, vandar):
     if result_data['status'] != 1:
         return {'details': result_data['errors'], 'status': 503}
 
@@ -51,21 +79,55 @@ def vandar_prepare_for_payment(invoice, request):
     invoice.status = Invoice.IN_PAYMENT
     invoice.save()
 
-    return {'redirect_to': 'https://ipg.vandar.io/v3/%s' % result_data['token'], 'status': 200}
+    return {'redirect_to': vandar.url('/v3/%s' % result_data['token']), 'status': 200}
 
 
 def vandar_verify_payment(invoice):
-    """Check payment verification"""
-
-    result = requests.post(
-        url="https://ipg.vandar.io/api/v3/verify",
-        data={
-            "api_key": VANDAR_API_KEY,
-            "token": invoice.payment_token
-        }
-    )
-    result = json.loads(result.text)
+    """
+    Check payment verification
+
+    :raise GatewayError: when vandar is not available, the invoice is left unchanged
+    """
+
+    result = get_client('vandar').post_json('verify', '/api/v3/verify', data=get_verification_data(invoice))
+    return apply_verification_result(invoice, result)
+
+
+async def vandar_verify_payment_async(invoice):
+    """
+    vandar_verify_payment of the async views
+
+    :raise GatewayError: when vandar is not available, the invoice is left unchanged
+    """
+
+    result = await get_async_client('vandar').post_json('verify', '/api/v3/verify',
+                                                        data=get_verification_data(invoice))
+    return await sync_to_async(apply_verification_result)(invoice, result)
+
+
+def get_verification_data(invoice):
+    return {
+        "api_key": VANDAR_API_KEY,
+        "token": invoice.payment_token
+    }
+
+
+def apply_verification_result(invoice, result):
+    """
+    handle_verification_result under the invoice row lock,
+    the result is dropped if another verification finished first,
+    unless it is a successful payment and the other one rejected the invoice
+    """
+    with transaction.atomic():
+        status = Invoice.objects.select_for_update().values_list('status', flat=True).get(pk=invoice.pk)
+        if status != Invoice.IN_PAYMENT and not (status == Invoice.REJECTED and result.get('status') == 1):
+            invoice.refresh_from_db()
+            return invoice.status == Invoice.PAYED
+
+        return handle_verification_result(invoice, result)
+
 
+def handle_verification_result(invoice, result):
     """
     sample_result = {
         "status": 1,
@@ -1,23 +1,33 @@
 import json
 
 import furl
+from django.conf import settings
+from django.db.models import F, Case, When, Value
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
-from rest_framework import generics, filters
+from rest_framework import generics, filters, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from BookStore.settings import DEBUG
 from .serializers import UserProfileSerializer, BookSerializer, BasketCreate, SendCodeSerializer, GetUserInfoSerializer, \
-    InvoiceDetailedSerializer, ConfigSerializer
-from .models import UserProfile, Book, Invoice, UserProfilePhoneVerification, Config
+    InvoiceDetailedSerializer, ConfigSerializer, BookCompactSerializer
+from .models import UserProfile, Book, Invoice, UserProfilePhoneVerification, Config, BookQuerySet, \
+    release_expired_reservations, release_expired_reservations_if_due
+from .cache import CatalogCacheMixin
+from .filters import BookFilter, get_book_facets
+from .pagination import BookPageNumberPagination, BookCursorPagination
 from .permissions import IsLoggedIn
+from .search import search_books
+from .throttling import OTPThrottleMixin, get_throttle_stats
 from django.utils.translation import gettext as _
 
+from .gateway import GatewayError, get_metrics
+from .helpers import SharedKeyLock
 from .vandar import vandar_prepare_for_payment, vandar_verify_payment
 
 
-class UserProfileSendCode(generics.CreateAPIView):
+class UserProfileSendCode(OTPThrottleMixin, generics.CreateAPIView):
     serializer_class = SendCodeSerializer
 
 
@@ -29,7 +39,7 @@ class UserProfileRUView(generics.RetrieveUpdateAPIView):
         return self.request.user.user_profile
 
 
-class GetUserInfoView(generics.GenericAPIView):
+class GetUserInfoView(OTPThrottleMixin, generics.GenericAPIView):
     serializer_class = GetUserInfoSerializer
 
     def post(self, request, *args, **kwargs):
@@ -42,7 +52,8 @@ class GetUserInfoView(generics.GenericAPIView):
         if not self.is_code_correct(serializer, vo):
             return self.handle_wrong_code_and_return_response(vo)
 
-        self.use_the_code(vo)
+        if not self.use_the_code(vo):
+            return Response({'phone_number': _("Phone number not found")}, status=400)
         return Response(UserProfileSerializer(instance=user_profile).data)
 
     def handle_wrong_code_and_return_response(self, vo):
@@ -51,8 +62,15 @@ class GetUserInfoView(generics.GenericAPIView):
 
     @staticmethod
     def use_the_code(vo):
+        """
+        a conditional update of the used flag only, the counters and the sms fields
+        of this instance might be stale
+
+        :return: False if the code was used or burnt by a parallel request
+        """
+        used = UserProfilePhoneVerification.objects.filter(pk=vo.pk, used=False, burnt=False).update(used=True)
         vo.used = True
-        vo.save()
+        return bool(used)
 
     @staticmethod
     def is_code_correct(serializer, vo):
@@ -65,17 +83,24 @@ class GetUserInfoView(generics.GenericAPIView):
 
     @staticmethod
     def handle_wrong_code_and_get_remaining_query_times(vo):
-        # todo: anti concurrency
-        vo.query_times += 1
-        GetUserInfoView.burn_the_vo_if_maxed_out(vo)
-        vo.save()
-        remaining_query_times = UserProfilePhoneVerification.MAX_QUERY - vo.query_times
-        return remaining_query_times
-
-    @staticmethod
-    def burn_the_vo_if_maxed_out(vo):
-        if vo.query_times == UserProfilePhoneVerification.MAX_QUERY:
-            vo.burnt = True
+        """
+        counts the wrong code and burns the code at MAX_QUERY in a single conditional update,
+        parallel guesses can not go past MAX_QUERY
+        """
+        max_query = UserProfilePhoneVerification.MAX_QUERY
+        counted = UserProfilePhoneVerification.objects.filter(
+            pk=vo.pk, used=False, burnt=False, query_times__lt=max_query
+        ).update(
+            query_times=F('query_times') + 1,
+            burnt=Case(When(query_times__gte=max_query - 1, then=Value(True)), default=F('burnt')),
+        )
+
+        if not counted:
+            # burnt or used by a parallel request
+            return 0
+
+        vo.refresh_from_db(fields=['query_times', 'burnt'])
+        return max(max_query - vo.query_times, 0)
 
     def get_user_profile(self, request):
         serializer = self.serializer_class(data=request.data)
@@ -84,25 +109,107 @@ class GetUserInfoView(generics.GenericAPIView):
         return serializer, user_profile
 
 
-class BookRetrieveView(generics.RetrieveAPIView):
-    serializer_class = BookSerializer
-    queryset = Book.objects.filter(is_delete=False)
+class BookCatalogMixin:
+    """
+    Book views with sparse fieldsets (fields and expand query params, see SparseFieldsMixin)
+    compact=true selects the compact representation
+    only the relations of the serialized fields are fetched
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # before the cached responses are looked up, so the released books are shown in stock
+        release_expired_reservations_if_due()
+
+    def get_serializer_class(self):
+        if self.request.query_params.get('compact') in ['1', 'true']:
+            return BookCompactSerializer
+        return BookSerializer
+
+    def get_queryset(self):
+        fields = self.get_serializer().fields
+        return Book.objects.catalog(relations=[
+            relation for relation in BookQuerySet.CATALOG_RELATIONS if relation in fields
+        ])
+
+
+class BookRetrieveView(CatalogCacheMixin, BookCatalogMixin, generics.RetrieveAPIView):
     lookup_field = 'pk'
     lookup_url_kwarg = 'book_id'
 
 
-class BookListView(generics.ListAPIView):
-    serializer_class = BookSerializer
-    queryset = Book.objects.filter(is_delete=False)
+class BookListView(CatalogCacheMixin, BookCatalogMixin, generics.ListAPIView):
+    """
+    filters: see BookFilter
+    facets=true adds the facet counts of the filtered books to the response
+    """
+
+    filter_backends = [BookFilter, filters.OrderingFilter]
+    ordering_fields = ['pk', 'price', 'title']
+    ordering = ['pk']
+
+    pagination_classes = {
+        'page': BookPageNumberPagination,
+        'cursor': BookCursorPagination,
+    }
+
+    @property
+    def paginator(self):
+        """
+        pagination is chosen by the `pagination` query param (page or cursor), page by default,
+        every mode is capped by its max_page_size
+        """
+        if not hasattr(self, '_paginator'):
+            pagination_class = self.pagination_classes.get(self.request.query_params.get('pagination', 'page'),
+                                                           BookPageNumberPagination)
+            self._paginator = pagination_class()
+        return self._paginator
 
-    filter_backends = [filters.OrderingFilter]
-    ordering_fields = ['pk', ]
+    def list(self, request, *args, **kwargs):
+        response = super(BookListView, self).list(request, *args, **kwargs)
+
+        if request.query_params.get('facets') in ['1', 'true']:
+            facets = get_book_facets(self.filter_queryset(self.get_queryset()))
+            response.data['facets'] = facets
+
+        return response
+
+
+class BookSearchView(CatalogCacheMixin, BookCatalogMixin, generics.ListAPIView):
+    """
+    Full text search over the books search index
+    q: the search query, results are ranked and paginated
+    """
+
+    pagination_class = BookPageNumberPagination
+
+    def get_queryset(self):
+        queryset = super(BookSearchView, self).get_queryset()
+        return search_books(queryset, self.request.query_params.get('q', ''))
 
 
 class BasketCreateView(generics.CreateAPIView):
     permission_classes = (IsLoggedIn,)
     serializer_class = BasketCreate
 
+    def create(self, request, *args, **kwargs):
+        # the books of this basket reserved by abandoned baskets are available again before the stock is checked,
+        # a batch at a time, the other reservations are released by the catalog reads and reconcile_stock
+        book_ids = self.getBookIds(request.data)
+        if book_ids:
+            release_expired_reservations(limit=settings.RESERVATION_RELEASE_BATCH_SIZE, book_ids=book_ids)
+        return super().create(request, *args, **kwargs)
+
+    @staticmethod
+    def getBookIds(data):
+        """
+        :return: the book pks of the items in the request data, before it is validated
+        """
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list):
+            return []
+        return [item.get('book') for item in items if isinstance(item, dict) and str(item.get('book')).isdigit()]
+
     def perform_create(self, serializer):
         serializer.save(user_profile=self.request.user.user_profile)
 
@@ -129,6 +236,7 @@ class MakePaymentView(APIView):
 
 
 class VerifyPaymentView(APIView):
+    verification_lock = SharedKeyLock('verify')
 
     @staticmethod
     def doesHaveValidBasket(invoice):
@@ -151,15 +259,60 @@ class VerifyPaymentView(APIView):
     def getInvoiceSerializedData(invoice):
         return InvoiceDetailedSerializer(instance=invoice).data
 
+    @staticmethod
+    def getFinalInvoiceStatusCode(invoice):
+        # retried callbacks of a payed invoice succeed
+        return 200 if VerifyPaymentView.isInvoiceValidated(invoice) else 400
+
     @staticmethod
     def get(request, *args, **kwargs):
-        invoice = get_object_or_404(Invoice, internal_id=kwargs.get('internal_id'))
+        internal_id = kwargs.get('internal_id')
         self = VerifyPaymentView
 
+        # final invoices are answered from the database, without locking
+        invoice = get_object_or_404(Invoice.objects.select_related('basket'), internal_id=internal_id)
         if not self.doesHaveValidBasket(invoice):
-            return Response(self.getInvoiceSerializedData(invoice), status=400)
+            return Response(self.getInvoiceSerializedData(invoice), status=self.getFinalInvoiceStatusCode(invoice))
+
+        # duplicate callbacks, of any process, wait for the first one and read its result
+        with self.verification_lock(str(internal_id), settings.VERIFICATION_LOCK_TIMEOUT) as acquired:
+            if acquired:
+                return self.verify(internal_id)
+
+        self.verification_lock.wait(str(internal_id), settings.VERIFICATION_WAIT)
+        return self.getVerifiedResponse(internal_id)
+
+    @staticmethod
+    def getVerifiedResponse(internal_id):
+        """
+        the response of a duplicate callback, from the invoice verified by the first one
+        """
+        self = VerifyPaymentView
+
+        invoice = get_object_or_404(Invoice.objects.select_related('basket'), internal_id=internal_id)
+        if not self.doesHaveValidBasket(invoice):
+            return Response(self.getInvoiceSerializedData(invoice), status=self.getFinalInvoiceStatusCode(invoice))
 
-        self.validateInvoice(invoice)
+        # still in flight or the gateway failed, the callback can be retried
+        return Response({'details': _("Payment gateway is not available")}, status=503)
+
+    @staticmethod
+    def verify(internal_id):
+        """
+        no lock is held while vandar is called, the result is applied under the invoice row lock
+        (see vandar.apply_verification_result), as the async view does
+        """
+        self = VerifyPaymentView
+
+        invoice = get_object_or_404(Invoice.objects.select_related('basket'), internal_id=internal_id)
+        if not self.doesHaveValidBasket(invoice):
+            return Response(self.getInvoiceSerializedData(invoice), status=self.getFinalInvoiceStatusCode(invoice))
+
+        try:
+            self.validateInvoice(invoice)
+        except GatewayError:
+            # the payment state is unknown, the invoice can be verified again later
+            return Response({'details': _("Payment gateway is not available")}, status=503)
 
         if not self.isInvoiceValidated(invoice):
             return Response(self.getInvoiceSerializedData(invoice), status=400)
@@ -189,3 +342,23 @@ class GetConfigView(generics.RetrieveAPIView):
 
     def get_object(self):
         return Config.get_instance()
+
+
+class ThrottleStatsView(APIView):
+    """
+    allowed and rejected requests of the otp rate limits, for monitoring
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_throttle_stats())
+
+
+class GatewayMetricsView(APIView):
+    """
+    circuit states and per endpoint request metrics of the gateway clients of this process, for monitoring
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_metrics())